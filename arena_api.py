@@ -3,7 +3,7 @@
 整合 ielts_rca_analyzer.py 的完整 RCA 分析能力
 """
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response, g
 from flask_cors import CORS
 import os
 import sys
@@ -12,6 +12,9 @@ import base64
 import tempfile
 import time
 import hashlib
+import threading
+import queue
+import contextvars
 
 # 設定 Python 路徑以載入 analyzer
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -19,6 +22,15 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 app = Flask(__name__)
 CORS(app)  # 允許跨域請求
 
+from score_cache import ScoreCache
+import arena_metrics as metrics
+import arena_tracing as tracing
+import arena_profiling as profiling
+import token_ledger
+from token_ledger import BudgetExceeded
+import rca_workers
+import trend_engine
+
 # 導入 RCA 分析器的核心功能
 try:
     import ielts_rca_analyzer as analyzer
@@ -31,6 +43,12 @@ except ImportError as e:
 ESSAYS_FOLDER = "essays_to_analyze"
 REPORT_IMAGE = "ielts_task1_report.png"
 CACHE_FILE = "ai_scores_cache.json"
+RECORD_TRAFFIC_FILE = os.environ.get("ARENA_RECORD_TRAFFIC")  # 設定後將 POST 請求錄製為 JSONL，供 load_test.py --replay 重播
+
+# RandomForest 擬合與 matplotlib 繪圖在常駐行程池中執行 (ARENA_CPU_WORKERS=0 停用)，不佔用請求執行緒的 GIL
+cpu_pool = rca_workers.CpuPool()
+# 每位學生的線上趨勢統計 (每篇新作文 O(1) 更新)
+trend_registry = trend_engine.TrendRegistry(analyzer.TASK1_METRICS) if HAS_ANALYZER else None
 
 # ═══════════════════════════════════════════════════════════════════════════
 # 🔧 HELPER FUNCTIONS FOR SMART CACHING
@@ -41,20 +59,199 @@ def get_essay_hash(essay_text):
     normalized = essay_text.strip().lower()
     return hashlib.md5(normalized.encode('utf-8')).hexdigest()
 
+_score_cache = None
+_score_cache_lock = threading.Lock()
+
 def load_score_cache():
-    """Load the AI scores cache from disk."""
-    if os.path.exists(CACHE_FILE):
-        try:
-            with open(CACHE_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            print("[Warning] Cache file corrupted, starting fresh.")
-    return {}
+    """
+    Return the process-wide score cache (normalised hash → scores layout).
+    Request threads share one instance so their journal writes are group-committed;
+    each call picks up scores the CLI (or another worker) has written since.
+    """
+    global _score_cache
+    with _score_cache_lock:
+        if _score_cache is None:
+            _score_cache = ScoreCache.load(CACHE_FILE, essay_folder=ESSAYS_FOLDER)
+            return _score_cache
+    _score_cache.refresh()
+    return _score_cache
 
 def save_score_cache(cache_data):
-    """Save the AI scores cache to disk."""
-    with open(CACHE_FILE, 'w', encoding='utf-8') as f:
-        json.dump(cache_data, f, ensure_ascii=False, indent=2)
+    """Durably commit new scores (journal append + fsync, periodic atomic snapshot)."""
+    cache_data.save()
+
+def get_cached_scores(score_cache, essay_hash, essay_text, endpoint):
+    """
+    Look up a cache entry by hash. Entries scored under an older rubric are brought up
+    to date by partial rescoring (only the missing metrics) and written back.
+    """
+    entry = score_cache.get(essay_hash)
+    if entry is None:
+        metrics.CACHE_LOOKUPS.inc(endpoint=endpoint, result='miss')
+        return None
+    if analyzer.validate_cache_entry(entry):
+        metrics.CACHE_LOOKUPS.inc(endpoint=endpoint, result='hit')
+    else:
+        metrics.CACHE_LOOKUPS.inc(endpoint=endpoint, result='partial')
+        print(f"[API] 🧩 快取條目缺少新指標，部分補評中...")
+        repaired = analyzer.complete_cache_entry(entry, essay_text)
+        if repaired is None:
+            print(f"[API] ⚠️ 部分補評失敗，沿用既有快取")
+            return entry
+        score_cache.put(essay_hash, repaired)
+        save_score_cache(score_cache)
+        entry = repaired
+    return entry
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 🎙️ TRAFFIC RECORDING (for load_test.py --replay)
+# ═══════════════════════════════════════════════════════════════════════════
+
+_record_lock = threading.Lock()
+
+@app.before_request
+def _mark_request_start():
+    request.environ['arena.start'] = time.perf_counter()
+    metrics.HTTP_REQUESTS_IN_FLIGHT.inc()
+    g.trace = tracing.start_trace(f"{request.method} {request.path}", request.headers.get('X-Request-Id'))
+    token_ledger.set_context(endpoint=request.path, student=request_student_id())
+
+def request_student_id():
+    """Student id for token accounting: JSON 'student_id', X-Student-Id header, or 'anonymous'."""
+    data = request.get_json(silent=True) if request.is_json else None
+    student = (data or {}).get('student_id') if isinstance(data, dict) else None
+    return student or request.headers.get('X-Student-Id') or 'anonymous'
+
+def budget_exceeded_response(e):
+    print(f"[API] 🪙 {e}")
+    return jsonify({"error": str(e), "budget_exceeded": True, "task": e.task,
+                    "used": e.used, "limit": e.limit}), 429
+
+def profile_mode_requested():
+    """?profile=1|sample|cprofile or header X-Arena-Profile with the same values."""
+    value = (request.args.get('profile') or request.headers.get('X-Arena-Profile') or '').lower()
+    if value in ('1', 'true', 'sample'):
+        return 'sample'
+    if value == 'cprofile':
+        return 'cprofile'
+    return None
+
+@app.before_request
+def _start_profile():
+    mode = profile_mode_requested()
+    if mode is None:
+        return
+    if not profiling.api_limiter.acquire():
+        g.profile_status = 'rate-limited'
+        print(f"[API] ⏳ 剖析請求被限流 (ARENA_PROFILE_RATE={profiling.PROFILE_RATE_PER_MINUTE}/min)")
+        return
+    g.profile = profiling.ProfileSession(g.trace.trace_id, mode).start()
+
+def _stop_profile():
+    """Stop the request's profile and return the file path; a failed write is logged, never raised."""
+    session = g.pop('profile', None)
+    if session is None:
+        return None
+    try:
+        return session.stop()
+    except Exception as e:
+        print(f"[API] ⚠️ 剖析結果寫入失敗: {e}")
+        return None
+    finally:
+        profiling.api_limiter.release()
+
+@app.teardown_request
+def _mark_request_end(exc):
+    _stop_profile()
+    metrics.HTTP_REQUESTS_IN_FLIGHT.dec()
+    trace = g.pop('trace', None)
+    if trace is not None:  # after_request 未執行 (未處理的例外)
+        trace.attrs['error'] = type(exc).__name__ if exc else 'unknown'
+        tracing.finish_trace(trace)
+
+@app.after_request
+def _finish_profile(response):
+    path = _stop_profile()
+    if path:
+        print(f"[API] 🔬 剖析結果已儲存: {path}")
+        response.headers['X-Profile-File'] = os.path.basename(path)
+    elif g.pop('profile_status', None):
+        response.headers['X-Profile-File'] = 'rate-limited'
+    return response
+
+@app.after_request
+def _finish_trace(response):
+    trace = g.pop('trace', None)
+    if trace is not None:
+        trace.attrs['status'] = response.status_code
+        # 只記錄會做實際工作的 POST 請求，避免 /metrics 抓取與健康檢查洗掉 trace log
+        tracing.finish_trace(trace, log=request.method == 'POST' and request.path.startswith('/api/'))
+        response.headers['X-Request-Id'] = trace.trace_id
+    return response
+
+def timings_requested():
+    """?timings=1 or header X-Arena-Timings: 1 asks for span timings in the response."""
+    return request.args.get('timings') in ('1', 'true') or request.headers.get('X-Arena-Timings') == '1'
+
+def attach_timings(payload):
+    """Add the current trace (spans so far) as `timings` when the client asked for it."""
+    trace = tracing.current_trace()
+    if trace is not None and timings_requested():
+        payload["timings"] = trace.to_dict()
+    return payload
+
+@app.after_request
+def _observe_request(response):
+    # url_rule keeps the label set bounded (e.g. /tools/<path:filename>)
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    elapsed = time.perf_counter() - request.environ.get('arena.start', time.perf_counter())
+    metrics.HTTP_REQUEST_SECONDS.observe(elapsed, endpoint=endpoint, method=request.method, status=response.status_code)
+    # 串流回應 (SSE) 不計算長度: calculate_content_length() 會先把整個 generator 讀進記憶體
+    if not response.direct_passthrough and not response.is_streamed:
+        metrics.HTTP_RESPONSE_BYTES.observe(response.calculate_content_length() or 0, endpoint=endpoint)
+    return response
+
+@app.after_request
+def _record_traffic(response):
+    if RECORD_TRAFFIC_FILE and request.method == 'POST' and request.path.startswith('/api/') and request.is_json:
+        record = {
+            "ts": time.time(),
+            "method": request.method,
+            "path": request.path,
+            "body": request.get_json(silent=True),
+            "status": response.status_code,
+            "duration_ms": round((time.perf_counter() - request.environ.get('arena.start', time.perf_counter())) * 1000, 1),
+        }
+        try:
+            with _record_lock, open(RECORD_TRAFFIC_FILE, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"[API] ⚠️ 流量錄製失敗: {e}")
+    return response
+
+HISTORY_EXCERPT_CHARS = 500  # 前端只保存每篇歷史作文的前 500 字 + '...'
+
+def history_text(hist):
+    """Full text of a history entry, or None for the frontend's truncated excerpts (features would be skewed)."""
+    content = hist.get('content') or ''
+    if not content or (content.endswith('...') and len(content) >= HISTORY_EXCERPT_CHARS + 3):
+        return None
+    return content
+
+def requested_bootstrap(data):
+    """Bootstrap resamples for this request ('bootstrap' field, default RCA_BOOTSTRAP), capped."""
+    try:
+        resamples = int(data.get('bootstrap', analyzer.RCA_BOOTSTRAP))
+    except (TypeError, ValueError):
+        resamples = analyzer.RCA_BOOTSTRAP
+    return max(0, min(resamples, analyzer.RCA_BOOTSTRAP_MAX))
+
+def save_chart(png_bytes):
+    """Atomically replace the latest chart served by /api/chart."""
+    tmp = f"{REPORT_IMAGE}.{threading.get_ident()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(png_bytes)
+    os.replace(tmp, REPORT_IMAGE)
 
 def save_essay_to_folder(essay_text, essay_hash):
     """Save a new essay to the essays folder with a timestamped filename."""
@@ -102,9 +299,13 @@ def analyze_essay():
         essay_hash = get_essay_hash(essay_text)
         score_cache = load_score_cache()
         
-        if essay_hash in score_cache:
+        cached_entry = get_cached_scores(score_cache, essay_hash, essay_text, endpoint='analyze')
+        if cached_entry is not None:
             print(f"[API] 🚀 快取命中！")
-            scores = score_cache[essay_hash]
+            scores = dict(cached_entry)
+            file_name = score_cache.file_name_for(essay_hash)
+            if file_name:
+                scores['file_name'] = file_name
         else:
             print(f"[API] Analyzing essay ({len(essay_text)} chars)...")
             scores = analyzer.get_ai_scores(essay_text)
@@ -112,19 +313,27 @@ def analyze_essay():
             if not scores:
                 return jsonify({"error": "AI scoring failed"}), 500
             
-            # Save to folder and cache
-            filename = save_essay_to_folder(essay_text, essay_hash)
-            scores['file_name'] = filename
-            score_cache[essay_hash] = scores.copy()
-            save_score_cache(score_cache)
-            print(f"[API] 📝 新評分已快取")
+            if analyzer.is_cacheable_scores(scores):
+                # Save to folder and cache
+                filename = save_essay_to_folder(essay_text, essay_hash)
+                scores['file_name'] = filename
+                score_cache.put(essay_hash, scores, file_name=filename)
+                save_score_cache(score_cache)
+                print(f"[API] 📝 新評分已快取")
         
-        return jsonify({
+        source = scores.get('_source', 'llm')
+        variance = scores.get('_variance')
+        scores = analyzer.strip_cache_meta(scores)
+        return jsonify(attach_timings({
             "success": True,
             "scores": scores,
-            "overall_band": scores.get('overall_band', 0)
-        })
+            "overall_band": scores.get('overall_band', 0),
+            "score_source": source,
+            "score_variance": variance
+        }))
         
+    except BudgetExceeded as e:
+        return budget_exceeded_response(e)
     except Exception as e:
         print(f"[API Error] {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -152,6 +361,8 @@ def full_rca_analysis():
         import pandas as pd
         import numpy as np
         
+        stages = metrics.StageTimer(metrics.FULL_RCA_STAGE_SECONDS)
+        
         # 設定 provider
         analyzer.CURRENT_PROVIDER = data.get('provider', 'kimi')
         
@@ -162,15 +373,19 @@ def full_rca_analysis():
         # 1. Calculate content hash
         essay_hash = get_essay_hash(new_essay)
         print(f"[API] Essay hash: {essay_hash[:12]}...")
+        stages.mark('hash')
         
         # 2. Load cache and check if this essay has been scored before
         score_cache = load_score_cache()
         
-        if essay_hash in score_cache:
+        cached_entry = get_cached_scores(score_cache, essay_hash, new_essay, endpoint='full_rca')
+        stages.mark('cache_lookup')
+        if cached_entry is not None:
             # 🚀 CACHE HIT - Use existing scores
             print(f"[API] 🚀 快取命中！直接使用已有評分 (跳過 AI 呼叫)")
-            new_scores = score_cache[essay_hash].copy()
-            filename = new_scores.get('file_name', f"cached_{essay_hash[:8]}.txt")
+            new_scores = analyzer.with_score_variance(analyzer.strip_cache_meta(cached_entry), cached_entry)
+            filename = score_cache.file_name_for(essay_hash) or f"cached_{essay_hash[:8]}.txt"
+            new_scores['file_name'] = filename
         else:
             # ✨ NEW ESSAY - Score with AI and persist
             print(f"[API] ✨ 新作文偵測！正在評分...")
@@ -179,14 +394,20 @@ def full_rca_analysis():
             if not new_scores:
                 return jsonify({"error": "Failed to score new essay"}), 500
             
-            # Save to folder
-            filename = save_essay_to_folder(new_essay, essay_hash)
-            new_scores['file_name'] = filename
-            
-            # Update cache
-            score_cache[essay_hash] = new_scores.copy()
-            save_score_cache(score_cache)
-            print(f"[API] 📝 快取已更新")
+            if analyzer.is_cacheable_scores(new_scores):
+                # Save to folder
+                filename = save_essay_to_folder(new_essay, essay_hash)
+                new_scores['file_name'] = filename
+                
+                # Update cache
+                score_cache.put(essay_hash, new_scores, file_name=filename)
+                save_score_cache(score_cache)
+                print(f"[API] 📝 快取已更新")
+            else:
+                # 本地模型的分數不進快取 (快取同時是本地模型的訓練資料)
+                new_scores['file_name'] = f"local_{essay_hash[:8]}.txt"
+            new_scores = analyzer.with_score_variance(analyzer.strip_cache_meta(new_scores), new_scores)
+            stages.mark('scoring')
         
         # 3. 組合歷史數據
         all_scores = []
@@ -194,11 +415,14 @@ def full_rca_analysis():
             if 'scores' in hist:
                 score_entry = hist['scores'].copy()
                 score_entry['file_name'] = hist.get('id', 'unknown')
-                all_scores.append(score_entry)
-        all_scores.append(new_scores)
+                score_entry[analyzer.ESSAY_TIME_COLUMN] = analyzer.parse_essay_time(hist.get('timestamp'))
+                all_scores.append(analyzer.with_text_features(score_entry, history_text(hist)))
+        new_row = dict(new_scores, **{analyzer.ESSAY_TIME_COLUMN: time.time()})
+        all_scores.append(analyzer.with_text_features(new_row, new_essay))
         
         # 4. 創建 DataFrame
         df = pd.DataFrame(all_scores)
+        stages.mark('dataframe')
         
         # 5. 執行 ML RCA 分析
         print("[API] Running ML RCA analysis...")
@@ -206,34 +430,40 @@ def full_rca_analysis():
         rca_prev_results = None
         
         if len(df) >= 2:
-            rca_results = analyzer.perform_ml_analysis(df)
-            if len(df) > 2:
-                rca_prev_results = analyzer.perform_ml_analysis(df.iloc[:-1])
+            # 目前與「加入新作文前」兩次擬合在行程池中同時執行
+            rca_results, rca_prev_results = cpu_pool.rca(df, df.iloc[:-1] if len(df) > 2 else None,
+                                                         bootstrap=requested_bootstrap(data))
+        stages.mark('rca')
         
         # 5. 生成 AI 建議
         print("[API] Generating recommendations...")
         recommendations = ""
         if rca_results is not None:
             recommendations = analyzer.get_ai_recommendations(rca_results, df)
+        stages.mark('recommendations')
         
         # 6. 生成圖表
         print("[API] Generating charts...")
-        analyzer.plot_results(rca_results, df, recommendations, rca_prev_results)
+        chart_png = cpu_pool.chart(rca_results, df, recommendations, rca_prev_results,
+                                   text_file=analyzer.REPORT_TEXT_FILE)
+        save_chart(chart_png)
+        stages.mark('chart')
         
-        # 7. 讀取圖片並轉為 base64
-        chart_base64 = None
-        if os.path.exists(REPORT_IMAGE):
-            with open(REPORT_IMAGE, 'rb') as f:
-                chart_base64 = base64.b64encode(f.read()).decode('utf-8')
+        # 7. 圖片轉為 base64
+        chart_base64 = base64.b64encode(chart_png).decode('utf-8')
+        stages.mark('chart_encode')
         
-        # 8. 計算戰鬥結果
+        # 8. 計算戰鬥結果 (加上趨勢引擎的近期變點)
+        trends = trend_registry.observe(request_student_id(), all_scores[:-1], all_scores[-1])
         battle_result = calculate_battle_result(df, new_scores, rca_results)
+        battle_result["trend_changes"] = trends.recent_changes()
 
         # 9. 準備前端繪圖所需的原始數據 (Chart Data)
         chart_data = {
             "radar": [],
             "trend": [],
-            "rca": []
+            "rca": [],
+            "trends": trends.snapshot()   # 每個指標的 EWMA / 斜率 / 變點
         }
 
         # (A) Radar Chart Data - Skill Groups
@@ -278,6 +508,9 @@ def full_rca_analysis():
                 item['Prev_Bottleneck_Index'] = float(prev_val)
                 diff = float(item['Bottleneck_Index']) - float(prev_val)
                 item['Diff'] = diff
+                if 'BI_CI_Low' in item and metric in prev_map:
+                    # 前一次的值落在目前的信賴區間內時，變化不具意義
+                    item['Diff_Significant'] = not (item['BI_CI_Low'] <= prev_val <= item['BI_CI_High'])
                 
             chart_data["rca"] = rca_clean
 
@@ -291,7 +524,9 @@ def full_rca_analysis():
             "rca_summary": None,
             "recommendations": recommendations,
             "chart_image": chart_base64, # Legacy support
-            "chart_data": chart_data      # New rich data
+            "chart_data": chart_data,     # New rich data
+            "rca_bootstrap": rca_results.attrs.get('bootstrap') if rca_results is not None else None,
+            "rca_window": rca_results.attrs.get('window') if rca_results is not None else None
         }
 
         if rca_results is not None:
@@ -299,9 +534,12 @@ def full_rca_analysis():
                 "top_bottlenecks": rca_results.head(3).to_dict('records'),
                 "total_essays": len(df)
             }
+        stages.mark('response_build')
         
-        return jsonify(response)
+        return jsonify(attach_timings(response))
         
+    except BudgetExceeded as e:
+        return budget_exceeded_response(e)
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -352,6 +590,188 @@ def calculate_battle_result(df, new_scores, rca_results):
         "regression_count": len(regressions)
     }
 
+# ═══════════════════════════════════════════════════════════════════════════
+# 🌊 STREAMING REPORTS (Server-Sent Events)
+# ═══════════════════════════════════════════════════════════════════════════
+
+STREAM_KINDS = ('recommendations', 'detailed-report')
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/api/stream/<kind>', methods=['POST'])
+def stream_report(kind):
+    """
+    以 Server-Sent Events 串流 AI 建議 (recommendations) 或詳細 RCA 報告 (detailed-report)，
+    Kimi / Gemini 皆逐段輸出。輸入與 /api/full-rca 的歷史作文相同:
+    {"essays": [{"id", "scores", "content"?}, ...], "provider"}
+    事件: rca (前三大瓶頸) → chunk {"text"} ... → done {"text"} 或 error {"error"}。
+    done 的文字為最終版本 (對沖請求勝出時可能與已串流的內容不同)。
+    用戶端斷線時背景執行緒會被取消，不再送出後續的 (付費) LLM 呼叫。
+    """
+    if not HAS_ANALYZER:
+        return jsonify({"error": "Analyzer not loaded"}), 500
+    if kind not in STREAM_KINDS:
+        return jsonify({"error": f"Unknown stream '{kind}' (use {', '.join(STREAM_KINDS)})"}), 404
+
+    data = request.get_json() or {}
+    rows, essays_list = [], []
+    for i, hist in enumerate(data.get('essays', [])):
+        if 'scores' not in hist:
+            continue
+        name = hist.get('id') or f"essay_{i + 1}"
+        row = dict(hist['scores'], file_name=name)
+        row[analyzer.ESSAY_TIME_COLUMN] = analyzer.parse_essay_time(hist.get('timestamp'))
+        rows.append(analyzer.with_text_features(row, history_text(hist)))
+        essays_list.append({'file_name': name, 'content': hist.get('content', '')})
+    if len(rows) < 2:
+        return jsonify({"error": "Need at least 2 scored essays"}), 400
+
+    # provider 以參數傳入，不修改 analyzer.CURRENT_PROVIDER (其他請求會在串流期間切換它)
+    provider = data.get('provider', 'kimi')
+    events = queue.Queue()
+    cancel = threading.Event()
+
+    def produce():
+        import pandas as pd
+        import numpy as np
+        try:
+            df = pd.DataFrame(rows)
+            rca_results, = cpu_pool.rca(df)
+            if rca_results is None:
+                events.put(('error', {"error": "RCA analysis failed"}))
+                return
+            events.put(('rca', {"top_bottlenecks": rca_results.head(3).replace({np.nan: 0}).to_dict('records'),
+                                "total_essays": len(df)}))
+            if cancel.is_set():
+                return
+            on_chunk = lambda text: events.put(('chunk', {"text": text}))
+            if kind == 'recommendations':
+                text = analyzer.get_ai_recommendations(rca_results, df, on_chunk=on_chunk, provider=provider,
+                                                       cancel_event=cancel)
+            else:
+                text = analyzer.generate_detailed_rca_report(rca_results, df, essays_list, on_chunk=on_chunk,
+                                                             provider=provider, cancel_event=cancel)
+            if cancel.is_set():
+                print(f"[API] 🔌 串流用戶端已斷線，已取消 {kind}")
+                return
+            events.put(('done', {"text": text or ""}))
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            events.put(('error', {"error": str(e)}))
+        finally:
+            events.put(None)
+
+    # 在背景執行緒產生內容 (保留 token 記帳與 trace 的 context)，回應本身只負責轉送事件
+    threading.Thread(target=contextvars.copy_context().run, args=(produce,),
+                     name=f"stream-{kind}", daemon=True).start()
+
+    def generate():
+        try:
+            yield sse_event('start', {"kind": kind, "provider": provider})
+            while True:
+                item = events.get()
+                if item is None:
+                    return
+                yield sse_event(*item)
+        except GeneratorExit:
+            cancel.set()  # 用戶端斷線 (WSGI 伺服器關閉回應)
+            raise
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/usage', methods=['GET'])
+def get_usage():
+    """
+    LLM token 用量與成本: ?days=7&student=<id>&by=endpoint,student,provider,task
+    """
+    days = request.args.get('days', default=1, type=int)
+    by = tuple(f for f in request.args.get('by', ','.join(token_ledger.GROUP_FIELDS)).split(',')
+               if f in token_ledger.GROUP_FIELDS)
+    return jsonify(token_ledger.get_ledger().summary(days=max(days, 1), by=by, student=request.args.get('student')))
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus 指標 (text exposition format)"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/api/trends', methods=['GET'])
+def get_trends():
+    """學生各指標的線上趨勢 (EWMA、斜率、CUSUM 變點)；?student= 或 X-Student-Id"""
+    if not HAS_ANALYZER:
+        return jsonify({"error": "Analyzer not loaded"}), 500
+    student = request.args.get('student') or request_student_id()
+    engine = trend_registry.get(student)
+    if engine is None:
+        return jsonify({"error": f"No trend data for student '{student}' yet (submit via /api/full-rca)"}), 404
+    return jsonify({"student": student, "essays": engine.n, "trends": engine.snapshot(),
+                    "recent_changes": engine.recent_changes()})
+
+def cohort_histories(students):
+    """
+    /api/cohort-rca 'students' -> {student_id: [score rows]}. Accepts a list of
+    {"student_id", "essays": [{"scores", "timestamp"}]} or a {student_id: essays} mapping.
+    Malformed input raises ValueError.
+    """
+    if isinstance(students, dict):
+        students = [{'student_id': sid, 'essays': essays} for sid, essays in students.items()]
+    if not isinstance(students, list):
+        raise ValueError("'students' must be a list or an object")
+    histories = {}
+    for i, student in enumerate(students):
+        if not isinstance(student, dict) or not isinstance(student.get('essays', []), list):
+            raise ValueError(f"students[{i}] must be an object with an 'essays' list")
+        rows = []
+        for hist in student.get('essays', []):
+            if not isinstance(hist, dict):
+                raise ValueError(f"students[{i}]: each essay must be an object")
+            if 'scores' in hist:
+                if not isinstance(hist['scores'], dict):
+                    raise ValueError(f"students[{i}]: 'scores' must be an object")
+                row = dict(hist['scores'])
+                row[analyzer.ESSAY_TIME_COLUMN] = analyzer.parse_essay_time(hist.get('timestamp'))
+                rows.append(row)
+        histories[str(student.get('student_id', f"student_{i + 1}"))] = rows
+    return histories
+
+@app.route('/api/cohort-rca', methods=['POST'])
+def cohort_rca_analysis():
+    """
+    全班 RCA：一次送入所有學生的評分歷史，回傳班級瓶頸排名、每位學生的前幾名瓶頸與離群學生
+    (只用已有評分，不呼叫 AI)
+    """
+    if not HAS_ANALYZER:
+        return jsonify({"error": "Analyzer not loaded"}), 500
+    data = request.get_json() or {}
+    students = data.get('students')
+    if not students:
+        return jsonify({"error": "No students provided"}), 400
+    try:
+        window = int(data.get('window', analyzer.cohort_rca.COHORT_WINDOW_ESSAYS))
+        top = max(1, min(int(data.get('top', 3)), len(analyzer.TASK1_METRICS)))
+    except (TypeError, ValueError):
+        return jsonify({"error": "'window' and 'top' must be integers"}), 400
+
+    stages = metrics.StageTimer(metrics.COHORT_RCA_STAGE_SECONDS)
+    try:
+        histories = cohort_histories(students)
+        matrix = analyzer.cohort_rca.build_matrix(histories, list(analyzer.TASK1_METRICS), window=window)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    stages.mark('cohort_matrix')
+    if not matrix['students']:
+        return jsonify({"error": f"No student has at least {analyzer.cohort_rca.COHORT_MIN_ESSAYS} scored essays"}), 400
+    try:
+        result = cpu_pool.cohort(matrix, top=top)
+    except Exception as e:
+        print(f"[API] Cohort RCA error: {e}")
+        return jsonify({"error": str(e)}), 500
+    stages.mark('cohort_rca')
+    result['skipped_students'] = sorted(set(histories) - set(matrix['students']))
+    return jsonify(attach_timings({"success": True, **result}))
+
 @app.route('/api/chart', methods=['GET'])
 def get_chart():
     """獲取最新生成的圖表"""
@@ -429,6 +849,9 @@ if __name__ == '__main__':
     print("⚔️ IELTS Challenger Arena API Server")
     print("=" * 60)
     print(f"Analyzer loaded: {HAS_ANALYZER}")
+    if HAS_ANALYZER and cpu_pool.workers > 0:
+        cpu_pool.start()
+        print(f"CPU pool: {cpu_pool.workers} warm worker process(es) for RCA / charts")
     port = int(os.environ.get('PORT', 3000))
     print(f"Starting server on http://0.0.0.0:{port}")
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,296 @@
+"""
+📈 Arena Metrics - Prometheus 文字格式的計數器與直方圖
+不依賴 prometheus_client；arena_api.py 的 /metrics 端點直接輸出 render() 的結果。
+
+ielts_rca_analyzer.py 也會更新這些指標 (LLM 延遲、JSON 重試、RF 訓練、圖表繪製)，
+在 CLI 中它們只是記憶體中的數字，不會輸出。
+"""
+
+import time
+import threading
+import contextlib
+import contextvars
+
+import arena_tracing as tracing
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 秒數直方圖的預設區間；LLM 呼叫需要到數十秒
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LLM_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+_captured = contextvars.ContextVar("arena_metrics_capture", default=None)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render_items(items))
+        return lines
+
+    def _render_items(self, items):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Counter(_Metric):
+    """Monotonically increasing count."""
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """Value that can go up and down (e.g. in-flight requests)."""
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+    """Cumulative-bucket histogram with _sum and _count series."""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        captured = _captured.get()
+        if captured is not None:
+            captured.append((self.name, value, labels))
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["buckets"][i] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    def time(self, **labels):
+        """Context manager that observes the elapsed wall time in seconds."""
+        return _Timer(self, labels)
+
+    def snapshot(self, **labels):
+        state = self._values.get(self._key(labels))
+        return {"sum": state["sum"], "count": state["count"]} if state else {"sum": 0.0, "count": 0}
+
+    def _render_items(self, items):
+        lines = []
+        for key, state in items:
+            for bound, count in zip(self.buckets, state["buckets"]):
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', _format_value(bound)))} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', '+Inf'))} {state['count']}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(state['sum'])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {state['count']}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.elapsed = time.perf_counter() - self.start
+        self.histogram.observe(self.elapsed, **self.labels)
+        return False
+
+
+class StageTimer:
+    """
+    Sequential stage stopwatch: mark(stage) observes the time since the previous
+    mark into `histogram` under label stage=<stage> and keeps it in .timings.
+    Each mark is also recorded as a span of the current trace, if any.
+    """
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.timings = {}
+        self._last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        elapsed = now - self._last
+        tracing.add_span(stage, self._last, now)
+        self._last = now
+        self.histogram.observe(elapsed, stage=stage)
+        self.timings[stage] = self.timings.get(stage, 0.0) + elapsed
+        return elapsed
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def get(self, name):
+        return next((m for m in self._metrics if m.name == name), None)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def render():
+    return REGISTRY.render()
+
+
+@contextlib.contextmanager
+def capture():
+    """
+    Collect the histogram observations made in this context as (name, value, labels)
+    tuples. rca_workers uses it so the pool processes can hand them back to the API.
+    """
+    observed = []
+    token = _captured.set(observed)
+    try:
+        yield observed
+    finally:
+        _captured.reset(token)
+
+
+def replay(observed):
+    """Apply observations captured in another process to this process's registry."""
+    for name, value, labels in observed:
+        metric = REGISTRY.get(name)
+        if metric is not None:
+            metric.observe(value, **labels)
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 📋 METRIC DEFINITIONS
+# ═══════════════════════════════════════════════════════════════════════════
+
+HTTP_REQUESTS_IN_FLIGHT = Gauge(
+    "arena_http_requests_in_flight", "Requests currently being handled")
+HTTP_REQUEST_SECONDS = Histogram(
+    "arena_http_request_duration_seconds", "Request latency by endpoint",
+    ("endpoint", "method", "status"), buckets=LLM_BUCKETS)
+HTTP_RESPONSE_BYTES = Histogram(
+    "arena_http_response_size_bytes", "Response body size by endpoint",
+    ("endpoint",), buckets=SIZE_BUCKETS)
+
+CACHE_LOOKUPS = Counter(
+    "arena_score_cache_lookups_total", "Score cache lookups by endpoint and result (hit/miss/partial)",
+    ("endpoint", "result"))
+
+LLM_CALL_SECONDS = Histogram(
+    "arena_llm_call_duration_seconds", "LLM call latency by provider, call type and outcome",
+    ("provider", "task", "outcome"), buckets=LLM_BUCKETS)
+LLM_FIRST_CHUNK_SECONDS = Histogram(
+    "arena_llm_first_chunk_seconds", "Time from LLM call start to the first streamed visible text chunk",
+    ("provider", "task"), buckets=LLM_BUCKETS)
+LLM_TOKENS = Counter(
+    "arena_llm_tokens_total", "LLM tokens by provider, call type and kind (prompt/completion/cached_prompt; estimated when unreported)",
+    ("provider", "task", "kind"))
+LLM_JSON_RETRIES = Counter(
+    "arena_llm_json_retries_total", "Score replies rejected (empty, not JSON or missing metrics) and retried",
+    ("provider", "task", "reason"))
+LLM_HEDGES = Counter(
+    "arena_llm_hedges_total", "Duplicate calls sent to a peer provider (reason: slow/failover/circuit_open)",
+    ("primary", "peer", "reason"))
+LLM_HEDGE_WINS = Counter(
+    "arena_llm_hedge_wins_total", "Hedged calls won, by the provider whose result was used",
+    ("provider",))
+LLM_CIRCUIT_STATE = Gauge(
+    "arena_llm_circuit_state", "Provider circuit breaker state (0 closed, 1 half-open, 2 open)",
+    ("provider",))
+PROMPT_CACHE_EVENTS = Counter(
+    "arena_prompt_cache_events_total", "Provider prompt-cache handle events (hit/create/refresh/evict/invalidated/error)",
+    ("provider", "event"))
+
+LOCAL_SCORER_DECISIONS = Counter(
+    "arena_local_scorer_decisions_total", "local/hybrid scoring outcomes (local, escalated to the LLM, or no model)",
+    ("provider", "decision"))
+SCORING_ENSEMBLE_MEMBERS = Histogram(
+    "arena_scoring_ensemble_members", "Ensemble members whose scores were aggregated per essay",
+    buckets=(1, 2, 3, 4, 5, 6, 8))
+
+RF_FIT_SECONDS = Histogram(
+    "arena_rf_fit_duration_seconds", "RandomForest fit time in perform_ml_analysis")
+CHART_RENDER_SECONDS = Histogram(
+    "arena_chart_render_duration_seconds", "plot_results chart rendering time (including PNG/text write)")
+
+CPU_POOL_TASK_SECONDS = Histogram(
+    "arena_cpu_pool_task_duration_seconds", "CPU-bound API stages (rca/chart) incl. pool transfer, by mode (pool/inline)",
+    ("task", "mode"))
+
+FULL_RCA_STAGE_SECONDS = Histogram(
+    "arena_full_rca_stage_duration_seconds", "Time spent in each /api/full-rca stage",
+    ("stage",), buckets=LLM_BUCKETS)
+COHORT_RCA_STAGE_SECONDS = Histogram(
+    "arena_cohort_rca_stage_duration_seconds", "Time spent in each /api/cohort-rca stage (matrix build, analysis)",
+    ("stage",), buckets=LLM_BUCKETS)
@@ -0,0 +1,291 @@
+"""
+🔬 Arena Profiling - 按需效能剖析 (API 請求 / CLI 執行)
+- 'sample'  : 取樣式剖析器，定時讀取目標執行緒的堆疊，輸出 collapsed stacks
+              (flamegraph.pl / speedscope / inferno 可直接讀取)，額外負擔低，可於正式環境使用
+- 'cprofile': 決定性剖析 (cProfile)，輸出 .prof (snakeviz / pstats)，額外負擔較高
+
+API: ?profile=1 (或 ?profile=cprofile) / X-Arena-Profile 標頭；受 ARENA_PROFILE_RATE 限流。
+CLI: python ielts_rca_analyzer.py --profile [sample|cprofile]
+
+每次剖析會在 ARENA_PROFILE_DIR 產生 <時間>_<request id>.* 檔案，以及一份依套件
+(seaborn / matplotlib / pandas / sklearn ...) 與熱點函式 (plot_results / perform_ml_analysis)
+彙總的 .summary.txt，用來判斷非 LLM 時間花在哪裡。
+
+CPU 階段在 rca_workers 行程池中執行時，工作行程以同一模式剖析該任務 (capture())，
+結果併入請求的剖析檔: collapsed stacks 放在 'cpu_pool_worker' 根節點下 (與請求執行緒
+等待結果的取樣同時存在，取樣總數因此會超過 wall time / 間隔)，cprofile 統計直接合併。
+"""
+
+import io
+import os
+import re
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import contextlib
+import contextvars
+from collections import Counter, deque
+
+PROFILE_DIR = os.environ.get("ARENA_PROFILE_DIR", "profiles")
+PROFILE_RATE_PER_MINUTE = float(os.environ.get("ARENA_PROFILE_RATE", "2"))  # API 每分鐘最多剖析次數，0 = 停用
+SAMPLE_INTERVAL = float(os.environ.get("ARENA_PROFILE_INTERVAL", "0.005"))  # 取樣間隔 (秒)
+PROFILE_MODES = ('sample', 'cprofile')
+
+# 熱點函式：summary 會列出它們的 inclusive 取樣比例
+FOCUS_FUNCTIONS = ('perform_ml_analysis', 'plot_results', 'get_ai_scores', 'get_ai_recommendations')
+WORKER_ROOT = "cpu_pool_worker"  # 行程池任務堆疊的根節點名稱
+
+_current = contextvars.ContextVar("arena_profile", default=None)
+
+
+# 第三方套件與標準函式庫保留套件路徑 (sklearn/ensemble/_forest.py)，專案檔案只留檔名
+_LIB_PATH = re.compile(r'.*/(?:site-packages|dist-packages|lib/python\d+\.\d+)/')
+
+
+def _frame_label(code):
+    filename = code.co_filename.replace('\\', '/')
+    if _LIB_PATH.match(filename):
+        filename = _LIB_PATH.sub('', filename, count=1)
+    else:
+        filename = os.path.basename(filename)
+    # ';' 是 collapsed 格式的分隔符，不能出現在名稱裡
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(';', ':')
+
+
+def _collapse(frame):
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame.f_code))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+def _package_of(label):
+    """'fit (sklearn/ensemble/_forest.py:314)' -> 'sklearn'; project files keep their module name."""
+    location = label.rsplit(' (', 1)[-1].rstrip(')')
+    path = location.rsplit(':', 1)[0]
+    if '/' in path:
+        return path.split('/', 1)[0]
+    return path[:-3] if path.endswith('.py') else path
+
+
+class SamplingProfiler:
+    """Sample one thread's Python stack every `interval` seconds from a helper thread."""
+
+    def __init__(self, thread_id=None, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="arena-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[_collapse(frame)] += 1
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self.stacks
+
+
+class _StatsHolder:
+    """cProfile stats from another process in the shape pstats.Stats.add() accepts."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+class ProfileSession:
+    """
+    One profiling run (sample or cprofile) of the calling thread, saved under PROFILE_DIR.
+    Results of pool worker tasks are added with merge().
+    """
+
+    def __init__(self, profile_id, mode='sample', directory=None):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode '{mode}' (use {', '.join(PROFILE_MODES)})")
+        # 檔名的一部分: 只保留安全字元 (id 可能來自用戶端的 X-Request-Id)
+        self.profile_id = re.sub(r"[^A-Za-z0-9_-]", "_", str(profile_id))[:64] or "profile"
+        self.mode = mode
+        self.directory = directory or PROFILE_DIR
+        self._profiler = None
+        self._worker_results = []
+        self._token = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self._token = _current.set(self)
+        if self.mode == 'cprofile':
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        else:
+            self._profiler = SamplingProfiler().start()
+        return self
+
+    def stop(self):
+        """Stop profiling, write the output files and return the main file path."""
+        elapsed = time.perf_counter() - self.started
+        # 先停止剖析器 (取樣執行緒)，寫檔失敗時也不會留下
+        if self.mode == 'cprofile':
+            self._profiler.disable()
+        else:
+            stacks = self._profiler.stop()
+        try:
+            _current.reset(self._token)
+        except (ValueError, TypeError):
+            _current.set(None)  # 在其他 context 中停止 (例如串流回應結束時)
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, f"{time.strftime('%Y%m%d_%H%M%S')}_{self.profile_id}")
+
+        if self.mode == 'cprofile':
+            path = base + ".prof"
+            stats = pstats.Stats(self._profiler)
+            for result in self._worker_results:
+                stats.add(_StatsHolder(result))
+            stats.dump_stats(path)
+            summary = self._cprofile_summary(stats, elapsed)
+        else:
+            stacks = Counter(stacks)
+            for result in self._worker_results:
+                for stack, count in result.items():
+                    stacks[f"{WORKER_ROOT};{stack}"] += count
+            path = base + ".collapsed"
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+            summary = summarize_stacks(stacks, elapsed)
+
+        with open(base + ".summary.txt", 'w', encoding='utf-8') as f:
+            f.write(summary)
+        self.path = path
+        self.summary = summary
+        return path
+
+    def merge(self, result):
+        """Add a capture() result from a pool worker (same mode as this session)."""
+        if result:
+            self._worker_results.append(result)
+
+    def _cprofile_summary(self, stats, elapsed):
+        stream = io.StringIO()
+        stats.stream = stream
+        stats.sort_stats('cumulative').print_stats(30)
+        return f"Profile {self.profile_id} (cprofile), wall {elapsed:.3f}s\n\n" + stream.getvalue()
+
+
+def current_session():
+    """The ProfileSession started in this context (request thread), if any."""
+    return _current.get()
+
+
+class _Captured:
+    result = None
+
+
+@contextlib.contextmanager
+def capture(mode):
+    """
+    Profile the calling thread for the duration of the block (used inside pool workers);
+    `.result` is then a {stack: count} dict (sample) or cProfile stats (cprofile), or
+    None when mode is None.
+    """
+    captured = _Captured()
+    if mode is None:
+        yield captured
+    elif mode == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield captured
+        finally:
+            profiler.disable()
+            profiler.create_stats()
+            captured.result = profiler.stats
+    else:
+        sampler = SamplingProfiler().start()
+        try:
+            yield captured
+        finally:
+            captured.result = dict(sampler.stop())
+
+
+def summarize_stacks(stacks, elapsed=None):
+    """
+    Text summary of collapsed stacks: self-time share per package (leaf frame) and
+    the inclusive share and package breakdown of each FOCUS_FUNCTIONS entry.
+    """
+    total = sum(stacks.values())
+    lines = [f"Samples: {total}" + (f", wall {elapsed:.3f}s" if elapsed is not None else "")]
+    if not total:
+        return "\n".join(lines) + "\n"
+
+    by_package = Counter()
+    focus = {name: Counter() for name in FOCUS_FUNCTIONS}
+    for stack, count in stacks.items():
+        frames = stack.split(';')
+        package = _package_of(frames[-1])
+        by_package[package] += count
+        names = {f.split(' (', 1)[0] for f in frames}
+        for name in FOCUS_FUNCTIONS:
+            if name in names:
+                focus[name][package] += count
+
+    lines.append("\n--- Self time by package (leaf frame) ---")
+    for package, count in by_package.most_common(15):
+        lines.append(f"  {package:<28} {count / total:6.1%}  ({count})")
+
+    for name, packages in focus.items():
+        inclusive = sum(packages.values())
+        if not inclusive:
+            continue
+        lines.append(f"\n--- {name}: {inclusive / total:.1%} of samples ---")
+        for package, count in packages.most_common(8):
+            lines.append(f"  {package:<28} {count / inclusive:6.1%}")
+    return "\n".join(lines) + "\n"
+
+
+class RateLimiter:
+    """
+    Allow at most `per_minute` profiles in any 60 s window and one at a time,
+    so the flag can stay enabled in production.
+    """
+
+    def __init__(self, per_minute=PROFILE_RATE_PER_MINUTE):
+        self.per_minute = per_minute
+        self._times = deque()
+        self._lock = threading.Lock()
+        self._active = False
+
+    def acquire(self):
+        if self.per_minute <= 0:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            while self._times and now - self._times[0] > 60:
+                self._times.popleft()
+            if self._active or len(self._times) >= self.per_minute:
+                return False
+            self._times.append(now)
+            self._active = True
+            return True
+
+    def release(self):
+        with self._lock:
+            self._active = False
+
+
+api_limiter = RateLimiter()
@@ -0,0 +1,197 @@
+"""
+🧵 Arena Tracing - 單一請求的階段計時 (trace spans)
+每個 API 請求建立一個 Trace；analyzer 的熱點函式以 span() / @traced 記錄耗時，
+沒有進行中的 Trace 時 (例如 CLI) 這些呼叫不做任何事。
+
+完成的 Trace 以一行 JSON 寫入輪替的 trace log (ARENA_TRACE_LOG，預設 arena_traces.log)，
+請求帶 ?timings=1 或 X-Arena-Timings: 1 時也會放在回應的 `timings` 欄位。
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import logging
+import functools
+import contextvars
+from logging.handlers import RotatingFileHandler
+
+TRACE_LOG_FILE = os.environ.get("ARENA_TRACE_LOG", "arena_traces.log")
+TRACE_LOG_MAX_BYTES = int(os.environ.get("ARENA_TRACE_LOG_MAX_BYTES", str(5 * 1024 * 1024)))
+TRACE_LOG_BACKUPS = int(os.environ.get("ARENA_TRACE_LOG_BACKUPS", "5"))
+TRACE_LOG_MIN_MS = float(os.environ.get("ARENA_TRACE_LOG_MIN_MS", "0"))  # 只記錄超過此耗時的請求
+
+# 用戶端傳入的 X-Request-Id 只在符合此格式時沿用 (會寫入 log、回應標頭與剖析檔名)
+TRACE_ID_RE = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+_current = contextvars.ContextVar("arena_trace", default=None)
+_trace_logger = None
+
+
+class Trace:
+    """Span timings for one request, relative to the trace start."""
+
+    def __init__(self, name, trace_id=None):
+        self.name = name
+        self.trace_id = trace_id if valid_trace_id(trace_id) else uuid.uuid4().hex[:16]
+        self.started_at = time.time()
+        self._t0 = time.perf_counter()
+        self.spans = []      # [{"name", "start", "end", "parent", "attrs"}]
+        self._stack = []     # indices of open spans
+        self.attrs = {}
+
+    def _open(self, name, attrs):
+        parent = self.spans[self._stack[-1]]["name"] if self._stack else None
+        self.spans.append({"name": name, "start": time.perf_counter(), "end": None,
+                           "parent": parent, "attrs": attrs})
+        self._stack.append(len(self.spans) - 1)
+        return len(self.spans) - 1
+
+    def _close(self, index):
+        self.spans[index]["end"] = time.perf_counter()
+        if self._stack and self._stack[-1] == index:
+            self._stack.pop()
+
+    def add_span(self, name, start, end, **attrs):
+        """
+        Record an already-finished span (used by StageTimer marks). Root-level spans
+        that ran inside [start, end] are re-parented under it.
+        """
+        parent = self.spans[self._stack[-1]]["name"] if self._stack else None
+        for span in self.spans:
+            if span["parent"] == parent and span["end"] is not None and start <= span["start"] and span["end"] <= end:
+                span["parent"] = name
+        self.spans.append({"name": name, "start": start, "end": end, "parent": parent, "attrs": attrs})
+
+    def merge(self, data, end):
+        """
+        Graft a finished trace in to_dict() form (e.g. from a pool worker) that ended at
+        perf_counter() == end; its root spans go under the currently open span.
+        """
+        origin = end - data["total_ms"] / 1000
+        parent = self.spans[self._stack[-1]]["name"] if self._stack else None
+        for span in data["spans"]:
+            start = origin + span["start_ms"] / 1000
+            self.spans.append({"name": span["name"], "start": start, "end": start + span["duration_ms"] / 1000,
+                               "parent": span["parent"] or parent, "attrs": span.get("attrs", {})})
+
+    def total_ms(self):
+        return (time.perf_counter() - self._t0) * 1000
+
+    def to_dict(self):
+        spans = []
+        for span in sorted(self.spans, key=lambda s: s["start"]):
+            end = span["end"] if span["end"] is not None else time.perf_counter()
+            item = {
+                "name": span["name"],
+                "start_ms": round((span["start"] - self._t0) * 1000, 2),
+                "duration_ms": round((end - span["start"]) * 1000, 2),
+                "parent": span["parent"],
+            }
+            if span["attrs"]:
+                item["attrs"] = span["attrs"]
+            spans.append(item)
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started_at)),
+            "total_ms": round(self.total_ms(), 2),
+            "attrs": self.attrs,
+            "spans": spans,
+        }
+
+
+class _Span:
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.trace = None
+
+    def __enter__(self):
+        self.trace = _current.get()
+        if self.trace is not None:
+            self.index = self.trace._open(self.name, self.attrs)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.trace is not None:
+            if exc_type is not None:
+                self.trace.spans[self.index]["attrs"] = dict(self.attrs, error=exc_type.__name__)
+            self.trace._close(self.index)
+        return False
+
+
+def span(name, **attrs):
+    """Context manager recording a span in the current trace (no-op without one)."""
+    return _Span(name, attrs)
+
+
+def traced(name=None):
+    """Decorator form of span() using the function name by default."""
+    def decorator(fn):
+        span_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _current.get() is None:
+                return fn(*args, **kwargs)
+            with _Span(span_name, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current_trace():
+    return _current.get()
+
+
+def add_span(name, start, end, **attrs):
+    trace = _current.get()
+    if trace is not None:
+        trace.add_span(name, start, end, **attrs)
+
+
+def merge_trace(data, end):
+    trace = _current.get()
+    if trace is not None:
+        trace.merge(data, end)
+
+
+def valid_trace_id(value):
+    """True if a client-supplied request id is safe to reuse as the trace id."""
+    return isinstance(value, str) and TRACE_ID_RE.fullmatch(value) is not None
+
+
+def start_trace(name, trace_id=None):
+    """Begin a trace for the current thread/context and return it (invalid ids are replaced)."""
+    trace = Trace(name, trace_id)
+    trace._token = _current.set(trace)
+    return trace
+
+
+def finish_trace(trace, log=True):
+    """Detach the trace from the current context and append it to the trace log."""
+    try:
+        _current.reset(trace._token)
+    except (ValueError, AttributeError):
+        _current.set(None)
+    data = trace.to_dict()
+    if log and data["total_ms"] >= TRACE_LOG_MIN_MS:
+        _get_logger().info(json.dumps(data, ensure_ascii=False))
+    return data
+
+
+def _get_logger():
+    global _trace_logger
+    if _trace_logger is None:
+        logger = logging.getLogger("arena.trace")
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        if not logger.handlers:
+            handler = RotatingFileHandler(TRACE_LOG_FILE, maxBytes=TRACE_LOG_MAX_BYTES,
+                                          backupCount=TRACE_LOG_BACKUPS, encoding="utf-8", delay=True)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+        _trace_logger = logger
+    return _trace_logger
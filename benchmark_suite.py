@@ -0,0 +1,293 @@
+"""
+⏱️ Benchmark Suite - 可重現的效能基準測試
+涵蓋快取、RCA、繪圖與 API 端點 (使用離線 fake provider，不呼叫任何網路 API)
+
+Usage:
+    python benchmark_suite.py                      # 全部基準，結果寫入 bench_results/
+    python benchmark_suite.py --quick              # 較小的資料量 (開發時快速檢查)
+    python benchmark_suite.py --filter cache       # 只跑名稱包含 'cache' 的項目
+    python benchmark_suite.py --compare bench_results/<baseline>.json --threshold 0.2
+
+結果 JSON 包含 git commit、環境資訊與每個項目的 min/median/mean/p95 (秒)，
+--compare 會列出 median 變慢超過 threshold 的項目並以 exit code 1 結束。
+"""
+
+import os
+import sys
+import io
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import platform
+import warnings
+import tempfile
+import subprocess
+import contextlib
+
+import numpy as np
+import pandas as pd
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT_DIR)
+
+RESULTS_DIR = os.path.join(ROOT_DIR, "bench_results")
+
+# CJK glyph warnings from matplotlib would flood the output of the plot benchmark
+warnings.filterwarnings('ignore', message='Glyph .* missing from font')
+
+SAMPLE_ESSAY = """
+The diagram illustrates the process of manufacturing chocolate.
+
+Overall, the process consists of several key stages, beginning with harvesting cacao pods and ending with the production of liquid chocolate.
+
+First, ripe cacao pods are harvested from cacao trees. These pods are then opened to extract the white cocoa beans inside. Following this, the beans undergo fermentation, which is a crucial step for developing flavor.
+
+Once fermentation is complete, the beans are spread out to dry under the sun. After drying, they are placed in large sacks and transported to the factory. At the factory, the beans are roasted at approximately 350 degrees Celsius. Subsequently, the roasted beans are crushed to remove their outer shells, leaving only the inner part.
+
+Finally, this inner part is pressed to produce liquid chocolate, which can then be used for various chocolate products.
+"""
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 🔧 HELPERS
+# ═══════════════════════════════════════════════════════════════════════════
+
+def _quiet():
+    """Silence analyzer/API progress output while timing."""
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def measure(fn, repeat=5, warmup=1, setup=None):
+    """Run `fn` repeat times (after warmup) and return timing statistics in seconds."""
+    for _ in range(warmup):
+        if setup:
+            setup()
+        with _quiet():
+            fn()
+    samples = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        with _quiet():
+            start = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - start)
+    samples = np.array(samples)
+    return {
+        "repeat": int(repeat),
+        "min": float(samples.min()),
+        "median": float(np.median(samples)),
+        "mean": float(samples.mean()),
+        "p95": float(np.percentile(samples, 95)),
+    }
+
+
+def synthetic_scores(rng, metrics):
+    ability = rng.uniform(0.5, 0.9)
+    scores = {m: round(float(np.clip(ability + rng.normal(0, 0.08), 0, 1)), 2) for m in metrics}
+    scores['overall_band'] = round((4.0 + 5.0 * ability) * 2) / 2
+    return scores
+
+
+def synthetic_history(analyzer, n, seed=42):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for i in range(n):
+        row = synthetic_scores(rng, analyzer.TASK1_METRICS.keys())
+        row['file_name'] = f"essay_{i:05d}.txt"
+        rows.append(row)
+    return rows
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return "unknown"
+
+
+def use_stub_llm(analyzer):
+    """Route every LLM call to the deterministic fake provider with no latency."""
+    analyzer.CURRENT_PROVIDER = 'fake'
+    analyzer.FAKE_LLM_LATENCY = 'none'
+    analyzer.FAKE_LLM_CHUNK_DELAY = 0.0
+    analyzer.FAKE_LLM_FAILURE_RATE = 0.0
+    analyzer.FAKE_LLM_BAD_JSON_RATE = 0.0
+    analyzer.rate_limit_pause = lambda seconds, cancel_event=None: False  # skip pauses between calls
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 📊 BENCHMARKS
+# ═══════════════════════════════════════════════════════════════════════════
+
+def bench_hash(analyzer, api, results, quick):
+    iterations = 1000
+    results['hash/get_essay_hash_x1000'] = measure(
+        lambda: [api.get_essay_hash(SAMPLE_ESSAY) for _ in range(iterations)], repeat=7)
+
+
+def bench_cache(analyzer, api, results, quick, workdir):
+    from score_cache import ScoreCache
+
+    sizes = [1000, 10000] if quick else [1000, 10000, 100000]
+    rng = np.random.default_rng(0)
+    metrics = list(analyzer.TASK1_METRICS.keys())
+
+    for n in sizes:
+        path = os.path.join(workdir, f"cache_{n}.json")
+        for suffix in ('', '.journal', '.lock'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        cache = ScoreCache(path)
+        for i in range(n):
+            key = hashlib.md5(str(i).encode()).hexdigest()
+            cache.scores[key] = synthetic_scores(rng, metrics)
+            cache.aliases[f"essay_{i}.txt"] = key
+        cache.snapshot()
+
+        analyzer.CACHE_FILE = path
+        repeat = 3 if n >= 100000 else 5
+        results[f'cache/load_cache_{n}'] = measure(analyzer.load_cache, repeat=repeat)
+
+        loaded = analyzer.load_cache()
+        results[f'cache/save_cache_snapshot_{n}'] = measure(loaded.snapshot, repeat=repeat)
+
+        counter = iter(range(10 ** 9))
+        def put_one():
+            i = next(counter)
+            loaded.put(f"{i:032x}", synthetic_scores(rng, metrics), file_name=f"new_{i}.txt")
+            analyzer.save_cache(loaded)
+        loaded.checkpoint_every = 10 ** 9  # isolate the journal append path
+        results[f'cache/save_cache_one_entry_{n}'] = measure(put_one, repeat=20)
+
+
+def bench_rca(analyzer, api, results, quick):
+    sizes = [5, 50] if quick else [5, 50, 500]
+    for n in sizes:
+        df = pd.DataFrame(synthetic_history(analyzer, n))
+        results[f'rca/perform_ml_analysis_{n}'] = measure(lambda: analyzer.perform_ml_analysis(df), repeat=5)
+
+
+def bench_plot(analyzer, api, results, quick):
+    df = pd.DataFrame(synthetic_history(analyzer, 20))
+    rca = analyzer.perform_ml_analysis(df)
+    rca_prev = analyzer.perform_ml_analysis(df.iloc[:-1])
+    text = "【診斷摘要】\n" + "Practise sequencing markers and passive voice. " * 20
+    results['plot/plot_results_20'] = measure(lambda: analyzer.plot_results(rca, df, text, rca_prev), repeat=3)
+
+
+def bench_endpoints(analyzer, api, results, quick):
+    use_stub_llm(analyzer)
+    client = api.app.test_client()
+    history = [{"id": i, "scores": s} for i, s in enumerate(synthetic_history(analyzer, 10))]
+
+    # Cache hit: the same essay every time
+    client.post('/api/analyze', json={"essay": SAMPLE_ESSAY, "provider": "fake"})
+    results['api/analyze_cache_hit'] = measure(
+        lambda: client.post('/api/analyze', json={"essay": SAMPLE_ESSAY, "provider": "fake"}), repeat=20)
+
+    # Cache miss: a new essay every time (stub LLM scoring + journal write)
+    counter = iter(range(10 ** 9))
+    results['api/analyze_new_essay'] = measure(
+        lambda: client.post('/api/analyze', json={"essay": f"{SAMPLE_ESSAY}\nVariant {next(counter)}.", "provider": "fake"}),
+        repeat=10)
+
+    results['api/full_rca_history_10'] = measure(
+        lambda: client.post('/api/full-rca', json={"essays": history, "new_essay": SAMPLE_ESSAY, "provider": "fake"}),
+        repeat=3)
+
+
+BENCHMARKS = [
+    ('hash', bench_hash),
+    ('cache', bench_cache),
+    ('rca', bench_rca),
+    ('plot', bench_plot),
+    ('api', bench_endpoints),
+]
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 🏁 RUNNER
+# ═══════════════════════════════════════════════════════════════════════════
+
+def run_suite(quick=False, name_filter=None):
+    workdir = tempfile.mkdtemp(prefix="ielts_bench_")
+    original_cwd = os.getcwd()
+    os.chdir(workdir)  # analyzer/API write reports, essays and caches relative to cwd
+    try:
+        with _quiet():
+            import ielts_rca_analyzer as analyzer
+            import arena_api as api
+
+        results = {}
+        for group, bench in BENCHMARKS:
+            if name_filter and name_filter not in group:
+                continue
+            print(f"[Bench] ▶ {group} ...", flush=True)
+            group_results = {}
+            if group == 'cache':
+                bench(analyzer, api, group_results, quick, workdir)
+            else:
+                bench(analyzer, api, group_results, quick)
+            for name, stats in group_results.items():
+                print(f"  {name:<40} median {stats['median'] * 1000:10.2f} ms   p95 {stats['p95'] * 1000:10.2f} ms")
+            results.update(group_results)
+    finally:
+        os.chdir(original_cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "meta": {
+            "git_commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "quick": quick,
+        },
+        "results": results,
+    }
+
+
+def compare(current, baseline, threshold):
+    """Print median ratios against a baseline run; return the names that regressed."""
+    regressions = []
+    print(f"\n[Bench] 與基準比較 ({baseline['meta'].get('git_commit')}, threshold {threshold:.0%})")
+    for name, stats in current['results'].items():
+        base = baseline['results'].get(name)
+        if not base:
+            continue
+        ratio = stats['median'] / base['median'] if base['median'] > 0 else 1.0
+        flag = "⚠️ REGRESSION" if ratio > 1 + threshold else ("✅ faster" if ratio < 1 - threshold else "")
+        print(f"  {name:<40} {base['median'] * 1000:10.2f} → {stats['median'] * 1000:10.2f} ms  x{ratio:5.2f} {flag}")
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="IELTS RCA benchmark suite")
+    parser.add_argument('--quick', action='store_true', help='Smaller sizes (skip 100k cache / 500-essay RCA)')
+    parser.add_argument('--filter', type=str, help='Only run benchmark groups containing this string')
+    parser.add_argument('--output', type=str, help='Result JSON path (default: bench_results/<time>_<commit>.json)')
+    parser.add_argument('--compare', type=str, help='Baseline result JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Allowed median slowdown before flagging (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    report = run_suite(quick=args.quick, name_filter=args.filter)
+
+    output = args.output
+    if not output:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d_%H%M%S')}_{report['meta']['git_commit']}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"\n[Bench] 結果已儲存: {output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        if compare(report, baseline, args.threshold):
+            sys.exit(1)
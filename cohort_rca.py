@@ -0,0 +1,197 @@
+"""
+🏫 Cohort RCA - 全班 / 多位學生的 RCA，一次完成
+- build_matrix()  : 所有學生的評分歷史合併成一個欄式矩陣 (學生索引、指標矩陣 X、overall_band y、
+                    集成評分變異數 V)，每位學生只保留最近 COHORT_WINDOW_ESSAYS 篇
+- 班級重要度      : 一次隨機森林擬合，使用「學生內」去平均的資料 (每位學生減去自己的平均)，
+                    反映讓同一位學生分數變動的因素，而不是學生之間的程度差異
+- 學生重要度      : 每位學生的指標與 band 的學生內相關 (r²，正規化後加總為 1)，以分組加總一次
+                    算出所有學生；依篇數向班級重要度收縮 (篇數少時幾乎等於班級值)
+- 學生瓶頸        : Bottleneck_Index = 重要度 × (1 - 學生平均分) × Reliability，(學生 × 指標) 矩陣一次算完
+- 離群            : 以中位數 / MAD 的 robust z 分數找出整體或單一指標明顯落後 (或領先) 的學生
+
+整個分析只有一次模型擬合；200 位學生不需要 200 次個別 RCA。
+輸入是 {student_id: [score row, ...]} (時間順序)；此模組不依賴 ielts_rca_analyzer，
+指標清單與名稱由呼叫端提供。
+"""
+
+import os
+import time
+
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor
+
+COHORT_WINDOW_ESSAYS = int(os.environ.get("COHORT_WINDOW_ESSAYS", "50"))  # 每位學生最近 N 篇 (0 = 全部)
+COHORT_MIN_ESSAYS = 2                                                     # 少於此篇數的學生不納入
+COHORT_OWN_MIN = int(os.environ.get("COHORT_OWN_MIN", "5"))               # 個人重要度所需篇數 (0 = 全部使用班級重要度)
+COHORT_SHRINKAGE = 10.0            # 班級重要度的先驗權重 (相當於幾篇作文)
+COHORT_OUTLIER_Z = 2.5
+COHORT_MIN_SPREAD = {'metric': 0.03, 'band': 0.25}  # robust z 的最小標準差 (小班 MAD 接近 0 時避免 z 值爆炸)
+COHORT_MAX_OUTLIERS = 50
+VARIANCE_PREFIX = 'var_'
+
+
+def build_matrix(histories, metrics, window=None):
+    """
+    {student: [rows]} -> columnar dict: 'students' (S ids), 'student_index' (N,), 'X' (N, p),
+    'y' (N,), 'V' (N, p; NaN where no ensemble variance). Rows without overall_band are
+    skipped; students with fewer than COHORT_MIN_ESSAYS rows are left out.
+    A non-numeric score raises ValueError naming the student and field.
+    """
+    window = COHORT_WINDOW_ESSAYS if window is None else window
+    p = len(metrics)
+    variance_fields = [f"{VARIANCE_PREFIX}{m}" for m in metrics]
+    students, index, X, y, V = [], [], [np.empty((0, p))], [np.empty(0)], [np.empty((0, p))]
+    for student, rows in histories.items():
+        rows = [r for r in rows if r.get('overall_band') is not None]
+        if window:
+            rows = rows[-window:]
+        if len(rows) < COHORT_MIN_ESSAYS:
+            continue
+        index.append(np.full(len(rows), len(students), dtype=np.int64))
+        X.append(_numeric(rows, metrics, student))
+        y.append(_numeric(rows, ['overall_band'], student)[:, 0])
+        V.append(_numeric(rows, variance_fields, student))
+        students.append(str(student))
+    return {
+        'students': students,
+        'metrics': list(metrics),
+        'student_index': np.concatenate(index) if index else np.empty(0, dtype=np.int64),
+        'X': np.concatenate(X),
+        'y': np.concatenate(y),
+        'V': np.concatenate(V),
+    }
+
+
+def _numeric(rows, fields, student):
+    """(len(rows), len(fields)) float64 array of the fields (missing / None -> NaN)."""
+    values = [[row.get(f) for f in fields] for row in rows]
+    try:
+        return np.asarray(values, dtype=np.float64).reshape(len(rows), len(fields))
+    except (TypeError, ValueError):
+        for row_values in values:
+            for field, value in zip(fields, row_values):
+                try:
+                    float(np.nan if value is None else value)
+                except (TypeError, ValueError):
+                    raise ValueError(f"student {student}: '{field}' is not a number ({value!r})") from None
+        raise
+
+
+def _group_mean(values, index, n_groups):
+    """Per-group nan-mean of a (N,) or (N, p) array (NaN where a group has no values)."""
+    values = values.reshape(len(index), -1)
+    present = ~np.isnan(values)
+    sums = np.zeros((n_groups, values.shape[1]))
+    counts = np.zeros((n_groups, values.shape[1]))
+    np.add.at(sums, index, np.where(present, values, 0.0))
+    np.add.at(counts, index, present)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+def _robust_z(values, min_spread):
+    """Column-wise (x - median) / max(1.4826 * MAD, min_spread)."""
+    median = np.nanmedian(values, axis=0)
+    mad = 1.4826 * np.nanmedian(np.abs(values - median), axis=0)
+    return (values - median) / np.maximum(mad, min_spread)
+
+
+def _own_importances(X_within, y_within, index, n_groups):
+    """
+    Per-student importance (S, p): squared within-student correlation of each metric with
+    the band, normalised to sum 1. Rows of students without any band movement are NaN.
+    """
+    sxy = _group_mean(X_within * y_within[:, None], index, n_groups)
+    sxx = _group_mean(X_within ** 2, index, n_groups)
+    syy = _group_mean(y_within ** 2, index, n_groups)[:, 0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r2 = sxy ** 2 / (sxx * syy[:, None])
+        r2 = np.nan_to_num(r2, nan=0.0)
+        return r2 / r2.sum(axis=1, keepdims=True)
+
+
+def analyze(matrix, metric_names=None, variance_ref=0.01, top=3, own_min=None):
+    """
+    Cohort RCA on a build_matrix() result. Returns a JSON-ready dict with the class
+    ranking, per-student top bottlenecks, outliers and timing.
+    """
+    start = time.perf_counter()
+    own_min = COHORT_OWN_MIN if own_min is None else own_min
+    metrics, students = matrix['metrics'], matrix['students']
+    metric_names = metric_names or {}
+    index, X, y, V = matrix['student_index'], matrix['X'], matrix['y'], matrix['V']
+    S, p = len(students), len(metrics)
+    if S == 0:
+        return {'students': [], 'class_ranking': [], 'outliers': [], 'total_students': 0, 'total_essays': 0}
+
+    # 缺值: 先用學生平均，再用全班平均補
+    student_mean = _group_mean(X, index, S)
+    X = np.where(np.isnan(X), student_mean[index], X)
+    X = np.where(np.isnan(X), np.nanmean(X, axis=0), X)
+    student_mean = _group_mean(X, index, S)
+    student_band = _group_mean(y, index, S)[:, 0]
+    counts = np.bincount(index, minlength=S)
+
+    # 班級重要度: 學生內去平均後一次擬合
+    X_within = X - student_mean[index]
+    y_within = y - student_band[index]
+    # 合併後資料量大且雜訊多: 葉節點至少 5 篇，重要度較穩定，擬合也較快
+    class_model = RandomForestRegressor(n_estimators=100, min_samples_leaf=5, random_state=42)
+    class_model.fit(X_within, y_within)
+    class_importance = class_model.feature_importances_
+    if not class_importance.any():
+        class_importance = np.full(p, 1.0 / p)  # 沒有學生內變化 (每人分數都不變) 時平均分配
+
+    # 學生重要度: 依篇數向班級值收縮；篇數不足或 band 沒有變化的學生直接用班級值
+    own = _own_importances(X_within, y_within, index, S)
+    has_own = (counts >= own_min) & np.isfinite(own).all(axis=1) if own_min else np.zeros(S, dtype=bool)
+    weight = np.where(has_own, counts / (counts + COHORT_SHRINKAGE), 0.0)[:, None]
+    importance = weight * np.nan_to_num(own) + (1 - weight) * class_importance
+
+    variance = np.nan_to_num(_group_mean(V, index, S), nan=0.0)
+    reliability = 1.0 / (1.0 + variance / variance_ref)
+    bottleneck = importance * (1.0 - student_mean) * reliability     # (S, p)
+
+    top1 = np.bincount(bottleneck.argmax(axis=1), minlength=p) / S
+    order = np.argsort(-bottleneck.mean(axis=0))
+    class_ranking = [{
+        'Metric': metrics[j],
+        'Metric_Name': metric_names.get(metrics[j], metrics[j]),
+        'Class_Importance': round(float(class_importance[j]), 4),
+        'Avg_Score': round(float(student_mean[:, j].mean()), 4),
+        'Mean_Bottleneck_Index': round(float(bottleneck[:, j].mean()), 4),
+        'Top1_Share': round(float(top1[j]), 3),
+    } for j in order]
+
+    ranked = np.argsort(-bottleneck, axis=1)[:, :top]
+    student_rows = [{
+        'student_id': students[s],
+        'essays': int(counts[s]),
+        'avg_band': round(float(student_band[s]), 2),
+        'own_importance': bool(has_own[s]),
+        'top_bottlenecks': [{'Metric': metrics[j], 'Metric_Name': metric_names.get(metrics[j], metrics[j]),
+                             'Bottleneck_Index': round(float(bottleneck[s, j]), 4),
+                             'Avg_Score': round(float(student_mean[s, j]), 3)} for j in ranked[s]],
+    } for s in range(S)]
+
+    # 離群: overall band 與各指標平均分的 robust z
+    z_band = _robust_z(student_band[:, None], COHORT_MIN_SPREAD['band'])[:, 0]
+    z_metric = _robust_z(student_mean, COHORT_MIN_SPREAD['metric'])
+    outliers = []
+    for s in np.flatnonzero(np.abs(z_band) >= COHORT_OUTLIER_Z):
+        outliers.append({'student_id': students[s], 'metric': 'overall_band', 'value': round(float(student_band[s]), 2),
+                         'z': round(float(z_band[s]), 2), 'direction': 'low' if z_band[s] < 0 else 'high'})
+    for s, j in zip(*np.nonzero(np.abs(z_metric) >= COHORT_OUTLIER_Z)):
+        outliers.append({'student_id': students[s], 'metric': metrics[j], 'value': round(float(student_mean[s, j]), 3),
+                         'z': round(float(z_metric[s, j]), 2), 'direction': 'low' if z_metric[s, j] < 0 else 'high'})
+    outliers.sort(key=lambda o: o['z'])  # 落後最多的排最前面
+
+    return {
+        'total_students': S,
+        'total_essays': int(len(y)),
+        'class_ranking': class_ranking,
+        'students': student_rows,
+        'outliers': outliers[:COHORT_MAX_OUTLIERS],
+        'own_importance_students': int(has_own.sum()),
+        'seconds': round(time.perf_counter() - start, 2),
+    }
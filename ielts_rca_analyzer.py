@@ -11,14 +11,36 @@ import requests
 import os
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.preprocessing import RobustScaler
-import io
+from scipy import stats
 import sys
 import re
 import argparse
+import hashlib
+import inspect
+import pickle
+import random
+import datetime
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from concurrent.futures import TimeoutError as FuturesTimeout
+from collections import deque
+from score_cache import ScoreCache
+import arena_metrics
+import arena_tracing as tracing
+import token_ledger
+import llm_router
+from llm_stream import StreamCollector
+import prompt_cache
+import local_scorer
+import linguistic_features
+import trend_engine
+import cohort_rca
+from token_ledger import BudgetExceeded
 
 # 設定編碼以支援中文顯示
 try:
-    sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+    sys.stdout.reconfigure(encoding='utf-8')  # 不另包一層 wrapper (舊 wrapper 被回收時會關閉底層的 buffer)
 except Exception:
     pass
 
@@ -38,6 +60,7 @@ KIMI_MODEL_NAME = "moonshotai/Kimi-K2-Instruct-0905"
 # GEMINI CONFIG
 gemini_api_key = os.environ.get("GEMINI_API_KEY") 
 GEMINI_MODEL_NAME ="gemini-3-flash-preview" # "gemini-3-flash-preview"
+GEMINI_CACHE_RESEND_MIN_SECONDS = 5.0  # 快取失效後，剩餘期限至少這麼多秒才以完整 prompt 重送
 
 # Try to import google.generativeai, handle if missing
 try:
@@ -46,11 +69,54 @@ try:
 except ImportError:
     HAS_GEMINI_LIB = False
 
+# FAKE PROVIDER CONFIG (離線壓測用的本地替身，不呼叫任何網路 API)
+FAKE_LLM_LATENCY = os.environ.get("FAKE_LLM_LATENCY", "lognormal:0.8,0.4")  # 'none' | 'fixed:S' | 'uniform:A,B' | 'lognormal:MEDIAN,SIGMA'
+FAKE_LLM_CHUNK_SIZE = int(os.environ.get("FAKE_LLM_CHUNK_SIZE", "16"))       # characters per streamed chunk
+FAKE_LLM_CHUNK_DELAY = float(os.environ.get("FAKE_LLM_CHUNK_DELAY", "0.01")) # seconds between chunks
+FAKE_LLM_FAILURE_RATE = float(os.environ.get("FAKE_LLM_FAILURE_RATE", "0"))   # probability a call returns None
+FAKE_LLM_BAD_JSON_RATE = float(os.environ.get("FAKE_LLM_BAD_JSON_RATE", "0")) # probability of truncated score JSON
+FAKE_LLM_SEED = os.environ.get("FAKE_LLM_SEED")
+FAKE_LLM_THINK_CHARS = int(os.environ.get("FAKE_LLM_THINK_CHARS", "0"))    # length of a fake <think> preface (0 = none)
+FAKE_LLM_SCORE_NOISE = float(os.environ.get("FAKE_LLM_SCORE_NOISE", "0"))  # per-call score jitter (std), simulates examiner noise
+_fake_rng = random.Random(FAKE_LLM_SEED)
+
 # DEFAULT PROVIDER
-DEFAULT_PROVIDER = 'kimi' # 'kimi' or 'gemini'
+DEFAULT_PROVIDER = 'kimi' # 'kimi', 'gemini', 'fake', 'local' or 'hybrid'
 CURRENT_PROVIDER = DEFAULT_PROVIDER  # 全局變數，可被外部模組修改
+# 'local': 只用本地評分模型 (local_scorer.py)；'hybrid': 本地模型不確定時升級給 LLM
+LOCAL_PROVIDERS = ('local', 'hybrid')
+LOCAL_ESCALATION_PROVIDER = os.environ.get("LOCAL_ESCALATION_PROVIDER", "kimi")  # hybrid 模式實際呼叫的 LLM
+# 機械性指標 (linguistic_features.MECHANICAL_METRICS) 的處理方式:
+# 'off' 不使用；'hint' 把量測到的特徵附在評分請求中作為參考；'prefill' 直接以本地分數填入，LLM 只評其餘指標
+LINGUISTIC_PREFILL = os.environ.get("LINGUISTIC_PREFILL", "hint")
+# 集成評分: 同一篇作文由多個供應商/樣本並行評分後彙整，例如 'kimi,gemini,kimi' (空字串 = 單次呼叫)
+SCORING_ENSEMBLE = [p.strip() for p in os.environ.get("SCORING_ENSEMBLE", "").split(',') if p.strip()]
+SCORING_ENSEMBLE_AGG = os.environ.get("SCORING_ENSEMBLE_AGG", "median")            # 'median' | 'trimmed'
+SCORING_ENSEMBLE_TRIM = float(os.environ.get("SCORING_ENSEMBLE_TRIM", "0.2"))      # trimmed mean 兩端各去除的比例
+SCORING_ENSEMBLE_GRACE = float(os.environ.get("SCORING_ENSEMBLE_GRACE", "5"))     # 過半成員完成後，最多再等待的秒數
+SCORE_VARIANCE_REF = float(os.environ.get("SCORE_VARIANCE_REF", "0.01"))           # RCA: 平均變異數達此值 (std 0.1) 時權重減半
+VARIANCE_PREFIX = 'var_'  # DataFrame 中各指標評分變異數的欄位前綴
+# RCA bootstrap: 以重抽樣重新擬合隨機森林，得到 Bottleneck_Index 的信賴區間與排名穩定度
+RCA_BOOTSTRAP = int(os.environ.get("RCA_BOOTSTRAP", "0"))                    # 重抽樣次數 B (0 = 不計算)
+RCA_BOOTSTRAP_MAX = 1000                                                      # API 請求可要求的上限
+RCA_BOOTSTRAP_BUDGET = float(os.environ.get("RCA_BOOTSTRAP_BUDGET", "3"))     # 秒；到期時以已完成的重抽樣計算
+RCA_BOOTSTRAP_TREES = int(os.environ.get("RCA_BOOTSTRAP_TREES", "50"))        # 每次重抽樣的樹數 (少於主模型以控制成本)
+RCA_BOOTSTRAP_MIN = 20     # 完成的重抽樣少於此數時不報告區間
+RCA_BOOTSTRAP_CI = 0.9     # 信賴水準
+# RCA 視窗: 只用最近的文章擬合 (擬合成本有上限，診斷反映目前程度)；兩個條件同時生效
+RCA_WINDOW_ESSAYS = int(os.environ.get("RCA_WINDOW_ESSAYS", "200"))   # 最近 N 篇 (0 = 不限)
+RCA_WINDOW_DAYS = float(os.environ.get("RCA_WINDOW_DAYS", "0"))       # 最近 D 天，相對於最新一篇 (0 = 不限)
+RCA_HALF_LIFE = float(os.environ.get("RCA_HALF_LIFE", "0"))           # 近期加權半衰期 (篇數)，作為 sample_weight (0 = 等權)
+RCA_WINDOW_MIN_ESSAYS = 5  # 天數條件不會讓視窗少於此篇數 (久未練習時仍可分析)
+ESSAY_TIME_COLUMN = 'essay_time'  # 作文時間 (epoch 秒)，視窗的天數條件使用
 ESSAY_FOLDER = "essays_to_analyze" # 使用者存放文章的資料夾
 CACHE_FILE = "ai_scores_cache.json"
+PIPELINE_CACHE_DIR = ".rca_pipeline_cache" # 各階段的記憶化輸出 (memoised stage outputs)
+REPORT_IMAGE_FILE = "ielts_task1_report.png"
+REPORT_TEXT_FILE = "ielts_task1_report.txt"
+COHORT_FOLDER = os.environ.get("COHORT_FOLDER", "cohort_essays")  # 每位學生一個子資料夾 (資料夾名稱 = 學生 id)
+COHORT_REPORT_FILE = "cohort_rca_report.json"
+DETAILED_REPORT_FILE = "ielts_detailed_rca_report.md"
 
 # --- IELTS Writing Task 1 Evaluation Metrics ---
 # --- IELTS Writing Task 1 Process Evaluation Metrics ---
@@ -77,10 +143,35 @@ TASK1_METRICS = {
     'gra_error_free_density': 'GRA: Error-Free Sentences', # Proportion of perfectly correct sentences
 }
 
-def _query_gemini_api(messages):
+# 各呼叫類型的生成參數。評分只需要約 300 tokens 的 JSON，不需要長推理；
+# deadline 是上限，實際期限依觀察到的 p99 延遲自動收斂 (見 generation_profile)
+GENERATION_PROFILES = {
+    'scoring':         {'max_tokens': 1024, 'thinking_budget': 2048,  'temperature': 0.2, 'top_p': 0.9,  'min_deadline': 15, 'deadline': 60},
+    'partial_scoring': {'max_tokens': 512,  'thinking_budget': 1024,  'temperature': 0.2, 'top_p': 0.9,  'min_deadline': 10, 'deadline': 45},
+    'recommendations': {'max_tokens': 2048, 'thinking_budget': 8192,  'temperature': 0.6, 'top_p': 0.95, 'min_deadline': 30, 'deadline': 120},
+    'deep_dive':       {'max_tokens': 3072, 'thinking_budget': 16384, 'temperature': 0.6, 'top_p': 0.95, 'min_deadline': 30, 'deadline': 150},
+    'default':         {'max_tokens': 4096, 'thinking_budget': 32768, 'temperature': 0.6, 'top_p': 0.95, 'min_deadline': 30, 'deadline': 120},
+}
+
+def generation_profile(provider, task):
+    """Profile for this call type with 'deadline' adapted from recent latency percentiles."""
+    profile = dict(GENERATION_PROFILES.get(task) or GENERATION_PROFILES['default'])
+    profile['deadline'] = LLM_ROUTER.deadline(provider, task or 'other', profile['min_deadline'], profile['deadline'])
+    return profile
+
+def _query_gemini_api(messages, usage=None, cancel_event=None, on_chunk=None, profile=None, stop_at_json=False):
     """
-    Helper to query Google Gemini API
+    Helper to query Google Gemini API with streaming support (same interface as _query_kimi_api)
+    usage: optional dict filled with prompt_tokens / completion_tokens / cached_tokens from usage_metadata
+    cancel_event: stop reading the stream once set
+    on_chunk: callback for each streamed text chunk (default: print it)
+    profile: generation profile (token limit, temperature, deadline)
+    stop_at_json: stop reading as soon as a complete JSON object has arrived (scoring)
+    A long, fixed system prompt is served from a CachedContent handle (see prompt_cache).
     """
+    on_chunk = on_chunk or _echo_chunk
+    profile = profile or GENERATION_PROFILES['default']
+    deadline_at = time.monotonic() + profile['deadline']
     if not HAS_GEMINI_LIB:
         print("[Error] google-generativeai library not installed. Pip install google-generativeai")
         return None
@@ -106,40 +197,124 @@ def _query_gemini_api(messages):
         # Simple concat for single-turn logic used here
         full_prompt = "\n\n".join(prompt_parts)
         
-        model = genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=system_instruction)
-        
-        response = model.generate_content(full_prompt)
-        return response.text
+        def stream_from(model, stream):
+            """Read one streamed response into `stream`; returns usage_metadata or None on deadline."""
+            remaining = deadline_at - time.monotonic()
+            # google-generativeai 的 GenerationConfig 沒有 thinking budget 參數，僅套用其餘設定
+            response = model.generate_content(
+                full_prompt,
+                generation_config={
+                    "max_output_tokens": profile['max_tokens'],
+                    "temperature": profile['temperature'],
+                    "top_p": profile['top_p'],
+                },
+                request_options={"timeout": remaining},  # 重送時只用剩餘的期限
+                stream=True,
+            )
+            meta = None
+            for chunk in response:
+                if cancel_event is not None and cancel_event.is_set():
+                    print("  [Router] Gemini 串流已取消")
+                    break
+                if time.monotonic() > deadline_at:
+                    print(f"\n  [Error] Gemini 超過期限 ({profile['deadline']:.0f}s)，中止串流")
+                    return None
+                meta = getattr(chunk, 'usage_metadata', None) or meta  # 最後一個 chunk 帶完整用量
+                try:
+                    text = chunk.text
+                except ValueError:
+                    continue  # 沒有文字的 chunk (例如只有 finish_reason)
+                if text and stream.feed(text):
+                    break  # 評分 JSON 已完整
+            return meta or {}
+
+        stream = StreamCollector(on_chunk, stop_at_json=stop_at_json)
+        meta = None
+        cached = prompt_cache.gemini_cache.get(GEMINI_MODEL_NAME, system_instruction)
+        if cached is not None:
+            try:
+                meta = stream_from(genai.GenerativeModel.from_cached_content(cached_content=cached), stream)
+            except Exception as e:
+                # 只有快取被服務端移除 / 無權限時才以完整 prompt 重送 (逾時等錯誤交給路由器備援)，
+                # 且已輸出部分內容或剩餘期限不足時不重送
+                if stream.text or not prompt_cache.is_stale_handle_error(e):
+                    raise
+                prompt_cache.gemini_cache.invalidate(GEMINI_MODEL_NAME, system_instruction)
+                if deadline_at - time.monotonic() < GEMINI_CACHE_RESEND_MIN_SECONDS:
+                    print(f"  [Cache] Gemini 快取已失效，剩餘期限不足，不重送: {e}")
+                    return None
+                print(f"  [Cache] Gemini 快取已失效，改送完整 prompt: {e}")
+                cached = None
+        if cached is None:
+            meta = stream_from(genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=system_instruction), stream)
+        if meta is None:
+            return None
+
+        if usage is not None and meta:
+            usage['prompt_tokens'] = getattr(meta, 'prompt_token_count', 0) or 0
+            usage['completion_tokens'] = getattr(meta, 'candidates_token_count', 0) or 0
+            usage['cached_tokens'] = getattr(meta, 'cached_content_token_count', 0) or 0
+        full_content = stream.finish()
+        if _echoes(on_chunk):
+            print()
+        return full_content
         
     except Exception as e:
         print(f"  [Error] Gemini API Request Failed: {str(e)}")
         return None
 
-def _query_kimi_api(messages):
+def _echo_chunk(chunk):
+    print(chunk, end="", flush=True)
+
+def _echoes(on_chunk):
+    """True when streamed text goes to stdout (a trailing newline is printed after the call)."""
+    return on_chunk is _echo_chunk or getattr(on_chunk, 'echo', False)
+
+def _query_kimi_api(messages, usage=None, cancel_event=None, on_chunk=None, profile=None, stop_at_json=False):
     """
     Internal helper to query Kimi API with streaming support
+    usage: optional dict filled with prompt_tokens / completion_tokens from the final stream chunk
+    cancel_event: stop reading the stream (and close the connection) once set
+    on_chunk: callback for each streamed text chunk (default: print it)
+    profile: generation profile; its deadline bounds the whole call, not just each socket read
+    stop_at_json: close the stream as soon as a complete JSON object has arrived (scoring)
+    <think> blocks are dropped while streaming and never reach on_chunk or the result.
+    Messages are sent with a stable system prefix so the endpoint's automatic prefix cache applies.
     """
+    on_chunk = on_chunk or _echo_chunk
+    profile = profile or GENERATION_PROFILES['default']
+    deadline_at = time.monotonic() + profile['deadline']
     headers = {
         "Authorization": f"Bearer {KIMI_API_KEY}",
         "Content-Type": "application/json"
     }
     payload = {
         "model": KIMI_MODEL_NAME,
-        "messages": messages,
+        "messages": prompt_cache.stable_prefix(messages),
         "stream": True,
-        "max_tokens": 4096,
-        "temperature": 0.6,
-        "top_p": 0.95,
+        "max_tokens": profile['max_tokens'],
+        "temperature": profile['temperature'],
+        "top_p": profile['top_p'],
         "top_k": 50,
         "frequency_penalty": 0,
-        "thinking_budget": 32768
+        "thinking_budget": profile['thinking_budget'],
+        "stream_options": {"include_usage": True}  # 最後一個 chunk 附帶 token 用量
     }
     
     try:
-        response = requests.post(KIMI_API_URL, headers=headers, json=payload, stream=True, timeout=120)
-        full_content = ""
+        response = requests.post(KIMI_API_URL, headers=headers, json=payload, stream=True,
+                                 timeout=(10, profile['deadline']))
+        stream = StreamCollector(on_chunk, stop_at_json=stop_at_json)
         
         for line in response.iter_lines():
+            if cancel_event is not None and cancel_event.is_set():
+                response.close()
+                print("  [Router] Kimi 串流已取消")
+                break
+            if time.monotonic() > deadline_at:
+                response.close()
+                print(f"\n  [Error] Kimi 超過期限 ({profile['deadline']:.0f}s)，中止串流")
+                return None
             if not line.startswith(b"data:"):
                 continue
             if line.strip() == b"data:[DONE]":
@@ -150,94 +325,703 @@ def _query_kimi_api(messages):
                     continue
                 
                 chunk = json.loads(decoded_line)
+                if usage is not None and chunk.get("usage"):
+                    usage['prompt_tokens'] = chunk["usage"].get("prompt_tokens", 0)
+                    usage['completion_tokens'] = chunk["usage"].get("completion_tokens", 0)
+                    usage['cached_tokens'] = prompt_cache.cached_prompt_tokens(chunk["usage"])
                 if "choices" in chunk and len(chunk["choices"]) > 0:
                     delta = chunk["choices"][0].get("delta", {})
                     content = delta.get("content", "")
-                    if content:
-                        print(content, end="", flush=True)
-                        full_content += content
+                    if content and stream.feed(content):
+                        # 評分 JSON 已完整：不再等待後續的推理或閒聊 tokens
+                        response.close()
+                        break
             except json.JSONDecodeError:
                 continue
                 
-        print()
+        full_content = stream.finish()
+        if _echoes(on_chunk):
+            print()
         return full_content
     except Exception as e:
         print(f"  [Error] API Request Failed: {str(e)}")
         return None
 
-def _query_llm(messages, provider='kimi'):
+def _sample_fake_latency(rng):
+    """Parse FAKE_LLM_LATENCY ('none' | 'fixed:S' | 'uniform:A,B' | 'lognormal:MEDIAN,SIGMA')."""
+    kind, _, params = FAKE_LLM_LATENCY.partition(':')
+    values = [float(v) for v in params.split(',') if v.strip()]
+    if kind == 'fixed':
+        return values[0]
+    if kind == 'uniform':
+        return rng.uniform(values[0], values[1])
+    if kind == 'lognormal':
+        return rng.lognormvariate(np.log(values[0]), values[1])
+    return 0.0
+
+def _fake_digest(text, salt=""):
+    return hashlib.md5(f"{salt}|{text.strip().lower()}".encode('utf-8')).hexdigest()
+
+def _fake_unit(digest, key):
+    """Deterministic value in [0, 1) derived from the essay digest and a key."""
+    return int(hashlib.md5(f"{digest}:{key}".encode('utf-8')).hexdigest()[:8], 16) / 0xFFFFFFFF
+
+def _fake_response(messages, task):
+    """Build a schema-valid, deterministic response for the given task type."""
+    system = "\n".join(m['content'] for m in messages if m['role'] == 'system')
+    user = "\n".join(m['content'] for m in messages if m['role'] == 'user')
+    digest = _fake_digest(user)
+
+    if task in ('scoring', 'partial_scoring'):
+        requested = [m for m in re.findall(r'^\s*- (\w+):', system, flags=re.MULTILINE) if m in TASK1_METRICS]
+        ability = 0.55 + 0.35 * _fake_unit(digest, 'ability')
+        scores = {}
+        for metric in requested:
+            value = ability + 0.25 * (_fake_unit(digest, metric) - 0.5)
+            if FAKE_LLM_SCORE_NOISE > 0:
+                value += _fake_rng.gauss(0, FAKE_LLM_SCORE_NOISE)
+            scores[metric] = round(min(1.0, max(0.0, value)), 2)
+        if 'overall_band' in system:
+            scores['overall_band'] = round((4.0 + 5.0 * ability) * 2) / 2
+        return json.dumps(scores)
+
+    if task == 'recommendations':
+        focus = list(TASK1_METRICS.values())[int(_fake_unit(digest, 'focus') * len(TASK1_METRICS))]
+        return (
+            f"【診斷摘要】\n(fake) 目前整體表現穩定，主要瓶頸為 {focus}。\n"
+            f"【關鍵瓶頸分析】\n(fake) {focus} 的分數低於其他指標。\n"
+            f"【具體改進建議】\n(fake) 每篇作文針對 {focus} 刻意練習。\n"
+            f"【下一步行動計劃】\n(fake) 完成 3 篇針對性練習。\n"
+            f"===ENGLISH_VERSION_START===\n"
+            f"[Diagnostic Summary]\n(fake) Main bottleneck: {focus}.\n"
+            f"[Key Bottleneck Analysis]\n(fake) {focus} trails the other metrics.\n"
+            f"[Actionable Advice]\n(fake) Practise {focus} deliberately in every essay.\n"
+            f"[Next Steps]\n(fake) Write 3 targeted essays. ref={digest[:8]}\n"
+        )
+
+    return (
+        f"### Definition\n(fake) Deterministic deep-dive text ref={digest[:8]}.\n\n"
+        f"### Problem Analysis with Quotes\n(fake) \"{user.strip()[:80]}...\"\n\n"
+        f"### Correction & Advice\n(fake) Rewrite the quoted sentence more precisely.\n"
+    )
+
+def _query_fake_api(messages, task=None, cancel_event=None, on_chunk=None, profile=None, stop_at_json=False):
+    """
+    Local deterministic stand-in for Kimi/Gemini (offline load testing & benchmarks).
+    Content depends only on the prompt/essay hash; latency, streaming cadence and
+    failures follow FAKE_LLM_* settings.
+    """
+    if task is None:
+        has_system = any(m['role'] == 'system' for m in messages)
+        task = 'scoring' if has_system else 'recommendations'
+
+    on_chunk = on_chunk or _echo_chunk
+    rng = _fake_rng
+    latency = _sample_fake_latency(rng)
+    if profile is not None and latency > profile['deadline']:
+        # 模擬逾時：等到期限後失敗
+        if cancel_event is None or not cancel_event.wait(profile['deadline']):
+            print(f"  [Error] Fake API Request Failed: deadline {profile['deadline']:.1f}s exceeded")
+        return None
+    if cancel_event is not None:
+        if cancel_event.wait(latency):
+            return None
+    else:
+        time.sleep(latency)
+    if rng.random() < FAKE_LLM_FAILURE_RATE:
+        print("  [Error] Fake API Request Failed: injected failure")
+        return None
+
+    content = _fake_response(messages, task)
+    if task in ('scoring', 'partial_scoring') and rng.random() < FAKE_LLM_BAD_JSON_RATE:
+        content = content[:len(content) // 2]  # truncated JSON exercises the retry path
+    if FAKE_LLM_THINK_CHARS > 0:
+        # 模擬推理模型：前置 <think> 區塊與 JSON 之後的閒聊，用來驗證串流過濾
+        content = f"<think>{'.' * FAKE_LLM_THINK_CHARS}</think>{content}\n\nLet me know if you need more detail."
+
+    # Stream in chunks like the Kimi path (same <think> / early-JSON handling)
+    stream = StreamCollector(on_chunk, stop_at_json=stop_at_json)
+    for i in range(0, len(content), FAKE_LLM_CHUNK_SIZE):
+        if cancel_event is not None and cancel_event.is_set():
+            break
+        chunk = content[i:i + FAKE_LLM_CHUNK_SIZE]
+        if FAKE_LLM_CHUNK_DELAY > 0:
+            time.sleep(FAKE_LLM_CHUNK_DELAY)
+        if stream.feed(chunk):
+            break
+    full_content = stream.finish()
+    if _echoes(on_chunk):
+        print()
+    return full_content
+
+def _query_llm(messages, provider='kimi', task=None, on_chunk=None, cancel_event=None):
+    """
+    task: 'scoring' | 'partial_scoring' | 'recommendations' | 'deep_dive' (used by the fake provider
+    and for token budgets). Raises BudgetExceeded when today's budget for this task is used up.
+    on_chunk: receives the primary call's streamed text (default: print it). If a hedged peer
+    wins, the returned content is authoritative and may differ from what was streamed.
+    cancel_event: once set, the call (and any hedge / failover) is abandoned and None returned.
+    """
+    provider = llm_provider(provider)
+    ledger = token_ledger.get_ledger()
+    ledger.check(task)
+
+    def attempt(name, cancel_event, hedged):
+        # 對沖的重複請求不輸出串流內容，避免與主要請求交錯
+        usage = {}
+        content = _dispatch_llm(messages, name, task, usage, cancel_event,
+                                on_chunk=(lambda chunk: None) if hedged else on_chunk)
+        _record_usage(ledger, messages, content, name, task, usage)
+        if cancel_event.is_set():
+            return None
+        return content
+
+    with tracing.span('llm_call', provider=provider, task=task) as span:
+        # 評分呼叫只有可解析的 JSON 才算有效結果 (截斷的回應會觸發備援)
+        is_valid = _is_parseable_json if task in ('scoring', 'partial_scoring') else bool
+        content, served_by = LLM_ROUTER.call(provider, task or 'other', attempt, is_valid=is_valid,
+                                             caller_cancel=cancel_event)
+        span.attrs['served_by'] = served_by
+    return content
+
+def llm_provider(provider):
+    """LLM that serves text calls for `provider` ('local' / 'hybrid' map to LOCAL_ESCALATION_PROVIDER)."""
+    return LOCAL_ESCALATION_PROVIDER if provider in LOCAL_PROVIDERS else provider
+
+def _dispatch_llm(messages, provider, task, usage, cancel_event=None, on_chunk=None):
+    start = time.perf_counter()
+    profile = generation_profile(provider, task)
+    on_chunk = _first_chunk_timer(on_chunk or _echo_chunk, start, provider, task)
+    stop_at_json = task in ('scoring', 'partial_scoring')
     if provider == 'gemini':
         print("(Using Gemini)...", end="", flush=True)
-        return _query_gemini_api(messages)
+        content = _query_gemini_api(messages, usage=usage, cancel_event=cancel_event, on_chunk=on_chunk,
+                                    profile=profile, stop_at_json=stop_at_json)
+    elif provider == 'fake':
+        print("(Using Fake LLM)...", end="", flush=True)
+        content = _query_fake_api(messages, task=task, cancel_event=cancel_event, on_chunk=on_chunk,
+                                  profile=profile, stop_at_json=stop_at_json)
     else:
         print("(Using Kimi)...", end="", flush=True)
-        return _query_kimi_api(messages)
+        content = _query_kimi_api(messages, usage=usage, cancel_event=cancel_event, on_chunk=on_chunk,
+                                  profile=profile, stop_at_json=stop_at_json)
+    if cancel_event is not None and cancel_event.is_set():
+        outcome = 'cancelled'
+    else:
+        outcome = 'ok' if content else 'error'
+    arena_metrics.LLM_CALL_SECONDS.observe(time.perf_counter() - start, provider=provider, task=task or 'other',
+                                           outcome=outcome)
+    return content
+
+def _first_chunk_timer(on_chunk, start, provider, task):
+    """Wrap a chunk callback to observe time-to-first-chunk once per call."""
+    seen = []
+    def wrapper(chunk):
+        if not seen:
+            seen.append(True)
+            arena_metrics.LLM_FIRST_CHUNK_SECONDS.observe(time.perf_counter() - start, provider=provider,
+                                                          task=task or 'other')
+        on_chunk(chunk)
+    wrapper.echo = on_chunk is _echo_chunk
+    return wrapper
+
+def rate_limit_pause(seconds, cancel_event=None):
+    """
+    Pause between LLM calls (retry delay, rate-limit protection). Returns True if
+    cancel_event was set meanwhile. benchmark_suite replaces this hook to skip the waits.
+    """
+    if cancel_event is not None:
+        return cancel_event.wait(seconds)
+    time.sleep(seconds)
+    return False
 
-def get_ai_scores(essay_text):
+def _clean_llm_json(content):
+    """Strip <think> blocks and markdown fences around a JSON reply."""
+    clean_content = re.sub(r'<think>.*?</think>', '', content, flags=re.DOTALL)
+    return clean_content.replace('```json', '').replace('```', '').strip()
+
+def _is_parseable_json(content):
+    try:
+        json.loads(_clean_llm_json(content))
+        return True
+    except json.JSONDecodeError:
+        return False
+
+def _provider_available(provider):
+    if provider == 'gemini':
+        return HAS_GEMINI_LIB and bool(gemini_api_key)
+    return True
+
+# 對沖 / 備援路由 (LLM_HEDGE_PEERS 設定主要→備援供應商對應)
+LLM_ROUTER = llm_router.ProviderRouter(is_available=_provider_available)
+
+def _record_usage(ledger, messages, content, provider, task, usage):
+    """Log token usage of one call; estimate it from the text when the provider reported none."""
+    estimated = not usage
+    if estimated:
+        if not content:
+            return  # 失敗且沒有用量資訊：無法得知是否計費
+        usage = {
+            'prompt_tokens': sum(token_ledger.estimate_tokens(m['content']) for m in messages),
+            'completion_tokens': token_ledger.estimate_tokens(content),
+        }
+    model = {'kimi': KIMI_MODEL_NAME, 'gemini': GEMINI_MODEL_NAME}.get(provider, provider)
+    cached = usage.get('cached_tokens', 0)
+    ledger.record(provider, task, usage['prompt_tokens'], usage['completion_tokens'], estimated=estimated,
+                  model=model, cached_tokens=cached)
+    for kind in ('prompt', 'completion'):
+        arena_metrics.LLM_TOKENS.inc(usage[f'{kind}_tokens'], provider=provider, task=task or 'other', kind=kind)
+    if cached:
+        arena_metrics.LLM_TOKENS.inc(cached, provider=provider, task=task or 'other', kind='cached_prompt')
+
+# 每個指標的評分說明 (同時用於完整評分與部分補評的 prompt)
+METRIC_RUBRIC = {
+    'ta_overview_clarity': "Is there a clear overview summarizing the main nature of the process?",
+    'ta_step_coverage': "Are ALL key steps/stages included without missing critical info?",
+    'ta_logic_accuracy': "Is the logic/information accurate (e.g., correct input/output, no misinterpretation of the arrows/cycle)?",
+    'cc_sequencing_markers': "Effective use of time sequencers (First, Next, Then, Finally, Subsequently).",
+    'cc_referencing': "Use of pronouns/referencing to link ideas (e.g., \"This resulting mixture,\" \"It is then...\").",
+    'cc_paragraphing': "Logic of paragraphing (Introduction, Overview, Body Paragraphs split logically).",
+    'lr_process_verbs': "Precision and variety of verbs used for actions (e.g., ground, filtered, transported).",
+    'lr_topic_nouns': "Accuracy of nouns describing equipment/substances in the diagram.",
+    'lr_paraphrasing': "Ability to rephrase prompt words (not copying \"The diagram shows...\").",
+    'lr_conciseness': "Precision and Conciseness. Does the student use precise words instead of wordy phrases? (Refinement).",
+    'gra_passive_voice': "Effective use of Passive Voice for object-focused steps. CRITICAL: Do NOT penalize Active Voice if the subject has natural or biological agency (e.g., \"The sun heats...\", \"Rain falls...\", \"The machine crushes...\"). Active voice in these natural contexts is correct and should be rewarded for appropriateness. Focus on logical appropriateness.",
+    'gra_complex_structures': "Use of complex syntax (e.g., \"After being heated, the water...\", \"Which is then...\").",
+    'gra_error_free_density': "Frequency of error-free sentences.",
+}
+
+RUBRIC_SECTIONS = [
+    ('Task Achievement', 'ta_'),
+    ('Coherence & Cohesion', 'cc_'),
+    ('Lexical Resource', 'lr_'),
+    ('Grammar', 'gra_'),
+]
+
+# --- Rubric Versioning ---
+# 每次新增或改寫指標定義時遞增 RUBRIC_VERSION，並在 RUBRIC_CHANGES 記錄受影響的指標。
+# 快取條目會帶上 '_rubric_version'，只有缺少或定義已變更的指標需要重新評分。
+RUBRIC_VERSION = 2
+RUBRIC_CHANGES = {
+    2: ['lr_conciseness'],
+}
+CACHE_META_PREFIX = '_'  # 以底線開頭的鍵是快取中繼資料，不是分數
+
+def build_examiner_prompt(metrics=None, include_overall=None):
     """
-    調用 AI (Gemini/Kimi) 將作文轉換為量化數值指標 (針對 IELTS Task 1)
+    Build the examiner system prompt. With `metrics` (a subset of TASK1_METRICS) the prompt
+    asks only for those metrics and, unless include_overall=True, omits overall_band
+    (partial rescoring / prefilled mechanical metrics).
     """
-    system_prompt = """
+    partial = metrics is not None
+    include_overall = not partial if include_overall is None else include_overall
+    metrics = list(metrics) if partial else list(TASK1_METRICS.keys())
+
+    sections = []
+    for title, prefix in RUBRIC_SECTIONS:
+        lines = [f"    - {m}: {METRIC_RUBRIC[m]}" for m in metrics if m.startswith(prefix)]
+        if lines:
+            sections.append(f"    [{title}]\n" + "\n".join(lines))
+
+    if partial:
+        example = ", ".join(f'"{m}": 0.8' for m in metrics[:2])
+        overall = "\n\n    [Overall]\n    - overall_band: Overall band score (0.0 to 9.0)" if include_overall else ""
+        example += ', ..., "overall_band": 6.5' if include_overall else (', ...' if len(metrics) > 2 else '')
+        fmt = f"    Format: {{{example}}}\n    Return ONLY the metrics listed above."
+    else:
+        overall = "\n\n    [Overall]\n    - overall_band: Overall band score (0.0 to 9.0)"
+        fmt = '    Format: {"ta_overview_clarity": 0.8, "ta_step_coverage": 0.9, ... , "overall_band": 6.5}'
+
+    return f"""
     You are an expert IELTS Writing Examiner specializing in **Task 1 Process Diagrams**.
     Evaluate the essay based on **Process-specific criteria** and return ONLY a JSON object.
     
     Required metrics (0.0 to 1.0 scale, where 0.9 is Band 9 equivalent):
     
-    [Task Achievement]
-    - ta_overview_clarity: Is there a clear overview summarizing the main nature of the process?
-    - ta_step_coverage: Are ALL key steps/stages included without missing critical info?
-    - ta_logic_accuracy: Is the logic/information accurate (e.g., correct input/output, no misinterpretation of the arrows/cycle)?
-
-    [Coherence & Cohesion]
-    - cc_sequencing_markers: Effective use of time sequencers (First, Next, Then, Finally, Subsequently).
-    - cc_referencing: Use of pronouns/referencing to link ideas (e.g., "This resulting mixture," "It is then...").
-    - cc_paragraphing: Logic of paragraphing (Introduction, Overview, Body Paragraphs split logically).
-
-    [Lexical Resource]
-    - lr_process_verbs: Precision and variety of verbs used for actions (e.g., ground, filtered, transported).
-    - lr_topic_nouns: Accuracy of nouns describing equipment/substances in the diagram.
-    - lr_paraphrasing: Ability to rephrase prompt words (not copying "The diagram shows...").
-    - lr_conciseness: Precision and Conciseness. Does the student use precise words instead of wordy phrases? (Refinement).
-
-    [Grammar]
-    - gra_passive_voice: Effective use of Passive Voice for object-focused steps. CRITICAL: Do NOT penalize Active Voice if the subject has natural or biological agency (e.g., "The sun heats...", "Rain falls...", "The machine crushes..."). Active voice in these natural contexts is correct and should be rewarded for appropriateness. Focus on logical appropriateness.
-    - gra_complex_structures: Use of complex syntax (e.g., "After being heated, the water...", "Which is then...").
-    - gra_error_free_density: Frequency of error-free sentences.
-
-    [Overall]
-    - overall_band: Overall band score (0.0 to 9.0)
+{(chr(10) * 2).join(sections)}{overall}
     
-    Format: {"ta_overview_clarity": 0.8, "ta_step_coverage": 0.9, ... , "overall_band": 6.5}
+{fmt}
     IMPORTANT: Return ONLY the raw JSON string. Do not use Markdown code blocks (```json ... ```).
     IMPORTANT: Evaluate based ONLY on the criteria above. Do NOT penalize for short word count. Ignore word limit requirements.
     """
-    
+
+EXAMINER_SYSTEM_PROMPT = build_examiner_prompt()
+# LINGUISTIC_PREFILL='prefill' 時使用：機械性指標由本地計算，LLM 只評其餘指標與 overall_band
+LLM_JUDGED_METRICS = [m for m in TASK1_METRICS if m not in linguistic_features.MECHANICAL_METRICS]
+PREFILL_EXAMINER_PROMPT = build_examiner_prompt(LLM_JUDGED_METRICS, include_overall=True)
+
+def _request_scores(system_prompt, essay_text, required_keys, task='scoring', hints=None, provider=None):
+    """
+    Query the LLM with retries until a JSON object containing `required_keys` comes back.
+    hints: optional text appended after the essay (the system prompt stays a stable prefix)
+    provider: defaults to CURRENT_PROVIDER (ensemble members pass their own)
+    """
+    user_content = f"Evaluate this IELTS Task 1 essay:\n\n{essay_text}"
+    if hints:
+        user_content += f"\n\n{hints}"
     messages = [
         {"role": "system", "content": system_prompt},
-        {"role": "user", "content": f"Evaluate this IELTS Task 1 essay:\n\n{essay_text}"}
+        {"role": "user", "content": user_content}
     ]
 
+    member = provider
     for delay in [1, 2, 4]:
-        content = _query_llm(messages, provider=CURRENT_PROVIDER)
+        provider = llm_provider(member or CURRENT_PROVIDER)
+        content = _query_llm(messages, provider=provider, task=task)
         if content:
             # Clean up potential markdown blocks and <think> tags
-            clean_content = re.sub(r'<think>.*?</think>', '', content, flags=re.DOTALL)
-            clean_content = clean_content.replace('```json', '').replace('```', '').strip()
+            clean_content = _clean_llm_json(content)
             try:
-                return json.loads(clean_content)
+                scores = json.loads(clean_content)
+                if all(k in scores for k in required_keys):
+                    return scores
+                print(f"  [Debug] Missing metrics in response. Retrying...")
+                reason = 'missing_keys'
             except json.JSONDecodeError:
                 print(f"  [Debug] JSON Parsing Failed. Retrying... content snippet: {clean_content[:50]}...")
+                reason = 'parse'
+        else:
+            reason = 'empty'
+        arena_metrics.LLM_JSON_RETRIES.inc(provider=provider, task=task, reason=reason)
         
-        time.sleep(delay)
+        rate_limit_pause(delay)
             
     return None
 
-def get_ai_recommendations(rca_df, df):
+@tracing.traced()
+def get_ai_scores(essay_text):
+    """
+    調用 AI (Gemini/Kimi) 將作文轉換為量化數值指標 (針對 IELTS Task 1)
+    'local' / 'hybrid' 模式先由本地模型評分；hybrid 只在本地模型不確定 (或尚未訓練) 時呼叫 LLM
+    """
+    local = None
+    if CURRENT_PROVIDER in LOCAL_PROVIDERS:
+        local = get_local_scores(essay_text)
+        if CURRENT_PROVIDER == 'local' or (local is not None and local['_confident']):
+            decision = 'local' if local is not None else 'unavailable'
+            arena_metrics.LOCAL_SCORER_DECISIONS.inc(provider=CURRENT_PROVIDER, decision=decision)
+            if local is None:
+                print("[Local] ⚠️ 尚無可用的本地評分模型，請先執行 --mode train-local-scorer")
+            return local
+        decision = 'escalated' if local is not None else 'unavailable'
+        arena_metrics.LOCAL_SCORER_DECISIONS.inc(provider=CURRENT_PROVIDER, decision=decision)
+        if local is not None:
+            print(f"[Local] 本地評分不確定 (std {local['_uncertainty']:.3f})，改由 LLM 評分")
+
+    features = linguistic_features.extract_features(essay_text)
+    mechanical = linguistic_features.mechanical_scores(features)
+    prefill = LINGUISTIC_PREFILL == 'prefill'
+    hints = linguistic_features.format_hints(features, mechanical) if LINGUISTIC_PREFILL in ('hint', 'prefill') else None
+    system_prompt = PREFILL_EXAMINER_PROMPT if prefill else EXAMINER_SYSTEM_PROMPT
+    try:
+        if len(SCORING_ENSEMBLE) > 1:
+            scores = get_ensemble_scores(system_prompt, essay_text, hints=hints)
+        else:
+            scores = _request_scores(system_prompt, essay_text, required_keys=(), hints=hints)
+    except BudgetExceeded as e:
+        if local is None:
+            raise
+        print(f"[預算] ⚠️ {e}，改用本地評分")
+        return local
+    if scores:
+        if prefill:
+            scores.update(mechanical)
+            scores['_prefilled'] = list(mechanical)
+        scores['_rubric_version'] = RUBRIC_VERSION
+    return scores
+
+# 集成成員並行執行 (每個成員各自經過 router 的對沖/備援)
+_ENSEMBLE_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="score-ensemble")
+
+def get_ensemble_scores(system_prompt, essay_text, hints=None, members=None):
+    """
+    Score one essay concurrently with every provider in SCORING_ENSEMBLE (repeats = extra
+    samples) and aggregate with aggregate_scores(). Once a majority has answered,
+    stragglers get SCORING_ENSEMBLE_GRACE more seconds, so wall time stays close to a
+    single call. Returns None when no member succeeded.
+    """
+    members = members or SCORING_ENSEMBLE
+    futures = {}
+    for provider in members:
+        ctx = contextvars.copy_context()  # 保留 token 記帳的端點/學生 context
+        future = _ENSEMBLE_POOL.submit(ctx.run, _request_scores, system_prompt, essay_text, (), 'scoring',
+                                       hints, provider)
+        futures[future] = provider
+
+    quorum = len(members) // 2 + 1
+    samples, providers, budget_error = [], [], None
+    pending = set(futures)
+    grace_deadline = None
+    with tracing.span('ensemble_score', members=len(members)):
+        while pending:
+            timeout = None if grace_deadline is None else max(0.0, grace_deadline - time.perf_counter())
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                print(f"  [Ensemble] ⏱️ {len(pending)} 個成員逾時，以 {len(samples)} 份評分彙整")
+                break  # 落後的成員在背景完成，結果不採用
+            for future in done:
+                try:
+                    scores = future.result()
+                except BudgetExceeded as e:
+                    budget_error = e
+                    continue
+                if scores:
+                    samples.append(scores)
+                    providers.append(futures[future])
+            if grace_deadline is None and len(samples) >= quorum:
+                grace_deadline = time.perf_counter() + SCORING_ENSEMBLE_GRACE
+
+    arena_metrics.SCORING_ENSEMBLE_MEMBERS.observe(len(samples))
+    if not samples:
+        if budget_error is not None:
+            raise budget_error
+        return None
+    aggregated = aggregate_scores(samples)
+    aggregated['_ensemble'] = providers
+    return aggregated
+
+def aggregate_scores(samples, method=None):
+    """
+    Combine score dicts per key with the median or a trimmed mean ('_variance' holds the
+    per-key population variance across samples). overall_band is rounded to half bands.
+    """
+    method = method or SCORING_ENSEMBLE_AGG
+    keys = [k for k in dict.fromkeys(k for s in samples for k in s) if not k.startswith(CACHE_META_PREFIX)]
+    aggregated, variance = {}, {}
+    for key in keys:
+        values = np.array([float(s[key]) for s in samples if key in s])
+        if method == 'trimmed':
+            value = float(stats.trim_mean(values, SCORING_ENSEMBLE_TRIM))
+        else:
+            value = float(np.median(values))
+        aggregated[key] = round(value * 2) / 2 if key == 'overall_band' else round(value, 2)
+        variance[key] = round(float(values.var()), 4)
+    aggregated['_variance'] = variance
+    return aggregated
+
+def with_score_variance(row, entry):
+    """Add var_<metric> columns from a cache entry's '_variance' (ensemble scoring) to a DataFrame row."""
+    variance = entry.get('_variance') if entry else None
+    if not variance:
+        return row
+    return dict(row, **{f"{VARIANCE_PREFIX}{m}": v for m, v in variance.items() if m in TASK1_METRICS})
+
+def non_score_columns(df):
+    """Columns of a score DataFrame that are not scores (file name, time, text features, variances)."""
+    return [c for c in df.columns
+            if c in ('file_name', ESSAY_TIME_COLUMN)
+            or c.startswith((linguistic_features.FEATURE_PREFIX, VARIANCE_PREFIX))]
+
+def parse_essay_time(value):
+    """Epoch seconds from an ISO timestamp / epoch number (None when missing or unparseable)."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return float(value) / 1000 if value > 1e11 else float(value)  # 前端的 Date.now() 為毫秒
+    try:
+        return datetime.datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return None
+
+def get_local_scores(essay_text):
+    """
+    Scores from the local model with '_source': 'local', '_uncertainty' (largest ensemble std)
+    and '_confident', or None when no model is trained for the current rubric.
+    """
+    scorer = local_scorer.get_scorer()
+    if scorer is None or scorer.meta.get('rubric_version') != RUBRIC_VERSION:
+        return None
+    with tracing.span('local_score'):
+        scores, spread = scorer.predict(essay_text)
+    missing = [m for m in TASK1_METRICS if m not in scores]
+    if missing:
+        # 模型沒有的指標 (只有啟發式分數、沒有 LLM 標註的機械性指標) 直接用啟發式規則
+        mechanical = linguistic_features.mechanical_scores(linguistic_features.extract_features(essay_text))
+        scores.update({m: mechanical[m] for m in missing if m in mechanical})
+        scores['_prefilled'] = [m for m in missing if m in mechanical]
+    scores['_source'] = 'local'
+    scores['_uncertainty'] = max(spread.values())
+    scores['_confident'] = scorer.is_confident(spread)
+    scores['_rubric_version'] = RUBRIC_VERSION
+    return scores
+
+def with_text_features(row, text):
+    """Add the deterministic feat_* columns (linguistic_features) to a DataFrame row when the text is known."""
+    if not text:
+        return row
+    return dict(row, **linguistic_features.extract_features(text))
+
+def is_cacheable_scores(scores):
+    """Only LLM scores go into the shared cache (it is also the local model's training set)."""
+    return scores.get('_source') != 'local'
+
+def train_local_scorer():
+    """Train local_scorer on essays in ESSAY_FOLDER whose cached LLM scores match the current rubric."""
+    score_cache = load_cache()
+    targets = list(TASK1_METRICS) + ['overall_band']
+    texts, labels = [], []
+    for essay in load_user_essays(ESSAY_FOLDER):
+        entry, _ = find_in_cache(score_cache, essay['file_name'], essay['content'])
+        if entry and validate_cache_entry(entry) and 'overall_band' in entry and is_cacheable_scores(entry):
+            # prefill 模式的機械性指標是啟發式分數，不是 LLM 標註：不作為訓練標籤
+            prefilled = set(entry.get('_prefilled', ()))
+            texts.append(essay['content'])
+            labels.append({t: entry[t] for t in targets if t in entry and t not in prefilled})
+    print(f"[Local] 可用於訓練的 LLM 評分文章: {len(texts)} 篇")
+    start = time.perf_counter()
+    try:
+        scorer = local_scorer.train(texts, labels, targets, meta={'rubric_version': RUBRIC_VERSION})
+    except ValueError as e:
+        print(f"[停止] {e}")
+        return None
+    local_scorer.save(scorer)
+
+    print(f"[Local] 訓練完成 ({time.perf_counter() - start:.1f}s)，holdout MAE:")
+    if scorer.meta.get('dropped_targets'):
+        print(f"[Local] LLM 標註不足、改用啟發式規則的指標: {', '.join(scorer.meta['dropped_targets'])}")
+    for target, mae in scorer.meta['holdout_mae'].items():
+        name = TASK1_METRICS.get(target, 'Overall Band')
+        print(f"  {name:<32} {mae:.3f}")
+    print(f"[Local] 模型已儲存: {local_scorer.LOCAL_SCORER_FILE}")
+    return scorer
+
+def load_cohort_histories(folder, score_cache):
+    """{student: [score rows]} from folder/<student>/*.txt using cached scores only (unscored essays are counted)."""
+    histories, unscored = {}, 0
+    for student in sorted(os.listdir(folder)):
+        path = os.path.join(folder, student)
+        if not os.path.isdir(path):
+            continue
+        rows = []
+        for essay in load_user_essays(path):
+            # 只依內容雜湊查詢: 不同學生資料夾常有同名檔案 (essay_1.txt)，檔名別名會對錯人
+            entry, _ = score_cache.lookup(get_content_hash(essay['content']))
+            if entry and validate_cache_entry(entry) and 'overall_band' in entry:
+                rows.append(with_score_variance(strip_cache_meta(entry), entry))
+            else:
+                unscored += 1
+        histories[student] = rows
+    return histories, unscored
+
+def cohort_report(folder=COHORT_FOLDER, window=None):
+    """Class-level RCA over every student folder in `folder`; prints the ranking / outliers and saves JSON."""
+    if not os.path.isdir(folder):
+        print(f"[停止] 找不到班級資料夾 '{folder}' (每位學生一個子資料夾，內含 .txt 作文)")
+        return None
+    start = time.perf_counter()
+    histories, unscored = load_cohort_histories(folder, load_cache())
+    matrix = cohort_rca.build_matrix(histories, list(TASK1_METRICS), window=window)
+    print(f"[Cohort] {len(histories)} 位學生，{len(matrix['y'])} 篇已評分作文納入分析"
+          + (f" ({unscored} 篇快取中沒有評分，略過)" if unscored else ""))
+    result = cohort_rca.analyze(matrix, metric_names=TASK1_METRICS, variance_ref=SCORE_VARIANCE_REF)
+    if not result['total_students']:
+        print(f"[停止] 沒有學生有至少 {cohort_rca.COHORT_MIN_ESSAYS} 篇已評分的作文")
+        return None
+
+    print(f"\n🏫 班級瓶頸排名 ({result['total_students']} 位學生):")
+    for i, row in enumerate(result['class_ranking'], 1):
+        print(f"  {i:>2}. {row['Metric_Name']:<32} BI {row['Mean_Bottleneck_Index']:.4f}  "
+              f"avg {row['Avg_Score']:.2f}  首要瓶頸 {row['Top1_Share']:.0%}")
+    if result['outliers']:
+        print("\n⚠️ 離群學生 (robust z):")
+        for o in result['outliers'][:15]:
+            name = TASK1_METRICS.get(o['metric'], 'Overall Band')
+            print(f"  {o['student_id']:<16} {name:<32} {o['value']:<6} z={o['z']:+.2f} ({o['direction']})")
+    with open(COHORT_REPORT_FILE, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"\n[Cohort] 完成 ({time.perf_counter() - start:.1f}s)，完整結果已儲存: {COHORT_REPORT_FILE}")
+    return result
+
+@tracing.traced()
+def get_ai_partial_scores(essay_text, metrics):
+    """
+    只針對指定的指標補評 (rubric 更新後使用)，回傳 {metric: score}
+    prefill 模式下由啟發式規則填入的指標另列於 '_prefilled'
+    """
+    # 固定指標順序：同一組指標永遠產生逐字相同的 prompt，供應商的前綴快取才會命中
+    metrics = [m for m in TASK1_METRICS if m in metrics]
+    prefilled = {}
+    if LINGUISTIC_PREFILL == 'prefill':
+        mechanical = linguistic_features.mechanical_scores(linguistic_features.extract_features(essay_text))
+        prefilled = {m: mechanical[m] for m in metrics if m in mechanical}
+        metrics = [m for m in metrics if m not in prefilled]
+        if not metrics:
+            return dict(prefilled, _prefilled=list(prefilled))  # 只缺機械性指標：不需呼叫 LLM
+    scores = _request_scores(build_examiner_prompt(metrics), essay_text, required_keys=metrics, task='partial_scoring')
+    if not scores:
+        return None
+    partial = dict(prefilled, **{m: scores[m] for m in metrics})
+    if prefilled:
+        partial['_prefilled'] = list(prefilled)
+    return partial
+
+def stale_metrics(entry):
+    """
+    List the metrics of a cache entry that must be (re)scored: missing keys plus metrics
+    whose definition changed after the entry's '_rubric_version'. Unversioned (legacy)
+    entries are only checked for missing keys.
+    """
+    stale = [m for m in TASK1_METRICS if m not in entry]
+    entry_version = entry.get('_rubric_version')
+    if entry_version is not None:
+        for version, changed in RUBRIC_CHANGES.items():
+            if version > entry_version:
+                stale.extend(m for m in changed if m in entry and m not in stale)
+    return stale
+
+def complete_cache_entry(entry, essay_text):
+    """
+    Bring a partial/outdated cache entry up to the current rubric by asking the LLM only
+    for the stale metrics and merging them in. Returns the merged entry, or None when the
+    entry cannot be repaired (no overall_band) or the partial scoring call failed.
+    """
+    if 'overall_band' not in entry or CURRENT_PROVIDER == 'local':
+        return None  # 本地模式不呼叫 LLM 補評，沿用既有快取
+    stale = stale_metrics(entry)
+    if stale:
+        print(f"  [Cache] 🧩 部分補評: {', '.join(stale)}")
+        try:
+            partial = get_ai_partial_scores(essay_text, stale)
+        except BudgetExceeded as e:
+            print(f"  [預算] ⚠️ {e}")
+            return None
+        if not partial:
+            return None
+        entry = dict(entry)
+        prefilled = set(partial.pop('_prefilled', ()))
+        entry.update(partial)
+        # '_prefilled' = 目前由啟發式規則 (而非 LLM) 給分的指標；這次由 LLM 重評的指標移除
+        # 快取紀錄是合併寫入 (鍵無法刪除)，清空時寫入空清單而不是移除鍵
+        prefilled |= set(entry.get('_prefilled', ())) - set(partial)
+        if prefilled or '_prefilled' in entry:
+            entry['_prefilled'] = sorted(prefilled)
+        if entry.get('_variance'):
+            # 補評的指標只有單次評分，舊的集成變異數不再適用
+            entry['_variance'] = {m: v for m, v in entry['_variance'].items() if m not in partial}
+    entry['_rubric_version'] = RUBRIC_VERSION
+    return entry
+
+def strip_cache_meta(entry):
+    """Return the score fields of a cache entry without '_'-prefixed metadata."""
+    return {k: v for k, v in entry.items() if not k.startswith(CACHE_META_PREFIX)}
+
+BUDGET_SKIPPED_RECOMMENDATIONS = "[預算] 今日 token 預算已用盡，暫停生成 AI 建議 / Daily token budget reached, recommendations skipped"
+LOCAL_SKIPPED_RECOMMENDATIONS = "[本地模式] 練習回合不生成 AI 建議 / Local practice mode, recommendations skipped"
+
+@tracing.traced()
+def get_ai_recommendations(rca_df, df, on_chunk=None, provider=None, cancel_event=None):
     """
     調用 AI (Gemini/Kimi) 生成學習建議報告
+    on_chunk: 串流回呼 (API 串流端點使用)，預設輸出到終端機
+    provider: 預設 CURRENT_PROVIDER；cancel_event: 設定後中止 LLM 呼叫 (串流用戶端已斷線)
     """
+    provider = provider or CURRENT_PROVIDER
+    if provider == 'local':
+        return LOCAL_SKIPPED_RECOMMENDATIONS
     # 準備分析資料
-    avg_scores = df.drop(columns=['file_name', 'overall_band'], errors='ignore').mean().to_dict()
+    feature_cols = [c for c in df.columns if c.startswith(linguistic_features.FEATURE_PREFIX)]
+    avg_scores = df.drop(columns=['overall_band'] + non_score_columns(df), errors='ignore').mean().to_dict()
+    avg_features = df[feature_cols].mean().round(2).to_dict() if feature_cols else {}
     
     if rca_df is not None:
         top_drivers = rca_df.head(3).to_dict('records')
@@ -253,6 +1037,9 @@ def get_ai_recommendations(rca_df, df):
     Top Score Drivers (most impactful on overall band):
     {json.dumps(top_drivers, indent=2)}
     
+    Measured Text Features (averages, automatic):
+    {json.dumps(avg_features, indent=2) if avg_features else "n/a"}
+    
     Overall Band Score Trend: {df['overall_band'].tolist()}
     
     ---
@@ -278,7 +1065,12 @@ def get_ai_recommendations(rca_df, df):
         {"role": "user", "content": prompt}
     ]
     
-    content = _query_llm(messages, provider=CURRENT_PROVIDER)
+    try:
+        content = _query_llm(messages, provider=provider, task='recommendations', on_chunk=on_chunk,
+                             cancel_event=cancel_event)
+    except BudgetExceeded as e:
+        print(f"\n[預算] ⚠️ {e}，略過 AI 建議")
+        return BUDGET_SKIPPED_RECOMMENDATIONS
     if content:
         # Return the raw combined content; frontend will split it
         return content
@@ -301,6 +1093,10 @@ def analyze_latest_progress(rca_df, df):
     print(f"\n--- 最新文章驗收 ({file_name}) ---")
     print(f"這篇文章是否解決了您的主要問題？\n")
     
+    # 近期趨勢 (EWMA / 斜率 / CUSUM 變點)
+    trends = trend_engine.TrendEngine.from_rows(df.to_dict('records'), TASK1_METRICS).snapshot()
+    direction_labels = {'improving': '↗️ 上升', 'declining': '↘️ 下降', 'stable': '➖ 平穩'}
+
     # 取出前三大瓶頸
     top_issues = rca_df.head(3)
     
@@ -325,20 +1121,39 @@ def analyze_latest_progress(rca_df, df):
             
         print(f"🔥 關鍵指標: {metric_name}")
         print(f"   本次表現: {current_score:.2f} (歷史平均: {prev_avg:.2f}) -> {status}")
+        trend = trends[metric]
+        print(f"   近期趨勢: EWMA {trend['ewma']:.2f}, 每篇 {trend['slope']:+.3f} -> {direction_labels[trend['direction']]}")
+        change = trend['change_points'][-1] if trend['change_points'] else None
+        if change and change['index'] >= trend['n'] - 10:  # 只提示最近 10 篇內的變點
+            print(f"   變點: 第 {change['index'] + 1} 篇起{'明顯進步' if change['direction'] == 'up' else '明顯退步'}")
         print("-" * 40)
 
-def generate_detailed_rca_report(rca_df, df, essays_list):
+def generate_detailed_rca_report(rca_df, df, essays_list, on_chunk=None, provider=None, cancel_event=None):
     """
     針對 Random Forest 找出的前三大問題，生成詳細的「舉例說明」報告
+    on_chunk: 串流回呼；提供時各段標題與 AI 分析會依序送出 (API 串流端點使用)
+    provider: 預設 CURRENT_PROVIDER；cancel_event: 設定後停止後續的 LLM 呼叫並回傳 None (不寫入報告檔)
     """
+    emit = on_chunk or (lambda text: None)
+    cancel_event = cancel_event or threading.Event()
+    provider = provider or CURRENT_PROVIDER
     if rca_df is None or len(rca_df) == 0:
         return
 
+    if provider == 'local':
+        print("[Local] 本地模式，略過詳細 RCA 報告")
+        return None
+
+    if not token_ledger.get_ledger().allows('deep_dive'):
+        print("[預算] ⚠️ 今日 token 預算已接近上限，略過詳細 RCA 報告")
+        return None
+
     top_drivers = rca_df.head(3)['Metric'].tolist()
     top_driver_names = rca_df.head(3)['Metric_Name'].tolist()
 
     report_content = "# IELTS Task 1 Detailed RCA Report\n\n"
     report_content += "這份報告針對影響您分數最大的前三項因素，提取您實際寫過的低分文章作為案例進行深入分析。\n\n"
+    emit(report_content)
 
     for metric, metric_name in zip(top_drivers, top_driver_names):
         print(f"  > [Deep Dive] 正在深入分析關鍵因子: {metric_name}...")
@@ -374,44 +1189,54 @@ def generate_detailed_rca_report(rca_df, df, essays_list):
         """
 
         messages = [{"role": "user", "content": prompt}]
-        analysis = _query_llm(messages, provider=CURRENT_PROVIDER)
+        emit(f"## Critical Factor: {metric_name}\n\n")
+        try:
+            analysis = _query_llm(messages, provider=provider, task='deep_dive', on_chunk=on_chunk,
+                                  cancel_event=cancel_event)
+        except BudgetExceeded as e:
+            print(f"  [預算] ⚠️ {e}，其餘因子略過")
+            section = f"## Critical Factor: {metric_name}\n\n(略過: 今日 token 預算已用盡)\n\n---\n\n"
+            emit(section.split("\n\n", 1)[1])
+            report_content += section
+            break
+        if cancel_event.is_set():
+            print("  [Deep Dive] 已取消，略過其餘因子")
+            return None
         
         if analysis:
              # Remove <think> tags again just in case
             analysis = re.sub(r'<think>.*?</think>', '', analysis, flags=re.DOTALL).strip()
             report_content += f"## Critical Factor: {metric_name}\n\n{analysis}\n\n---\n\n"
+            emit("\n\n---\n\n")
         else:
             report_content += f"## Critical Factor: {metric_name}\n\n(AI Analysis Failed)\n\n---\n\n"
+            emit("(AI Analysis Failed)\n\n---\n\n")
         
-        time.sleep(2)
+        if rate_limit_pause(2, cancel_event):
+            print("  [Deep Dive] 已取消，略過其餘因子")
+            return None
 
     # Save Report
-    with open('ielts_detailed_rca_report.md', 'w', encoding='utf-8') as f:
+    with open(DETAILED_REPORT_FILE, 'w', encoding='utf-8') as f:
         f.write(report_content)
-    
-    print("\n[系統] 詳細 RCA 報告已生成: ielts_detailed_rca_report.md")
+
+    print(f"\n[系統] 詳細 RCA 報告已生成: {DETAILED_REPORT_FILE}")
+    return report_content
 
 def get_content_hash(text):
     """
     Generate a unique MD5 hash from content for unified cache lookup.
     Uses the same normalization as arena_api.py for consistency.
     """
-    import hashlib
     normalized = text.strip().lower()
     return hashlib.md5(normalized.encode('utf-8')).hexdigest()
 
 def load_cache():
-    if os.path.exists(CACHE_FILE):
-        try:
-            with open(CACHE_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            print("[Warning] Cache file corrupted, starting fresh.")
-    return {}
+    """Load the shared score cache (legacy flat layouts are normalised on load)."""
+    return ScoreCache.load(CACHE_FILE, essay_folder=ESSAY_FOLDER)
 
 def save_cache(cache_data):
-    with open(CACHE_FILE, 'w', encoding='utf-8') as f:
-        json.dump(cache_data, f, ensure_ascii=False, indent=2)
+    cache_data.save()
 
 def find_in_cache(cache, filename, content):
     """
@@ -419,20 +1244,11 @@ def find_in_cache(cache, filename, content):
     
     Strategy:
     1. First try hash-based lookup (most reliable, content-based)
-    2. Fallback to filename-based lookup (for backward compatibility)
+    2. Fallback to the filename alias index (for backward compatibility)
     
-    Returns: (cache_entry, cache_key) if found, else (None, None)
+    Returns: (cache_entry, content_hash) if found, else (None, None)
     """
-    # Strategy 1: Hash-based lookup (preferred, used by API)
-    content_hash = get_content_hash(content)
-    if content_hash in cache:
-        return cache[content_hash], content_hash
-    
-    # Strategy 2: Filename-based lookup (fallback, for CLI compatibility)
-    if filename in cache:
-        return cache[filename], filename
-    
-    return None, None
+    return cache.lookup(get_content_hash(content), filename)
 
 
 def load_user_essays(folder_path):
@@ -449,17 +1265,97 @@ def load_user_essays(folder_path):
     # Sort files by the numeric value in the filename
     files.sort(key=lambda f: int(re.search(r'\d+', f).group()) if re.search(r'\d+', f) else 9999)
     for file_name in files:
-        with open(os.path.join(folder_path, file_name), 'r', encoding='utf-8') as f:
+        path = os.path.join(folder_path, file_name)
+        with open(path, 'r', encoding='utf-8') as f:
             essays.append({
                 "file_name": file_name,
-                "content": f.read()
+                "content": f.read(),
+                "modified": os.path.getmtime(path)
             })
     return essays
 
-def perform_ml_analysis(df):
+class EssayWindow:
+    """
+    Rolling window of score rows in chronological order: at most `max_essays` rows and
+    rows no older than `max_days` before the newest one (but never fewer than
+    RCA_WINDOW_MIN_ESSAYS rows because of the day limit). Expired rows are dropped from
+    the left as rows are appended. A row without ESSAY_TIME_COLUMN is dated by the
+    previous timed row (rows are chronological); untimed rows before the first timed
+    row count as the oldest.
+
+    The window is not kept between calls: perform_ml_analysis() rebuilds it from the
+    history it is given (one O(history) pass), since the API receives the full history
+    with every request. What the window bounds is the fit (rows and sample weights).
+    """
+
+    def __init__(self, max_essays=None, max_days=None, half_life=None):
+        self.max_essays = RCA_WINDOW_ESSAYS if max_essays is None else max_essays
+        self.max_days = RCA_WINDOW_DAYS if max_days is None else max_days
+        self.half_life = RCA_HALF_LIFE if half_life is None else half_life
+        self.rows = deque(maxlen=self.max_essays or None)
+        self._times = deque(maxlen=self.max_essays or None)  # 每列的有效時間 (None = 早於第一個有時間的列)
+        self.seen = 0
+        self._newest_time = None
+
+    @classmethod
+    def from_frame(cls, df, **kwargs):
+        window = cls(**kwargs)
+        for row in df.to_dict('records'):
+            window.append(row)
+        return window
+
+    def append(self, row):
+        essay_time = row.get(ESSAY_TIME_COLUMN)
+        if essay_time is not None and not pd.isna(essay_time):
+            self._newest_time = max(essay_time, self._newest_time or essay_time)
+        else:
+            essay_time = self._newest_time
+        self.rows.append(row)
+        self._times.append(essay_time)
+        self.seen += 1
+        if self.max_days and self._newest_time is not None:
+            cutoff = self._newest_time - self.max_days * 86400
+            while len(self.rows) > RCA_WINDOW_MIN_ESSAYS and (self._times[0] is None or self._times[0] < cutoff):
+                self.rows.popleft()
+                self._times.popleft()
+
+    def frame(self):
+        return pd.DataFrame(list(self.rows))
+
+    def weights(self):
+        """Exponential recency weights (newest = 1, halving every half_life essays), or None when unweighted."""
+        if not self.half_life:
+            return None
+        age = np.arange(len(self.rows) - 1, -1, -1, dtype=float)
+        return 0.5 ** (age / self.half_life)
+
+    def summary(self):
+        return {'essays': len(self.rows), 'history': self.seen, 'max_essays': self.max_essays,
+                'max_days': self.max_days, 'half_life': self.half_life}
+
+def nan_weighted_mean(values, weights=None):
+    """
+    Per-metric mean over the essay axis (values: (..., essays, metrics), weights: (..., essays)).
+    NaN scores are skipped and each column is normalised by its own present weights,
+    like DataFrame.mean(); a column without any value is NaN. weights=None = equal weights.
+    """
+    values = np.asarray(values, dtype=float)
+    present = ~np.isnan(values)
+    w = np.ones(values.shape[:-1]) if weights is None else np.asarray(weights, dtype=float)
+    w = np.where(present, w[..., None], 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (w * np.where(present, values, 0.0)).sum(axis=-2) / w.sum(axis=-2)
+
+@tracing.traced()
+def perform_ml_analysis(df, bootstrap=None, window=None):
     """
     使用隨機森林分析 AI 生成的數值
+    bootstrap: 重抽樣次數 (預設 RCA_BOOTSTRAP)；> 0 時加上 BI_CI_Low / BI_CI_High / Rank_Stability 欄位
+    window: EssayWindow (預設依 RCA_WINDOW_* 由整個 df 重新建立)；只擬合視窗內的文章，並以近期權重作為 sample_weight
     """
+    window = window or EssayWindow.from_frame(df)
+    df = window.frame()
+    weights = window.weights()
     features = list(TASK1_METRICS.keys())
     
     # 確保所有特徵都存在
@@ -479,13 +1375,15 @@ def perform_ml_analysis(df):
     X_scaled = scaler.fit_transform(X)
 
     model = RandomForestRegressor(n_estimators=100, random_state=42)
-    model.fit(X_scaled, y)
+    with arena_metrics.RF_FIT_SECONDS.time(), tracing.span('rf_fit', rows=len(df), features=len(available_features)):
+        model.fit(X_scaled, y, sample_weight=weights)
 
-    # 計算每個指標的平均分數 (代表 User 現況)
-    avg_scores = df[available_features].mean()
+    # 計算每個指標的 (近期加權) 平均分數 (代表 User 現況)
+    avg_scores = pd.Series(nan_weighted_mean(df[available_features].to_numpy(dtype=float), weights),
+                           index=available_features)
 
-    # 計算 Bottleneck Index = Importance * (1 - Score)
-    # 邏輯: 越重要且分數越低，越是瓶頸
+    # 計算 Bottleneck Index = Importance * (1 - Score) * Reliability
+    # 邏輯: 越重要且分數越低，越是瓶頸；集成評分變異數大的指標 (評分本身不穩定) 降權
     
     rca_data = []
     importances = model.feature_importances_
@@ -493,24 +1391,98 @@ def perform_ml_analysis(df):
     for i, feature in enumerate(available_features):
         imp = importances[i]
         score = avg_scores[feature]
-        bottleneck_idx = imp * (1.0 - score)
+        var_col = f"{VARIANCE_PREFIX}{feature}"
+        variance = df[var_col].mean() if var_col in df.columns else np.nan  # 變異數只用於降權，不需加權
+        variance = 0.0 if pd.isna(variance) else float(variance)
+        reliability = 1.0 / (1.0 + variance / SCORE_VARIANCE_REF)
+        bottleneck_idx = imp * (1.0 - score) * reliability
         
         rca_data.append({
             'Metric': feature,
             'Metric_Name': TASK1_METRICS.get(feature, feature),
             'Impact_Weight': imp,
             'Avg_Score': score,
+            'Score_Variance': variance,
+            'Reliability': reliability,
             'Bottleneck_Index': bottleneck_idx
         })
 
-    rca_df = pd.DataFrame(rca_data).sort_values(by='Bottleneck_Index', ascending=False)
+    rca_df = pd.DataFrame(rca_data)
+
+    bootstrap = RCA_BOOTSTRAP if bootstrap is None else bootstrap
+    if bootstrap > 0:
+        start = time.perf_counter()
+        with tracing.span('rca_bootstrap', requested=bootstrap):
+            boot = bootstrap_bottlenecks(df[available_features].to_numpy(dtype=float), X_scaled, y.to_numpy(dtype=float),
+                                         rca_df['Reliability'].to_numpy(), bootstrap, weights=weights)
+        elapsed = time.perf_counter() - start
+        if len(boot) >= RCA_BOOTSTRAP_MIN:
+            # 稀疏指標在少數重抽樣中可能完全沒有分數 (NaN)，略過那些重抽樣
+            low, high = np.nanpercentile(boot, [50 * (1 - RCA_BOOTSTRAP_CI), 50 * (1 + RCA_BOOTSTRAP_CI)], axis=0)
+            # 排名穩定度: 重抽樣中名次與點估計相差不超過 1 的比例
+            point_rank = (-rca_df['Bottleneck_Index'].to_numpy()).argsort().argsort()
+            boot_rank = (-boot).argsort(axis=1).argsort(axis=1)
+            rca_df['BI_CI_Low'] = low
+            rca_df['BI_CI_High'] = high
+            rca_df['Rank_Stability'] = (np.abs(boot_rank - point_rank) <= 1).mean(axis=0)
+        else:
+            print(f"[RCA] ⚠️ 時間預算內只完成 {len(boot)} 次重抽樣 (< {RCA_BOOTSTRAP_MIN})，略過信賴區間")
+        rca_df.attrs['bootstrap'] = {'requested': bootstrap, 'resamples': len(boot),
+                                     'seconds': round(elapsed, 2), 'ci': RCA_BOOTSTRAP_CI}
 
+    rca_df = rca_df.sort_values(by='Bottleneck_Index', ascending=False)
+    rca_df.attrs['window'] = window.summary()
     return rca_df
 
-def plot_results(rca_df, df, recommendations, rca_prev_df=None):
+# 重抽樣擬合在執行緒中並行 (sklearn 建樹時釋放 GIL)
+_BOOTSTRAP_POOL = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="rca-bootstrap")
+
+def bootstrap_bottlenecks(X_raw, X_scaled, y, reliability, resamples, budget=None, seed=42, weights=None):
+    """
+    Refit the forest on `resamples` bootstrap resamples of the essays in parallel until
+    RCA_BOOTSTRAP_BUDGET runs out. All resample indices and their (weighted) average
+    scores are drawn/computed in one vectorised step. Returns a (completed, n_metrics)
+    array of bottleneck indices (resamples not finished within the budget are dropped).
+    """
+    budget = RCA_BOOTSTRAP_BUDGET if budget is None else budget
+    rng = np.random.default_rng(seed)
+    idx = rng.integers(0, len(y), size=(resamples, len(y)))
+    w = np.ones(len(y)) if weights is None else np.asarray(weights)
+    avg = nan_weighted_mean(X_raw[idx], w[idx])  # (resamples, n_metrics)
+
+    def fit(b):
+        model = RandomForestRegressor(n_estimators=RCA_BOOTSTRAP_TREES, random_state=b)
+        model.fit(X_scaled[idx[b]], y[idx[b]], sample_weight=None if weights is None else w[idx[b]])
+        return b, model.feature_importances_
+
+    importances = np.full(avg.shape, np.nan)
+    futures = [_BOOTSTRAP_POOL.submit(fit, b) for b in range(resamples)]
+    try:
+        for future in as_completed(futures, timeout=budget):
+            b, importance = future.result()
+            importances[b] = importance
+    except FuturesTimeout:
+        pass
+    finally:
+        for future in futures:
+            future.cancel()  # 尚未開始的重抽樣不再執行
+    done = ~np.isnan(importances).any(axis=1)
+    return importances[done] * (1.0 - avg[done]) * reliability
+
+@tracing.traced()
+def plot_results(rca_df, df, recommendations, rca_prev_df=None, image_file=REPORT_IMAGE_FILE,
+                 text_file=REPORT_TEXT_FILE):
     """
     繪製分析圖表並包含摘要報告
+    image_file: 圖片路徑或可寫入的 file object (例如 BytesIO)；text_file=None 時不寫純文字報告
+    recommendations=None: 第四格不放建議內文，只指向文字報告 (CLI 流程中圖表不隨建議重新繪製)
     """
+    with arena_metrics.CHART_RENDER_SECONDS.time():
+        _plot_results(rca_df, df, recommendations, rca_prev_df, image_file)
+    if text_file is not None:
+        write_text_report(rca_df, df, recommendations, text_file)
+
+def _plot_results(rca_df, df, recommendations, rca_prev_df=None, image_file=REPORT_IMAGE_FILE):
     fig = plt.figure(figsize=(16, 12))
     
     # 設定字體以支援中文 (如果可用)
@@ -523,6 +1495,12 @@ def plot_results(rca_df, df, recommendations, rca_prev_df=None):
     if rca_df is not None:
         colors = plt.cm.magma(np.linspace(0.8, 0.2, len(rca_df)))
         bars = ax1.barh(rca_df['Metric_Name'], rca_df['Bottleneck_Index'], color=colors, label='Current')
+        if 'BI_CI_Low' in rca_df.columns:
+            # Bootstrap 信賴區間 (區間重疊的指標之間排名並不可靠)
+            ci = np.vstack([rca_df['Bottleneck_Index'] - rca_df['BI_CI_Low'],
+                            rca_df['BI_CI_High'] - rca_df['Bottleneck_Index']]).clip(min=0)
+            ax1.errorbar(rca_df['Bottleneck_Index'], range(len(rca_df)), xerr=ci, fmt='none', ecolor='gray',
+                         elinewidth=1, capsize=3, label=f"{RCA_BOOTSTRAP_CI:.0%} CI")
         
         # New: Plot previous state marker if available
         if rca_prev_df is not None:
@@ -604,7 +1582,10 @@ def plot_results(rca_df, df, recommendations, rca_prev_df=None):
     ax4.axis('off')
     
     # Format recommendation text (use English placeholder if Chinese fails)
-    report_text = recommendations if recommendations else "No data available for recommendations"
+    if recommendations is None:
+        report_text = f"See {REPORT_TEXT_FILE} for the AI recommendations."
+    else:
+        report_text = recommendations if recommendations else "No data available for recommendations"
     
     # --- Fix for missing glyphs in Matplotlib fonts ---
     # Replace common problematic characters that triggers UserWarnings or empty boxes
@@ -642,17 +1623,20 @@ def plot_results(rca_df, df, recommendations, rca_prev_df=None):
              verticalalignment='top', wrap=True)
 
     plt.tight_layout()
-    plt.savefig('ielts_task1_report.png', dpi=150, bbox_inches='tight')
-    print("\n[系統] 報告已儲存: ielts_task1_report.png")
-    
-    # 同時儲存純文字報告
-    with open('ielts_task1_report.txt', 'w', encoding='utf-8') as f:
+    plt.savefig(image_file, format='png', dpi=150, bbox_inches='tight')
+    plt.close(fig)
+    if isinstance(image_file, str):
+        print(f"\n[系統] 報告已儲存: {image_file}")
+
+def write_text_report(rca_df, df, recommendations, text_file=REPORT_TEXT_FILE):
+    """純文字報告: 分數統計、RCA 瓶頸表與 AI 建議"""
+    with open(text_file, 'w', encoding='utf-8') as f:
         f.write("=" * 60 + "\n")
         f.write("IELTS Writing Task 1 RCA Analysis Report\n")
         f.write("=" * 60 + "\n\n")
         
         f.write("--- 分數統計 ---\n")
-        f.write(df.drop(columns=['file_name'], errors='ignore').describe().loc[['mean', 'min', 'max']].to_string())
+        f.write(df.drop(columns=non_score_columns(df)).describe().loc[['mean', 'min', 'max']].to_string())
         f.write("\n\n")
         
         if rca_df is not None:
@@ -664,7 +1648,7 @@ def plot_results(rca_df, df, recommendations, rca_prev_df=None):
         f.write(recommendations if recommendations else "尚無足夠資料生成建議")
         f.write("\n")
     
-    print("[系統] 文字報告已儲存: ielts_task1_report.txt")
+    print(f"[系統] 文字報告已儲存: {text_file}")
 
 def validate_cache_entry(entry):
     """
@@ -673,28 +1657,386 @@ def validate_cache_entry(entry):
     """
     if not entry:
         return False
-    required_keys = TASK1_METRICS.keys()
-    for k in required_keys:
-        if k not in entry:
-            return False
-    return True
+    return not stale_metrics(entry)
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 🧩 STAGE PIPELINE (memoised DAG for the CLI flow)
+# ═══════════════════════════════════════════════════════════════════════════
+# 每個階段 (stage) 有名稱、上游依賴與「輸入指紋」。指紋 = 階段程式碼 + 相關函式原始碼
+# + 上游輸出內容 + 額外設定 (例如 provider)。指紋未變時直接讀取 .rca_pipeline_cache，
+# 因此只修改建議的 prompt 時，不會重新訓練模型，也不會重新繪製圖表 (建議只寫入 text_report)。
+
+class PipelineHalt(Exception):
+    """Raised by a stage to stop the pipeline with a user-facing message."""
+
+
+class Stage:
+    """
+    A named pipeline step.
+    - deps: upstream stage names, passed positionally to `run(ctx, *dep_values)`
+    - sources: functions whose source code is part of the fingerprint
+    - extra: optional callable(ctx) returning extra fingerprint material
+    - memoize: persist the output to PIPELINE_CACHE_DIR and reuse it when inputs are unchanged
+    - outputs: files that must still exist for a memoised result to be reused
+    """
+    def __init__(self, name, run, deps=(), sources=(), extra=None, memoize=True, outputs=()):
+        self.name = name
+        self.run = run
+        self.deps = tuple(deps)
+        self.sources = tuple(sources)
+        self.extra = extra
+        self.memoize = memoize
+        self.outputs = tuple(outputs)
+
+    def fingerprint(self, ctx, dep_fingerprints):
+        h = hashlib.md5(self.name.encode('utf-8'))
+        for fn in (self.run,) + self.sources:
+            try:
+                h.update(inspect.getsource(fn).encode('utf-8'))
+            except (OSError, TypeError):
+                h.update(repr(fn).encode('utf-8'))
+        for fp in dep_fingerprints:
+            h.update(fp.encode('utf-8'))
+        if self.extra is not None:
+            h.update(_fingerprint_value(self.extra(ctx)).encode('utf-8'))
+        return h.hexdigest()
+
+
+def _fingerprint_value(value):
+    """Content hash of a stage output (DataFrames, dicts, lists, scalars)."""
+    h = hashlib.md5()
+    if isinstance(value, pd.DataFrame):
+        h.update(b'df')
+        h.update(json.dumps([str(c) for c in value.columns]).encode('utf-8'))
+        h.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+    elif isinstance(value, (list, tuple)):
+        h.update(b'seq')
+        for item in value:
+            h.update(_fingerprint_value(item).encode('utf-8'))
+    else:
+        h.update(json.dumps(value, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _memo_path(stage_name):
+    return os.path.join(PIPELINE_CACHE_DIR, f"{stage_name}.pkl")
+
+
+def _load_memo(stage, fingerprint):
+    path = _memo_path(stage.name)
+    if not os.path.exists(path):
+        return False, None
+    if any(not os.path.exists(p) for p in stage.outputs):
+        return False, None
+    try:
+        with open(path, 'rb') as f:
+            memo = pickle.load(f)
+    except Exception:
+        return False, None
+    if memo.get('fingerprint') != fingerprint:
+        return False, None
+    return True, memo.get('value')
+
+
+def _save_memo(stage, fingerprint, value):
+    os.makedirs(PIPELINE_CACHE_DIR, exist_ok=True)
+    tmp_path = _memo_path(stage.name) + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump({'fingerprint': fingerprint, 'value': value, 'saved_at': time.time()}, f)
+    os.replace(tmp_path, _memo_path(stage.name))
+
+
+def run_pipeline(stages, ctx, targets, force=()):
+    """
+    Resolve `targets` (and their upstream stages) in dependency order.
+    Stages listed in `force` always execute; everything else is reused from the
+    memo when its fingerprint is unchanged.
+    """
+    stage_map = {s.name: s for s in stages}
+    values = {}
+    fingerprints = {}
+
+    def resolve(name):
+        if name in values:
+            return
+        stage = stage_map[name]
+        for dep in stage.deps:
+            resolve(dep)
+
+        fp = stage.fingerprint(ctx, [fingerprints[d] for d in stage.deps])
+        hit = False
+        if stage.memoize and name not in force:
+            hit, value = _load_memo(stage, fp)
+        if hit:
+            print(f"[Pipeline] ⏭️  {name}: 輸入未變更，使用記憶化結果")
+        else:
+            started = time.time()
+            value = stage.run(ctx, *[values[d] for d in stage.deps])
+            # 因預算等原因降級的輸出不記憶化，下次執行會重新嘗試
+            if stage.memoize and name not in ctx.get('degraded', ()):
+                _save_memo(stage, fp, value)
+                print(f"[Pipeline] ✅ {name}: 完成 ({time.time() - started:.2f}s)")
+
+        values[name] = value
+        fingerprints[name] = _fingerprint_value(value) if value is not None else fp
+
+    try:
+        for name in targets:
+            resolve(name)
+    except PipelineHalt as e:
+        print(str(e))
+    return values
+
+
+def downstream_stages(stages, start):
+    """`start` plus every stage that transitively depends on it, in pipeline order."""
+    selected = {start}
+    ordered = []
+    for stage in stages:
+        if stage.name == start or selected.intersection(stage.deps):
+            selected.add(stage.name)
+            ordered.append(stage.name)
+    return ordered
+
+
+def _stage_score(ctx):
+    """讀取快取或呼叫 AI 評分，回傳 scored_data (list of dict)"""
+    essays_list = ctx['essays']
+    force_refresh = ctx['force_refresh']
+    allow_llm = ctx['allow_llm']
+
+    score_cache = load_cache()
+    if allow_llm:
+        print(f"[系統] 偵測到 {len(essays_list)} 篇文章，開始 AI 量化評分 (Task 1 標準)...")
+        if force_refresh:
+            # 只略過快取查找；其他文章的既有評分仍保留在快取中
+            print("[設定] 強制刷新模式: 忽略現有快取")
+
+    scored_data = []
+    for item in essays_list:
+        file_name = item['file_name']
+        content = item['content']
+
+        if allow_llm:
+            # 同步 API (或其他程序) 剛寫入的評分，避免重複付費評分同一篇
+            score_cache.refresh()
+
+        # Unified cache lookup (supports both hash and filename)
+        cached_entry, cache_key = find_in_cache(score_cache, file_name, content)
+
+        use_cache = False
+        if cached_entry and not force_refresh:
+            if validate_cache_entry(cached_entry):
+                use_cache = True
+            elif allow_llm:
+                # Rubric 更新: 只補評缺少/變更的指標，而不是整篇重新評分
+                print(f"  [Cache] 發現舊版資料 '{file_name}' (缺少新指標)，嘗試部分補評...")
+                cached_entry = complete_cache_entry(cached_entry, content)
+                if cached_entry:
+                    use_cache = True
+                    score_cache.put(get_content_hash(content), cached_entry, file_name=file_name)
+                    save_cache(score_cache)
+                else:
+                    print(f"  [Cache] 無法部分補評 '{file_name}'，將重新評分...")
+
+        scores = None
+        if use_cache:
+            if allow_llm:
+                print(f"  [Cache] 🚀 快取命中: {file_name}")
+            scores = with_score_variance(strip_cache_meta(cached_entry), cached_entry)
+        elif allow_llm:
+            print(f"  > 正在分析: {file_name}...")
+            try:
+                scores = get_ai_scores(content)
+            except BudgetExceeded as e:
+                # 停止新評分，但已評分 (及快取中) 的文章仍繼續分析
+                print(f"  [預算] ⚠️ {e}，停止新評分")
+                allow_llm = False
+                continue
+            if scores and is_cacheable_scores(scores):
+                # One record per content hash; the file name is stored as an alias
+                score_cache.put(get_content_hash(content), scores, file_name=file_name)
+                save_cache(score_cache)
+                rate_limit_pause(1) # 速率限制保護
+            if scores:
+                scores = with_score_variance(strip_cache_meta(scores), scores)
+
+        if scores:
+            scores['file_name'] = file_name
+            if item.get('modified') is not None:
+                scores[ESSAY_TIME_COLUMN] = item['modified']
+            scored_data.append(with_text_features(scores, content))
+
+    if allow_llm:
+        print("[系統] 評分完成。")
+    return scored_data
+
+
+def _stage_dataframe(ctx, scored_data):
+    if not scored_data:
+        raise PipelineHalt("[錯誤] 無有效評分資料可供分析。請先執行評分模式。")
+    return pd.DataFrame(scored_data)
+
+
+def _stage_rca(ctx, df):
+    """兩次隨機森林擬合: 全部文章 & 排除最新一篇 (before state)"""
+    rca_prev_results = None
+    if len(df) > 2:
+        # Calculate RCA excluding the latest essay to see the "before" state
+        rca_prev_results = perform_ml_analysis(df.iloc[:-1])
+
+    rca_results = perform_ml_analysis(df)
+    if rca_results is not None and rca_results.attrs['window']['essays'] < len(df):
+        info = rca_results.attrs['window']
+        print(f"[RCA] 視窗: 最近 {info['essays']}/{info['history']} 篇文章")
+    if rca_results is not None and 'bootstrap' in rca_results.attrs:
+        info = rca_results.attrs['bootstrap']
+        print(f"[RCA] Bootstrap: {info['resamples']}/{info['requested']} 次重抽樣 ({info['seconds']}s)")
+    return rca_results, rca_prev_results
+
+
+def _stage_summary(ctx, df, rca):
+    rca_results, _ = rca
+    print("\n--- AI 量化分析摘要 (Task 1) ---")
+    display_cols = [c for c in df.columns if c not in non_score_columns(df)]
+    print(df[display_cols].describe().loc[['mean', 'min', 'max']])
+
+    if rca_results is not None:
+        print("\n--- 隨機森林 RCA 診斷 ---")
+        print(rca_results.to_string(index=False))
+
+        top_driver = rca_results.iloc[0]['Metric_Name']
+        print(f"\n[診斷核心]: 你的總分波動主要受 '{top_driver}' 驅動。")
+        print(f"這意味著 '{top_driver}' 是你目前最需要改善的瓶頸 (高重要性但表現不佳)。")
+    else:
+        print("\n[提示] 目前文章數量過少，機器學習診斷精確度受限。請上傳更多文章以獲取深入 RCA 分析。")
+
+
+def _stage_recommendations(ctx, df, rca):
+    rca_results, _ = rca
+    print("\n[系統] 正在生成個人化學習建議...")
+    recommendations = get_ai_recommendations(rca_results, df)
+    if recommendations == BUDGET_SKIPPED_RECOMMENDATIONS:
+        ctx.setdefault('degraded', set()).add('recommendations')
+
+    print("\n--- AI 學習建議 ---")
+    print(recommendations)
+    return recommendations
+
+
+def _stage_detailed_report(ctx, df, rca):
+    rca_results, _ = rca
+    if rca_results is None:
+        return None
+    report = generate_detailed_rca_report(rca_results, df, ctx['essays'])
+    if not token_ledger.get_ledger().allows('deep_dive'):
+        # 報告可能被略過或只完成一部分
+        ctx.setdefault('degraded', set()).add('detailed_report')
+    return report
+
+
+def _stage_plot(ctx, df, rca):
+    """RCA 圖表 (不含建議內文)，只在資料或 RCA 改變時重新繪製"""
+    rca_results, rca_prev_results = rca
+    plot_results(rca_results, df, None, rca_prev_results, text_file=None)
+    return None
+
+
+def _stage_text_report(ctx, df, rca, recommendations):
+    rca_results, _ = rca
+    write_text_report(rca_results, df, recommendations)
+    return None
+
+
+def _stage_progress(ctx, df, rca):
+    rca_results, _ = rca
+    if rca_results is not None:
+        analyze_latest_progress(rca_results, df)
+
+
+def _essays_fingerprint(ctx):
+    return [get_content_hash(e['content']) + e['file_name'] for e in ctx['essays']]
+
+
+def build_pipeline():
+    """CLI 分析流程: score → dataframe → rca → summary / recommendations → detailed_report → plot / text_report → progress"""
+    llm_extra = lambda ctx: CURRENT_PROVIDER
+    return [
+        Stage('score', _stage_score, memoize=False),
+        Stage('dataframe', _stage_dataframe, deps=('score',), memoize=False),
+        Stage('rca', _stage_rca, deps=('dataframe',), sources=(perform_ml_analysis, nan_weighted_mean, bootstrap_bottlenecks, EssayWindow),
+              extra=lambda ctx: [RCA_BOOTSTRAP, RCA_WINDOW_ESSAYS, RCA_WINDOW_DAYS, RCA_HALF_LIFE]),
+        Stage('summary', _stage_summary, deps=('dataframe', 'rca'), memoize=False),
+        Stage('recommendations', _stage_recommendations, deps=('dataframe', 'rca'),
+              sources=(get_ai_recommendations,), extra=llm_extra),
+        Stage('detailed_report', _stage_detailed_report, deps=('dataframe', 'rca'),
+              sources=(generate_detailed_rca_report,),
+              extra=lambda ctx: [CURRENT_PROVIDER, _essays_fingerprint(ctx)],
+              outputs=(DETAILED_REPORT_FILE,)),
+        Stage('plot', _stage_plot, deps=('dataframe', 'rca'),
+              sources=(plot_results, _plot_results), outputs=(REPORT_IMAGE_FILE,)),
+        Stage('text_report', _stage_text_report, deps=('dataframe', 'rca', 'recommendations'),
+              sources=(write_text_report,), outputs=(REPORT_TEXT_FILE,)),
+        Stage('progress', _stage_progress, deps=('dataframe', 'rca'), memoize=False),
+    ]
+
 
 if __name__ == "__main__":
+    pipeline = build_pipeline()
+    stage_names = [s.name for s in pipeline]
+
     parser = argparse.ArgumentParser(description="IELTS Task 1 RCA Analyzer")
-    parser.add_argument('--mode', type=str, choices=['all', 'score', 'report'], default='all', help='Execution mode')
-    parser.add_argument('--provider', type=str, choices=['kimi', 'gemini'], default=DEFAULT_PROVIDER, help='AI Provider (kimi or gemini)')
+    parser.add_argument('--mode', type=str, choices=['all', 'score', 'report', 'usage', 'train-local-scorer', 'cohort'], default='all',
+                        help='Execution mode (usage: token spend summary; train-local-scorer: fit the local model on cached LLM scores; '
+                             'cohort: class-level RCA over --cohort-dir)')
+    parser.add_argument('--provider', type=str, choices=['kimi', 'gemini', 'fake', 'local', 'hybrid'], default=DEFAULT_PROVIDER,
+                        help='AI Provider (kimi, gemini, fake for offline load tests, local model only, or hybrid local + LLM)')
+    parser.add_argument('--ensemble', type=str, default=','.join(SCORING_ENSEMBLE),
+                        help="Comma-separated providers that score each essay in parallel, e.g. kimi,gemini,kimi (median per metric)")
+    parser.add_argument('--bootstrap', type=int, default=RCA_BOOTSTRAP,
+                        help='Bootstrap resamples for Bottleneck_Index confidence intervals (0 = off, capped by RCA_BOOTSTRAP_BUDGET seconds)')
+    parser.add_argument('--window', type=int, default=RCA_WINDOW_ESSAYS, help='RCA fits on the last N essays only (0 = all)')
+    parser.add_argument('--window-days', type=float, default=RCA_WINDOW_DAYS, help='RCA fits on essays from the last D days only (0 = no limit)')
+    parser.add_argument('--half-life', type=float, default=RCA_HALF_LIFE,
+                        help='Recency weighting half-life in essays for the RCA fit (0 = equal weights)')
+    parser.add_argument('--cohort-dir', type=str, default=COHORT_FOLDER, help='Folder with one sub-folder of essays per student (--mode cohort)')
     parser.add_argument('--file', type=str, help='Specific file to analyze (optional)')
     parser.add_argument('--force-refresh', action='store_true', help='Ignore cache and re-score')
-    
+    parser.add_argument('--only', type=str, help=f"Comma-separated stages to (re)run: {', '.join(stage_names)}")
+    parser.add_argument('--from', dest='from_stage', type=str, choices=stage_names, help='Rerun this stage and everything downstream of it')
+    parser.add_argument('--student', type=str, default=os.environ.get('STUDENT_ID', 'local'), help='Student id for token accounting / budgets')
+    parser.add_argument('--days', type=int, default=1, help='Days to include in --mode usage')
+    parser.add_argument('--profile', nargs='?', const='sample', choices=['sample', 'cprofile'],
+                        help='Profile the run (sample: collapsed stacks for flamegraphs, cprofile: .prof) into profiles/')
+
     args = parser.parse_args()
 
+    if args.mode == 'usage':
+        token_ledger.print_summary(token_ledger.get_ledger().summary(days=args.days))
+        sys.exit()
+
+    if args.mode == 'train-local-scorer':
+        train_local_scorer()
+        sys.exit()
+
+    if args.mode == 'cohort':
+        cohort_report(args.cohort_dir)
+        sys.exit()
+
+    token_ledger.set_context(endpoint=f"cli:{args.mode}", student=args.student)
+
     # Set Global Provider
     CURRENT_PROVIDER = args.provider
+    SCORING_ENSEMBLE = [p.strip() for p in args.ensemble.split(',') if p.strip()]
+    RCA_BOOTSTRAP = args.bootstrap
+    RCA_WINDOW_ESSAYS, RCA_WINDOW_DAYS, RCA_HALF_LIFE = args.window, args.window_days, args.half_life
     if CURRENT_PROVIDER == 'gemini' and not gemini_api_key:
         print("[警告] 尚未設定 GEMINI_API_KEY 環境變數。請設定後再試，或使用 --provider kimi。")
         # Fallback? No, let user decide.
     
     print(f"[系統] 目前使用 AI 模型: {CURRENT_PROVIDER.upper()}")
+    if len(SCORING_ENSEMBLE) > 1:
+        print(f"[系統] 集成評分: {', '.join(SCORING_ENSEMBLE)} ({SCORING_ENSEMBLE_AGG})")
 
     # 1. 讀取使用者真實文章
     essays_list = load_user_essays(ESSAY_FOLDER)
@@ -710,110 +2052,37 @@ if __name__ == "__main__":
             print(f"[錯誤] 找不到檔案: {args.file}")
             sys.exit()
 
-    # --- Mode: Score (or All) ---
-    if args.mode in ['all', 'score']:
-        print(f"[系統] 偵測到 {len(essays_list)} 篇文章，開始 AI 量化評分 (Task 1 標準)...")
-        
-        score_cache = load_cache()
-        if args.force_refresh:
-            print("[設定] 強制刷新模式: 忽略現有快取")
-            score_cache = {}
-            
-        scored_data = []
-        
-        for item in essays_list:
-            file_name = item['file_name']
-            content = item['content']
-            
-            # Unified cache lookup (supports both hash and filename)
-            cached_entry, cache_key = find_in_cache(score_cache, file_name, content)
-            
-            use_cache = False
-            if cached_entry and not args.force_refresh:
-                if validate_cache_entry(cached_entry):
-                    use_cache = True
-                else:
-                    print(f"  [Cache] 發現舊版資料 '{file_name}' (缺少新指標)，將重新評分...")
-
-            if use_cache:
-                print(f"  [Cache] 🚀 快取命中: {file_name}")
-                scores = cached_entry
-            else:
-                print(f"  > 正在分析: {file_name}...")
-                scores = get_ai_scores(content)
-                if scores:
-                    # Save under BOTH hash (for API compatibility) AND filename (for CLI backward compatibility)
-                    content_hash = get_content_hash(content)
-                    score_cache[content_hash] = scores  # Primary: hash-based
-                    score_cache[file_name] = scores     # Secondary: filename-based (legacy)
-                    save_cache(score_cache)
-                    time.sleep(1) # 速率限制保護
-            
-            if scores:
-                scores['file_name'] = file_name
-                scored_data.append(scores)
-        
-        if args.mode == 'score':
-            print("[系統] 評分完成。")
-            sys.exit()
-
-    # --- Mode: Report (or All) ---
-    if args.mode in ['all', 'report']:
-        # Reload cache to define scored_data if we skipped scoring block
-        if 'scored_data' not in locals():
-             score_cache = load_cache()
-             scored_data = []
-             for item in essays_list:
-                 # Use unified cache lookup
-                 cached_entry, _ = find_in_cache(score_cache, item['file_name'], item['content'])
-                 if cached_entry and validate_cache_entry(cached_entry):
-                     scores = cached_entry
-                     scores['file_name'] = item['file_name']
-                     scored_data.append(scores)
-
-        if scored_data:
-            df = pd.DataFrame(scored_data)
-            
-            # 2. 機器學習分析
-            # 2. 機器學習分析
-            rca_prev_results = None
-            if len(df) > 2:
-                # Calculate RCA excluding the latest essay to see the "before" state
-                rca_prev_results = perform_ml_analysis(df.iloc[:-1])
-
-            rca_results = perform_ml_analysis(df)
-            
-            print("\n--- AI 量化分析摘要 (Task 1) ---")
-            display_cols = [c for c in df.columns if c != 'file_name']
-            print(df[display_cols].describe().loc[['mean', 'min', 'max']])
-
-            if rca_results is not None:
-                print("\n--- 隨機森林 RCA 診斷 ---")
-                print(rca_results.to_string(index=False))
-                
-                top_driver = rca_results.iloc[0]['Metric_Name']
-                print(f"\n[診斷核心]: 你的總分波動主要受 '{top_driver}' 驅動。")
-                print(f"這意味著 '{top_driver}' 是你目前最需要改善的瓶頸 (高重要性但表現不佳)。")
-            else:
-                print("\n[提示] 目前文章數量過少，機器學習診斷精確度受限。請上傳更多文章以獲取深入 RCA 分析。")
-
-            # 3. 生成 AI 建議
-            print("\n[系統] 正在生成個人化學習建議...")
-            recommendations = get_ai_recommendations(rca_results, df)
-            
-            print("\n--- AI 學習建議 ---")
-            print(recommendations)
-
-            # 4. 生成詳細 RCA 診斷報告
-            if rca_results is not None:
-                 generate_detailed_rca_report(rca_results, df, essays_list)
+    # 2. 決定要執行的階段
+    force = set()
+    if args.only:
+        targets = [s.strip() for s in args.only.split(',') if s.strip()]
+        unknown = [s for s in targets if s not in stage_names]
+        if unknown:
+            parser.error(f"unknown stage(s) for --only: {', '.join(unknown)}")
+        force.update(targets)
+    elif args.from_stage:
+        targets = downstream_stages(pipeline, args.from_stage)
+        force.update(targets)
+    elif args.mode == 'score':
+        targets = ['score']
+    else:
+        targets = stage_names
 
-            # 5. 視覺化
-            # 5. 視覺化
-            plot_results(rca_results, df, recommendations, rca_prev_results)
+    ctx = {
+        'essays': essays_list,
+        'force_refresh': args.force_refresh,
+        # report 模式只讀取快取，不呼叫 AI 評分
+        'allow_llm': args.mode != 'report',
+    }
 
-            # 6. 最新成果驗收 (New Feature)
-            if rca_results is not None:
-                analyze_latest_progress(rca_results, df)
-        else:
-            print("[錯誤] 無有效評分資料可供分析。請先執行評分模式。")
+    if args.profile:
+        import arena_profiling
+        session = arena_profiling.ProfileSession(f"cli_{args.mode}", args.profile).start()
+        try:
+            run_pipeline(pipeline, ctx, targets, force=force)
+        finally:
+            path = session.stop()
+            print(f"\n[Profile] 🔬 剖析結果已儲存: {path}")
+            print(session.summary)
+    else:
+        run_pipeline(pipeline, ctx, targets, force=force)
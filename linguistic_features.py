@@ -0,0 +1,167 @@
+"""
+🔤 Linguistic Features - 確定性的語言特徵擷取 (不呼叫 LLM，每篇作文單次掃描)
+- 預先編譯的 regex 詞庫: 順序連接詞、被動語態 (be + 過去分詞)、流程動詞 (含屈折變化)、總述句
+- 斷句 / 分段後計算 feat_* 特徵，併入 RCA DataFrame
+- 由特徵推得四個「機械性」指標的分數，作為 get_ai_scores 的提示 (hint) 或直接預填 (prefill)，
+  讓 LLM 只需評其餘指標
+
+MECHANICAL_METRICS 的分數換算是人工校準的啟發式規則 (0.9 ≈ Band 9)，不是模型。
+"""
+
+import re
+
+MECHANICAL_METRICS = ('cc_sequencing_markers', 'gra_passive_voice', 'lr_process_verbs', 'cc_paragraphing')
+FEATURE_PREFIX = 'feat_'
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 📚 REGEX / WORD BANKS
+# ═══════════════════════════════════════════════════════════════════════════
+
+_SEQUENCERS = [
+    r"first(?:ly)?", r"second(?:ly)?", r"third(?:ly)?", r"to begin with", r"initially",
+    r"at the (?:beginning|start|outset)", r"in the (?:first|second|third|next|following|final|last) (?:stage|step|phase)",
+    r"next", r"then", r"after (?:that|this|which)", r"afterwards?", r"subsequently",
+    r"following (?:this|that)", r"once", r"as soon as", r"prior to", r"before (?:this|that|being)",
+    r"meanwhile", r"at the same time", r"simultaneously", r"eventually", r"finally", r"lastly",
+    r"in the end", r"ultimately",
+]
+SEQUENCER_RE = re.compile(r"\b(?:" + "|".join(_SEQUENCERS) + r")\b", re.IGNORECASE)
+
+_IRREGULAR_PARTICIPLES = (
+    "made built sent put cut kept left held brought bought caught taught fed led read set spread shut "
+    "sold told found ground laid paid split spun stuck struck swept hung dug bent bound burnt lit "
+    "frozen given taken shown driven known grown thrown drawn done seen chosen broken blown sewn sown "
+    "woven worn torn spoken stolen risen fallen beaten bitten hidden ridden written eaten shaken"
+).split()
+PASSIVE_RE = re.compile(
+    r"\b(?:am|is|are|was|were|be|been|being)\s+(?:\w+ly\s+)?(?:\w+ed|" + "|".join(_IRREGULAR_PARTICIPLES) + r")\b",
+    re.IGNORECASE)
+
+OVERVIEW_RE = re.compile(
+    r"\b(?:overall|in general|generally|it is (?:clear|evident|apparent)|it can be seen|in summary|to summari[sz]e|"
+    r"in total|altogether)\b", re.IGNORECASE)
+INTRO_RE = re.compile(
+    r"\b(?:the|this|given) (?:diagram|figure|picture|illustration|flow ?chart|process|chart)\b.{0,40}?"
+    r"\b(?:shows?|illustrates?|depicts?|describes?|explains?|presents?|demonstrates?|outlines?|gives?)\b",
+    re.IGNORECASE)
+REFERENCE_RE = re.compile(r"\b(?:this|these|it|its|they|their|which|the former|the latter|such)\b", re.IGNORECASE)
+
+SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?])\s+(?=[\"'(\[]?[A-Z0-9])")
+PARAGRAPH_SPLIT_RE = re.compile(r"\n\s*\n")
+WORD_RE = re.compile(r"[A-Za-z]+(?:'[a-z]+)?")
+
+_PROCESS_VERBS = (
+    "heat cool boil melt mix blend stir grind crush cut chop slice filter strain purify extract collect "
+    "gather harvest store transport deliver distribute pump pipe pour add combine separate sort clean wash "
+    "rinse dry bake roast cook ferment distil distill refine process package pack bottle seal ship load "
+    "unload transfer convert transform produce generate burn compress press shape mould mold cast form "
+    "spray soak drain evaporate condense recycle treat test inspect check weigh measure mine dig plant "
+    "grow fertilise fertilize irrigate feed release emit absorb channel freeze thaw sieve sift dissolve "
+    "pasteurise pasteurize cure smoke crystallise crystallize"
+).split()
+_IRREGULAR_FORMS = {
+    'cut': ['cut', 'cuts', 'cutting'], 'grind': ['ground'], 'feed': ['fed'], 'dig': ['dug', 'digging'],
+    'freeze': ['froze', 'frozen'], 'grow': ['grew', 'grown'], 'burn': ['burnt'], 'cast': ['cast'],
+    'ship': ['shipped', 'shipping'], 'stir': ['stirred', 'stirring'],
+}
+
+
+def _inflections(lemma):
+    forms = {lemma}
+    stem = lemma[:-1] if lemma.endswith('e') else lemma
+    forms.update({stem + 'ing', stem + 'ed' if not lemma.endswith('e') else lemma + 'd'})
+    if lemma.endswith(('s', 'sh', 'ch', 'x', 'z')):
+        forms.add(lemma + 'es')
+    elif lemma.endswith('y') and lemma[-2:-1] not in 'aeiou':
+        forms.update({lemma[:-1] + 'ies', lemma[:-1] + 'ied'})
+    else:
+        forms.add(lemma + 's')
+    forms.update(_IRREGULAR_FORMS.get(lemma, []))
+    return forms
+
+
+# inflected form -> lemma (single dict lookup per token)
+PROCESS_VERB_FORMS = {form: lemma for lemma in _PROCESS_VERBS for form in _inflections(lemma)}
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 🔍 EXTRACTION
+# ═══════════════════════════════════════════════════════════════════════════
+
+def split_sentences(text):
+    return [s for s in SENTENCE_SPLIT_RE.split(text.strip()) if s.strip()]
+
+
+def split_paragraphs(text):
+    return [p for p in PARAGRAPH_SPLIT_RE.split(text.strip()) if p.strip()]
+
+
+def extract_features(text):
+    """Deterministic feat_* signals for one essay (counts, ratios and 0/1 flags)."""
+    paragraphs = split_paragraphs(text)
+    sentences = [s for p in paragraphs for s in split_sentences(p)]
+    words = WORD_RE.findall(text)
+    n_words = len(words)
+    n_sentences = max(1, len(sentences))
+
+    sequencers = [m.group(0).lower() for m in SEQUENCER_RE.finditer(text)]
+    passive_sentences = sum(1 for s in sentences if PASSIVE_RE.search(s))
+    verbs = [PROCESS_VERB_FORMS[w] for w in (w.lower() for w in words) if w in PROCESS_VERB_FORMS]
+    para_words = [len(WORD_RE.findall(p)) for p in paragraphs] or [0]
+    overview_at = next((i for i, p in enumerate(paragraphs) if OVERVIEW_RE.search(p)), -1)
+
+    return {
+        'feat_word_count': n_words,
+        'feat_sentence_count': len(sentences),
+        'feat_paragraph_count': len(paragraphs),
+        'feat_avg_sentence_words': round(n_words / n_sentences, 2),
+        'feat_sequencer_count': len(sequencers),
+        'feat_sequencer_distinct': len(set(sequencers)),
+        'feat_sequencer_density': round(len(sequencers) / n_sentences, 3),
+        'feat_passive_count': len(PASSIVE_RE.findall(text)),
+        'feat_passive_sentence_ratio': round(passive_sentences / n_sentences, 3),
+        'feat_process_verb_count': len(verbs),
+        'feat_process_verb_distinct': len(set(verbs)),
+        'feat_reference_count': len(REFERENCE_RE.findall(text)),
+        'feat_has_intro': int(bool(paragraphs) and bool(INTRO_RE.search(paragraphs[0]))),
+        'feat_overview_paragraph': overview_at,
+        'feat_paragraph_balance': round(min(para_words) / max(max(para_words), 1), 3),
+    }
+
+
+def mechanical_scores(features):
+    """Heuristic 0-1 scores for MECHANICAL_METRICS from extract_features() output."""
+    def clip(value):
+        return round(min(0.95, max(0.2, value)), 2)
+
+    paragraphs = features['feat_paragraph_count']
+    paragraph_score = 0.3
+    paragraph_score += 0.2 if 3 <= paragraphs <= 5 else (0.1 if paragraphs in (2, 6) else 0.0)
+    paragraph_score += 0.2 * features['feat_has_intro']
+    paragraph_score += 0.2 if 0 <= features['feat_overview_paragraph'] <= 1 else (
+        0.1 if features['feat_overview_paragraph'] > 1 else 0.0)
+    paragraph_score += 0.1 if features['feat_paragraph_balance'] >= 0.25 else 0.0
+
+    return {
+        'cc_sequencing_markers': clip(0.35 + 0.08 * min(features['feat_sequencer_distinct'], 6)
+                                      + 0.1 * min(features['feat_sequencer_density'], 1.0)),
+        'gra_passive_voice': clip(0.35 + 0.6 * min(features['feat_passive_sentence_ratio'] / 0.5, 1.0)),
+        'lr_process_verbs': clip(0.35 + 0.05 * min(features['feat_process_verb_distinct'], 12)),
+        'cc_paragraphing': clip(paragraph_score),
+    }
+
+
+def format_hints(features, scores=None):
+    """Short 'measured signals' block appended to the scoring request (priors for the examiner)."""
+    lines = [
+        f"- paragraphs: {features['feat_paragraph_count']}, sentences: {features['feat_sentence_count']}, "
+        f"words: {features['feat_word_count']}",
+        f"- sequencing markers: {features['feat_sequencer_count']} ({features['feat_sequencer_distinct']} distinct)",
+        f"- sentences with passive voice: {features['feat_passive_sentence_ratio']:.0%}",
+        f"- distinct process verbs: {features['feat_process_verb_distinct']}",
+        f"- introduction paraphrase: {'yes' if features['feat_has_intro'] else 'no'}, "
+        f"overview paragraph: {features['feat_overview_paragraph'] + 1 if features['feat_overview_paragraph'] >= 0 else 'none'}",
+    ]
+    if scores:
+        lines.append("- heuristic priors: " + ", ".join(f"{m}={v}" for m, v in scores.items()))
+    return "Measured text signals (automatic, use as priors only):\n" + "\n".join(lines)
@@ -0,0 +1,273 @@
+"""
+🔀 LLM Router - 供應商路由、對沖請求 (hedging) 與斷路器
+- 依 (provider, task) 追蹤最近的延遲與錯誤率
+- 主要供應商超過其 p95 延遲仍未回應時，向備援供應商送出對沖請求；最先回傳有效結果者勝出，
+  其餘請求透過 cancel_event 取消
+- 主要供應商失敗時立即改用備援 (failover)
+- 連續失敗達門檻時斷路 (open)，冷卻後放行一次試探請求 (half-open)
+
+供應商呼叫本身由呼叫端提供 (attempt callable)，此模組不依賴 ielts_rca_analyzer。
+"""
+
+import os
+import time
+import threading
+import contextvars
+from collections import deque, defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import arena_metrics
+
+HEDGING_ENABLED = os.environ.get("LLM_HEDGING", "1") != "0"
+HEDGE_PEERS_SPEC = os.environ.get("LLM_HEDGE_PEERS", "kimi:gemini,gemini:kimi")  # 'primary:peer,...'
+HEDGE_DEFAULT_DELAY = float(os.environ.get("LLM_HEDGE_DEFAULT_DELAY", "15"))   # 樣本不足時的對沖等待秒數
+HEDGE_MIN_DELAY = float(os.environ.get("LLM_HEDGE_MIN_DELAY", "1"))
+HEDGE_MAX_DELAY = float(os.environ.get("LLM_HEDGE_MAX_DELAY", "60"))
+HEDGE_MIN_SAMPLES = 10           # 至少有這麼多成功樣本才使用 p95
+LATENCY_WINDOW = 100             # 每個 (provider, task) 保留的最近呼叫數
+DEADLINE_P99_MULTIPLIER = float(os.environ.get("LLM_DEADLINE_P99_MULTIPLIER", "2.0"))  # 自適應期限 = p99 × 倍數
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("LLM_CIRCUIT_FAILURES", "3"))
+CIRCUIT_COOLDOWN = float(os.environ.get("LLM_CIRCUIT_COOLDOWN", "30"))
+
+CIRCUIT_STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+
+def parse_peers(spec):
+    peers = {}
+    for pair in spec.split(','):
+        primary, _, peer = pair.partition(':')
+        if primary.strip() and peer.strip():
+            peers[primary.strip()] = peer.strip()
+    return peers
+
+
+class CircuitBreaker:
+    """closed → (N consecutive failures) → open → (cooldown) → half_open → one trial call."""
+
+    def __init__(self, provider, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, cooldown=CIRCUIT_COOLDOWN):
+        self.provider = provider
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state != self.state:
+            print(f"\n[Router] ⚡ {self.provider} 斷路器: {self.state} → {state}")
+        self.state = state
+        arena_metrics.LLM_CIRCUIT_STATE.set(CIRCUIT_STATES[state], provider=self.provider)
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.cooldown:
+                self._set_state('half_open')
+            if self.state == 'half_open' and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def is_open(self):
+        with self._lock:
+            return self.state == 'open' and time.monotonic() - self.opened_at < self.cooldown
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._trial_in_flight = False
+            self._set_state('closed')
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._set_state('open')
+
+
+class ProviderStats:
+    """Rolling latency (successful calls) and outcome window for one (provider, task)."""
+
+    def __init__(self):
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.outcomes = deque(maxlen=LATENCY_WINDOW)  # True = success
+        self._lock = threading.Lock()
+
+    def record(self, latency, ok):
+        with self._lock:
+            self.outcomes.append(ok)
+            if ok:
+                self.latencies.append(latency)
+
+    def percentile(self, q):
+        """q-th percentile (0-1) of recent successful latencies, None with too few samples."""
+        with self._lock:
+            if len(self.latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def p95(self):
+        return self.percentile(0.95)
+
+    def error_rate(self):
+        with self._lock:
+            return (1 - sum(self.outcomes) / len(self.outcomes)) if self.outcomes else 0.0
+
+
+class LinkedEvent:
+    """Read-only event that counts as set when any of `events` is set (attempt cancel + caller cancel)."""
+
+    def __init__(self, *events):
+        self.events = [e for e in events if e is not None]
+
+    def is_set(self):
+        return any(e.is_set() for e in self.events)
+
+    def wait(self, timeout=None):
+        end = None if timeout is None else time.monotonic() + timeout
+        while not self.is_set():
+            remaining = 0.05 if end is None else min(0.05, end - time.monotonic())
+            if remaining <= 0:
+                return False
+            self.events[0].wait(remaining)
+        return True
+
+
+class ProviderRouter:
+    """
+    Run an LLM call on its primary provider with hedging/failover to a peer.
+    `attempt(provider, cancel_event, hedged)` performs one call and returns the content
+    (falsy on failure); `is_valid(content)` decides whether a result can win.
+    A `caller_cancel` event (e.g. a disconnected stream client) stops every attempt,
+    with no hedging, failover or provider statistics for the cancelled call.
+    """
+
+    def __init__(self, peers=None, is_available=None, max_workers=16):
+        self.peers = parse_peers(HEDGE_PEERS_SPEC) if peers is None else peers
+        self.is_available = is_available or (lambda provider: True)
+        self.stats = defaultdict(ProviderStats)
+        self.breakers = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm-router")
+
+    def breaker(self, provider):
+        with self._lock:
+            if provider not in self.breakers:
+                self.breakers[provider] = CircuitBreaker(provider)
+            return self.breakers[provider]
+
+    def hedge_delay(self, provider, task):
+        p95 = self.stats[(provider, task)].p95()
+        if p95 is None:
+            return HEDGE_DEFAULT_DELAY
+        return min(max(p95, HEDGE_MIN_DELAY), HEDGE_MAX_DELAY)
+
+    def deadline(self, provider, task, floor, ceiling, multiplier=DEADLINE_P99_MULTIPLIER):
+        """
+        Adaptive per-call deadline: `multiplier` × observed p99, clamped to [floor, ceiling].
+        Falls back to the ceiling until enough samples exist.
+        """
+        p99 = self.stats[(provider, task)].percentile(0.99)
+        if p99 is None:
+            return ceiling
+        return min(max(p99 * multiplier, floor), ceiling)
+
+    def _usable_peer(self, provider):
+        peer = self.peers.get(provider) if HEDGING_ENABLED else None
+        if peer and self.is_available(peer) and not self.breaker(peer).is_open():
+            return peer
+        return None
+
+    def _launch(self, provider, task, attempt, hedged, running, caller_cancel=None):
+        cancel_event = threading.Event()
+        ctx = contextvars.copy_context()  # 保留 token 記帳的端點/學生等 context
+        started = time.perf_counter()
+        attempt_cancel = LinkedEvent(cancel_event, caller_cancel) if caller_cancel is not None else cancel_event
+        future = self._pool.submit(ctx.run, attempt, provider, attempt_cancel, hedged)
+        running[future] = (provider, cancel_event, started)
+        return future
+
+    def call(self, primary, task, attempt, is_valid=bool, caller_cancel=None):
+        """Return (content, provider) of the first valid result, or (None, primary)."""
+        cancelled = caller_cancel.is_set if caller_cancel is not None else (lambda: False)
+        if cancelled():
+            return None, primary
+        peer = self._usable_peer(primary)
+        if not self.breaker(primary).allow():
+            if peer is not None:
+                print(f"\n[Router] {primary} 斷路中，改用 {peer}")
+                arena_metrics.LLM_HEDGES.inc(primary=primary, peer=peer, reason='circuit_open')
+                primary, peer = peer, None
+            # 沒有可用的備援時仍嘗試主要供應商
+
+        running = {}
+        self._launch(primary, task, attempt, False, running, caller_cancel)
+        hedge_at = time.perf_counter() + self.hedge_delay(primary, task)
+        hedged = False
+        result = (None, primary)
+
+        while running:
+            timeout = None
+            if peer is not None and not hedged and not cancelled():
+                timeout = max(0.0, hedge_at - time.perf_counter())
+            done, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+
+            if not done and cancelled():
+                continue  # 等待進行中的請求察覺取消後結束
+            if not done:
+                # 主要供應商超過 p95：送出對沖請求
+                hedged = True
+                print(f"\n[Router] ⏱️ {primary} 超過 p95 ({self.hedge_delay(primary, task):.1f}s)，對沖至 {peer}")
+                arena_metrics.LLM_HEDGES.inc(primary=primary, peer=peer, reason='slow')
+                if self.breaker(peer).allow():
+                    self._launch(peer, task, attempt, True, running, caller_cancel)
+                continue
+
+            for future in done:
+                provider, cancel_event, started = running.pop(future)
+                latency = time.perf_counter() - started
+                try:
+                    content = future.result()
+                except Exception as e:
+                    print(f"\n[Router] {provider} 呼叫例外: {e}")
+                    content = None
+                if cancelled():
+                    continue  # 呼叫端取消：不計入統計與斷路器
+                ok = bool(content) and is_valid(content)
+                self.stats[(provider, task)].record(latency, ok)
+                if ok:
+                    self.breaker(provider).record_success()
+                    if result[0] is None:
+                        result = (content, provider)
+                        if hedged:
+                            arena_metrics.LLM_HEDGE_WINS.inc(provider=provider)
+                else:
+                    self.breaker(provider).record_failure()
+
+            if cancelled():
+                for provider, cancel_event, _ in running.values():
+                    cancel_event.set()
+                result = (None, primary)
+                break
+
+            if result[0] is not None:
+                # 勝出者已產生：取消其餘仍在執行的請求 (不計入統計)
+                for provider, cancel_event, _ in running.values():
+                    cancel_event.set()
+                break
+
+            if peer is not None and not hedged:
+                # 主要供應商失敗：立即改用備援
+                hedged = True
+                print(f"\n[Router] ❌ {primary} 失敗，改用 {peer}")
+                arena_metrics.LLM_HEDGES.inc(primary=primary, peer=peer, reason='failover')
+                if self.breaker(peer).allow():
+                    self._launch(peer, task, attempt, True, running, caller_cancel)
+
+        return result
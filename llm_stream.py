@@ -0,0 +1,149 @@
+"""
+🌊 LLM Stream Filters - 串流回應的即時處理
+- ThinkFilter         : 在串流過程中丟棄 <think>...</think> 推理區塊 (標籤可跨 chunk 切開)
+- JsonObjectDetector  : 偵測第一個完整且括號平衡的 JSON 物件，評分呼叫可在此提前關閉串流
+- StreamCollector     : 兩者的組合，供 Kimi / fake 串流迴圈使用
+"""
+
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+
+
+def _partial_tag_suffix(text, tag):
+    """Length of the longest suffix of `text` that is a proper prefix of `tag`."""
+    for k in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:k]):
+            return k
+    return 0
+
+
+class ThinkFilter:
+    """Stateful filter that returns only the text outside <think> blocks."""
+
+    def __init__(self):
+        self.inside = False
+        self._buffer = ""
+
+    def feed(self, chunk):
+        self._buffer += chunk
+        visible = []
+        while self._buffer:
+            if not self.inside:
+                idx = self._buffer.find(THINK_OPEN)
+                if idx >= 0:
+                    visible.append(self._buffer[:idx])
+                    self._buffer = self._buffer[idx + len(THINK_OPEN):]
+                    self.inside = True
+                    continue
+                keep = _partial_tag_suffix(self._buffer, THINK_OPEN)
+                visible.append(self._buffer[:len(self._buffer) - keep])
+                self._buffer = self._buffer[len(self._buffer) - keep:]
+                break
+            idx = self._buffer.find(THINK_CLOSE)
+            if idx >= 0:
+                self._buffer = self._buffer[idx + len(THINK_CLOSE):]
+                self.inside = False
+                continue
+            # 推理內容直接丟棄，只保留可能是結束標籤開頭的部分
+            keep = _partial_tag_suffix(self._buffer, THINK_CLOSE)
+            self._buffer = self._buffer[len(self._buffer) - keep:]
+            break
+        return "".join(visible)
+
+    def flush(self):
+        """Text held back as a possible tag prefix (returned only outside a think block)."""
+        rest, self._buffer = self._buffer, ""
+        return "" if self.inside else rest
+
+
+class JsonObjectDetector:
+    """
+    Track the first top-level JSON object in streamed text. feed() returns True once
+    its braces are balanced (strings and escapes respected); .text is the object and
+    .tail whatever followed it in the completing chunk.
+    """
+
+    def __init__(self):
+        self._parts = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self.started = False
+        self.complete = False
+        self.tail = ""
+
+    def feed(self, text):
+        if self.complete:
+            return True
+        for i, ch in enumerate(text):
+            if not self.started:
+                if ch != '{':
+                    continue
+                self.started = True
+            self._parts.append(ch)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == '{':
+                self._depth += 1
+            elif ch == '}':
+                self._depth -= 1
+                if self._depth == 0:
+                    self.complete = True
+                    self.tail = text[i + 1:]
+                    return True
+        return False
+
+    @property
+    def text(self):
+        return "".join(self._parts)
+
+
+class StreamCollector:
+    """
+    Combine both filters for one streamed reply: visible (non-reasoning) text is passed
+    to on_chunk and accumulated; with stop_at_json, feed() returns True as soon as the
+    first JSON object is complete so the caller can close the stream.
+    """
+
+    def __init__(self, on_chunk, stop_at_json=False):
+        self.on_chunk = on_chunk
+        self.think = ThinkFilter()
+        self.detector = JsonObjectDetector() if stop_at_json else None
+        self._parts = []
+
+    def _emit(self, visible):
+        if self.stopped_early:
+            return True  # 物件已完成: 之後 (或 finish() 時) 的文字都不再輸出
+        if not visible:
+            return False
+        done = self.detector is not None and self.detector.feed(visible)
+        if done and self.detector.tail:
+            visible = visible[:-len(self.detector.tail)]  # 物件之後的文字不再輸出
+        if visible:
+            self.on_chunk(visible)
+            self._parts.append(visible)
+        return done
+
+    def feed(self, chunk):
+        return self._emit(self.think.feed(chunk))
+
+    def finish(self):
+        self._emit(self.think.flush())
+        return self.text
+
+    @property
+    def stopped_early(self):
+        return self.detector is not None and self.detector.complete
+
+    @property
+    def text(self):
+        if self.stopped_early:
+            return self.detector.text
+        return "".join(self._parts)
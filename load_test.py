@@ -0,0 +1,375 @@
+"""
+🏋️ Load Test - Arena API 壓力測試 / 流量重播
+以指定 RPS (開放迴圈) 或併發數 (封閉迴圈) 對 arena_api.py 發送請求，
+依端點回報 p50/p95/p99 延遲、錯誤率與吞吐量。
+
+Usage:
+    # 自動在暫存資料夾啟動 API (fake provider)，避免污染真實快取與作文資料夾
+    python load_test.py --spawn --rps 20 --duration 60
+
+    # 對已在執行的服務，以 8 個併發使用者壓測
+    python load_test.py --url http://localhost:3000 --concurrency 8 --duration 30
+
+    # 自訂流量組成與 full-rca 歷史長度
+    python load_test.py --spawn --mix hit=0.6,new=0.3,rca=0.1 --history-lengths 5,20,50
+
+    # 重播錄製的流量 (API 以 ARENA_RECORD_TRAFFIC=traffic.jsonl 啟動時錄製)
+    python load_test.py --spawn --replay traffic.jsonl --rps 10
+
+合成與重播的請求一律改用 provider='fake' (除非 --keep-provider)，不會呼叫付費 API。
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import tempfile
+import argparse
+import threading
+import subprocess
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT_DIR)
+
+from benchmark_suite import SAMPLE_ESSAY, synthetic_scores
+
+METRIC_KEYS = [
+    'ta_overview_clarity', 'ta_step_coverage', 'ta_logic_accuracy',
+    'cc_sequencing_markers', 'cc_referencing', 'cc_paragraphing',
+    'lr_process_verbs', 'lr_topic_nouns', 'lr_paraphrasing', 'lr_conciseness',
+    'gra_passive_voice', 'gra_complex_structures', 'gra_error_free_density',
+]
+
+DEFAULT_MIX = "hit=0.6,new=0.3,rca=0.1"
+REQUEST_TIMEOUT = 120
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 🎲 REQUEST GENERATORS
+# ═══════════════════════════════════════════════════════════════════════════
+
+class SyntheticTraffic:
+    """
+    Produce (label, path, body) tuples following a weighted mix:
+    'hit' re-submits an essay the server has already scored, 'new' submits a
+    never-seen essay, 'rca' runs /api/full-rca with a random history length.
+    """
+
+    def __init__(self, mix, history_lengths, provider='fake', seed=0):
+        self.kinds = list(mix.keys())
+        self.weights = np.array([mix[k] for k in self.kinds], dtype=float)
+        self.weights /= self.weights.sum()
+        self.history_lengths = history_lengths
+        self.provider = provider
+        self.rng = random.Random(seed)
+        self.np_rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        self.counter = 0
+        self.run_id = f"{int(time.time())}-{os.getpid()}"
+
+    def warmup_requests(self):
+        """Requests that make sure the 'hit' essay is cached before measuring."""
+        return [('warmup', '/api/analyze', {"essay": SAMPLE_ESSAY, "provider": self.provider})]
+
+    def _new_essay(self):
+        self.counter += 1
+        return f"{SAMPLE_ESSAY}\nLoad test variant {self.run_id}-{self.counter}."
+
+    def next(self):
+        with self.lock:
+            kind = self.kinds[self.np_rng.choice(len(self.kinds), p=self.weights)]
+            if kind == 'hit':
+                return 'analyze_hit', '/api/analyze', {"essay": SAMPLE_ESSAY, "provider": self.provider}
+            if kind == 'new':
+                return 'analyze_new', '/api/analyze', {"essay": self._new_essay(), "provider": self.provider}
+            n = self.rng.choice(self.history_lengths)
+            history = [{"id": f"hist_{i}", "scores": synthetic_scores(self.np_rng, METRIC_KEYS)} for i in range(n)]
+            new_essay = SAMPLE_ESSAY if self.rng.random() < 0.5 else self._new_essay()
+            return f'full_rca_h{n}', '/api/full-rca', {"essays": history, "new_essay": new_essay, "provider": self.provider}
+
+
+class ReplayTraffic:
+    """Cycle through requests recorded by arena_api.py (ARENA_RECORD_TRAFFIC)."""
+
+    def __init__(self, path, provider='fake'):
+        self.records = []
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # 錄製中斷時最後一行可能不完整
+                if record.get('method') == 'POST' and isinstance(record.get('body'), dict):
+                    if provider:
+                        record['body']['provider'] = provider
+                    self.records.append(record)
+        if not self.records:
+            raise ValueError(f"No replayable POST requests in {path}")
+        self.index = 0
+        self.lock = threading.Lock()
+
+    def warmup_requests(self):
+        return []
+
+    def next(self):
+        with self.lock:
+            record = self.records[self.index % len(self.records)]
+            self.index += 1
+        path = record['path']
+        label = path.rsplit('/', 1)[-1]
+        if path.endswith('full-rca'):
+            label = f"full_rca_h{len(record['body'].get('essays', []))}"
+        return label, path, record['body']
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in ('hit', 'new', 'rca'):
+            raise argparse.ArgumentTypeError(f"Unknown traffic kind '{kind}' (use hit/new/rca)")
+        mix[kind] = float(weight)
+    if sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError("Mix weights must sum to > 0")
+    return mix
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 🚦 LOAD GENERATION
+# ═══════════════════════════════════════════════════════════════════════════
+
+class Recorder:
+    """Thread-safe per-endpoint latency/status collection."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)   # label -> [latency seconds]
+        self.errors = defaultdict(int)     # label -> count
+        self.error_kinds = defaultdict(int)
+        self.bytes = defaultdict(int)
+
+    def add(self, label, latency, ok, size=0, error_kind=None):
+        with self.lock:
+            self.samples[label].append(latency)
+            self.bytes[label] += size
+            if not ok:
+                self.errors[label] += 1
+                self.error_kinds[error_kind or 'unknown'] += 1
+
+
+_thread_local = threading.local()
+
+
+def _session():
+    if not hasattr(_thread_local, 'session'):
+        _thread_local.session = requests.Session()
+    return _thread_local.session
+
+
+def send(base_url, label, path, body, recorder, scheduled_at=None):
+    """
+    Send one request. For open-loop runs the latency is measured from the
+    scheduled send time so queueing inside the generator is not hidden
+    (coordinated omission).
+    """
+    start = scheduled_at if scheduled_at is not None else time.perf_counter()
+    try:
+        resp = _session().post(base_url + path, json=body, timeout=REQUEST_TIMEOUT)
+        latency = time.perf_counter() - start
+        ok = resp.status_code < 400
+        recorder.add(label, latency, ok, len(resp.content), None if ok else f"HTTP {resp.status_code}")
+    except requests.RequestException as e:
+        recorder.add(label, time.perf_counter() - start, False, 0, type(e).__name__)
+
+
+def run_open_loop(base_url, traffic, recorder, rps, duration, max_workers):
+    """Issue requests at a fixed arrival rate regardless of response times."""
+    interval = 1.0 / rps
+    total = int(rps * duration)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        t0 = time.perf_counter()
+        for i in range(total):
+            scheduled = t0 + i * interval
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            label, path, body = traffic.next()
+            pool.submit(send, base_url, label, path, body, recorder, scheduled)
+    return time.perf_counter() - t0
+
+
+def run_closed_loop(base_url, traffic, recorder, concurrency, duration):
+    """N virtual users each send the next request as soon as the previous returns."""
+    deadline = time.perf_counter() + duration
+
+    def user():
+        while time.perf_counter() < deadline:
+            label, path, body = traffic.next()
+            send(base_url, label, path, body, recorder)
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=user, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - t0
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 🖥️ SERVER MANAGEMENT
+# ═══════════════════════════════════════════════════════════════════════════
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def spawn_server(workdir, log_path):
+    """Start arena_api.py in `workdir` so caches, essays and charts stay out of the repo."""
+    port = _free_port()
+    env = dict(os.environ, PORT=str(port))
+    log = open(log_path, 'w', encoding='utf-8')
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, 'arena_api.py')],
+                            cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(300):
+        if proc.poll() is not None:
+            raise RuntimeError(f"API server exited early (see {log_path})")
+        try:
+            if requests.get(base_url + '/api/health', timeout=1).ok:
+                return proc, base_url
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError(f"API server did not become healthy (see {log_path})")
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 📊 REPORT
+# ═══════════════════════════════════════════════════════════════════════════
+
+def summarize(recorder, elapsed):
+    report = {"elapsed_s": elapsed, "endpoints": {}}
+    labels = sorted(recorder.samples)
+    all_latencies = []
+    total_errors = 0
+    for label in labels:
+        lat = np.array(recorder.samples[label])
+        all_latencies.extend(recorder.samples[label])
+        total_errors += recorder.errors[label]
+        report["endpoints"][label] = {
+            "count": int(len(lat)),
+            "errors": int(recorder.errors[label]),
+            "error_rate": float(recorder.errors[label] / len(lat)),
+            "throughput_rps": float(len(lat) / elapsed) if elapsed > 0 else 0.0,
+            "p50_ms": float(np.percentile(lat, 50) * 1000),
+            "p95_ms": float(np.percentile(lat, 95) * 1000),
+            "p99_ms": float(np.percentile(lat, 99) * 1000),
+            "max_ms": float(lat.max() * 1000),
+            "avg_bytes": float(recorder.bytes[label] / len(lat)),
+        }
+    if all_latencies:
+        lat = np.array(all_latencies)
+        report["total"] = {
+            "count": int(len(lat)),
+            "errors": int(total_errors),
+            "error_rate": float(total_errors / len(lat)),
+            "throughput_rps": float(len(lat) / elapsed) if elapsed > 0 else 0.0,
+            "p50_ms": float(np.percentile(lat, 50) * 1000),
+            "p95_ms": float(np.percentile(lat, 95) * 1000),
+            "p99_ms": float(np.percentile(lat, 99) * 1000),
+            "max_ms": float(lat.max() * 1000),
+        }
+    report["error_kinds"] = dict(recorder.error_kinds)
+    return report
+
+
+def print_report(report):
+    print(f"\n{'endpoint':<18} {'count':>7} {'err%':>6} {'rps':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    print("-" * 80)
+    rows = list(report["endpoints"].items())
+    if "total" in report:
+        rows.append(("TOTAL", report["total"]))
+    for label, s in rows:
+        print(f"{label:<18} {s['count']:>7} {s['error_rate'] * 100:>5.1f}% {s['throughput_rps']:>7.2f} "
+              f"{s['p50_ms']:>9.1f} {s['p95_ms']:>9.1f} {s['p99_ms']:>9.1f} {s['max_ms']:>9.1f}")
+    if report["error_kinds"]:
+        print(f"\n錯誤類型: {report['error_kinds']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Arena API load test / traffic replay")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--url', type=str, default='http://localhost:3000', help='Base URL of a running arena_api.py')
+    target.add_argument('--spawn', action='store_true', help='Start arena_api.py in a temporary folder for the run')
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument('--rps', type=float, help='Open-loop target requests per second')
+    load.add_argument('--concurrency', type=int, default=4, help='Closed-loop number of virtual users (default 4)')
+    parser.add_argument('--duration', type=float, default=30, help='Test duration in seconds')
+    parser.add_argument('--max-workers', type=int, default=64, help='Max in-flight requests for --rps mode')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f'Synthetic traffic mix (default {DEFAULT_MIX})')
+    parser.add_argument('--history-lengths', type=str, default='5,20,50', help='Comma-separated full-rca history sizes')
+    parser.add_argument('--replay', type=str, help='Replay a JSONL traffic recording instead of synthetic traffic')
+    parser.add_argument('--keep-provider', action='store_true', help='Keep the recorded/real provider instead of forcing fake')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, help='Write the summary as JSON')
+    args = parser.parse_args()
+
+    provider = None if args.keep_provider else 'fake'
+    if args.replay:
+        traffic = ReplayTraffic(args.replay, provider=provider)
+        print(f"[Load] 重播 {len(traffic.records)} 筆錄製請求 ({args.replay})")
+    else:
+        history_lengths = [int(x) for x in args.history_lengths.split(',') if x.strip()]
+        traffic = SyntheticTraffic(args.mix, history_lengths, provider=provider or 'kimi', seed=args.seed)
+        print(f"[Load] 合成流量 mix={args.mix} history={history_lengths}")
+
+    server = None
+    base_url = args.url
+    if args.spawn:
+        workdir = tempfile.mkdtemp(prefix="arena_load_")
+        server, base_url = spawn_server(workdir, os.path.join(workdir, 'server.log'))
+        print(f"[Load] 🖥️ API 已啟動於 {base_url} (工作資料夾 {workdir})")
+
+    try:
+        for label, path, body in traffic.warmup_requests():
+            send(base_url, label, path, body, Recorder())
+
+        recorder = Recorder()
+        if args.rps:
+            print(f"[Load] ▶ 開放迴圈 {args.rps} rps × {args.duration}s ...")
+            elapsed = run_open_loop(base_url, traffic, recorder, args.rps, args.duration, args.max_workers)
+        else:
+            print(f"[Load] ▶ 封閉迴圈 {args.concurrency} users × {args.duration}s ...")
+            elapsed = run_closed_loop(base_url, traffic, recorder, args.concurrency, args.duration)
+    finally:
+        if server:
+            server.terminate()
+            server.wait(timeout=10)
+
+    report = summarize(recorder, elapsed)
+    report["config"] = {
+        "url": base_url, "rps": args.rps, "concurrency": None if args.rps else args.concurrency,
+        "duration_s": args.duration, "replay": args.replay,
+        "mix": None if args.replay else args.mix,
+    }
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"\n[Load] 結果已儲存: {args.output}")
@@ -0,0 +1,160 @@
+"""
+🏠 Local Scorer - 以快取中的 LLM 評分訓練的本地第一輪評分模型 (CPU、毫秒級)
+- 特徵: HashingVectorizer (詞 1-2 gram + 字元 3-5 gram，不需保存詞彙表) 加上長度特徵
+- 模型: 多輸出 Ridge 的 bootstrap 集成；成員預測的標準差即為不確定度
+- provider='local'  : 只用本地模型 (練習回合的即時回饋，不呼叫 LLM)
+- provider='hybrid' : 不確定度低時直接採用本地分數，否則升級給 LLM
+
+訓練資料由 ielts_rca_analyzer 提供: essays_to_analyze/*.txt 依內容雜湊對應 ai_scores_cache.json
+中的 LLM 評分 (本地預測不會寫回快取，模型不會用自己的輸出訓練)。
+
+Usage:
+    python ielts_rca_analyzer.py --mode train-local-scorer
+"""
+
+import os
+import time
+import pickle
+import threading
+
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import Ridge
+
+LOCAL_SCORER_FILE = os.environ.get("LOCAL_SCORER_FILE", "local_scorer.pkl")
+LOCAL_SCORER_MIN_ESSAYS = int(os.environ.get("LOCAL_SCORER_MIN_ESSAYS", "30"))  # 少於此數不訓練
+LOCAL_SCORER_MEMBERS = int(os.environ.get("LOCAL_SCORER_MEMBERS", "8"))         # bootstrap 成員數
+LOCAL_SCORER_ALPHA = float(os.environ.get("LOCAL_SCORER_ALPHA", "1.0"))
+LOCAL_SCORER_MAX_STD = float(os.environ.get("LOCAL_SCORER_MAX_STD", "0.06"))    # hybrid: 任一指標超過即升級
+LOCAL_SCORER_MAX_BAND_STD = float(os.environ.get("LOCAL_SCORER_MAX_BAND_STD", "0.4"))
+HOLDOUT_FRACTION = 0.2
+HASH_FEATURES = 2 ** 14   # 每種 n-gram 的雜湊維度；係數矩陣 = 2 × 維度 × 成員 × 指標 (float32)
+
+_word_vectorizer = HashingVectorizer(ngram_range=(1, 2), n_features=HASH_FEATURES, alternate_sign=False,
+                                     lowercase=True)
+_char_vectorizer = HashingVectorizer(analyzer='char_wb', ngram_range=(3, 5), n_features=HASH_FEATURES,
+                                     alternate_sign=False, lowercase=True)
+
+
+def featurize(texts):
+    """Sparse feature matrix: hashed word / char n-grams plus scaled length features."""
+    words = np.array([len(t.split()) for t in texts], dtype=float)
+    sentences = np.array([max(1, t.count('.') + t.count('!') + t.count('?')) for t in texts], dtype=float)
+    dense = np.column_stack([np.log1p(words) / 8.0, words / sentences / 40.0])
+    return sparse.hstack([_word_vectorizer.transform(texts), _char_vectorizer.transform(texts),
+                          sparse.csr_matrix(dense)], format='csr')
+
+
+class LocalScorer:
+    """
+    Bootstrap ensemble of multi-output ridge models, stored as one stacked coefficient
+    matrix so a prediction is a single sparse x dense matmul.
+    """
+
+    def __init__(self, targets, coef, intercept, members, meta):
+        self.targets = list(targets)
+        self.coef = coef              # dense (n_features, members * n_targets)
+        self.intercept = intercept    # (members * n_targets,)
+        self.members = members
+        self.meta = meta              # n_train, holdout_mae, trained_at, rubric_version, ...
+
+    def predict_many(self, texts):
+        """Return (mean, std) arrays of shape (n_texts, n_targets)."""
+        raw = featurize(texts) @ self.coef + self.intercept
+        raw = np.asarray(raw).reshape(len(texts), self.members, len(self.targets))
+        return raw.mean(axis=1), raw.std(axis=1)
+
+    def predict(self, text):
+        """({target: score}, {target: std}) for one essay, clipped to the score scales."""
+        mean, std = self.predict_many([text])
+        scores, spread = {}, {}
+        for i, target in enumerate(self.targets):
+            upper = 9.0 if target == 'overall_band' else 1.0
+            scores[target] = round(float(np.clip(mean[0, i], 0.0, upper)), 1 if upper > 1 else 2)
+            spread[target] = round(float(std[0, i]), 3)
+        return scores, spread
+
+    def is_confident(self, spread, max_std=LOCAL_SCORER_MAX_STD, max_band_std=LOCAL_SCORER_MAX_BAND_STD):
+        return all(s <= (max_band_std if t == 'overall_band' else max_std) for t, s in spread.items())
+
+
+def _fit_ensemble(X, Y, members, alpha, rng):
+    """
+    Bootstrap ridge ensemble -> (coef (n_features, members * n_targets), intercept). Y may
+    hold NaN for unlabelled cells; targets labelled on the same rows are fitted together
+    on those rows only.
+    """
+    n_targets = Y.shape[1]
+    coef = np.zeros((X.shape[1], members, n_targets), dtype=np.float32)
+    intercept = np.zeros((members, n_targets), dtype=np.float32)
+    labelled = ~np.isnan(Y)
+    groups = {}
+    for t in range(n_targets):
+        groups.setdefault(labelled[:, t].tobytes(), []).append(t)
+    for cols in groups.values():
+        rows = np.flatnonzero(labelled[:, cols[0]])
+        if len(rows) == 0:
+            continue  # 這組指標在此子集中沒有標籤 (係數維持 0)
+        for m in range(members):
+            idx = rows[rng.integers(0, len(rows), size=len(rows))]
+            model = Ridge(alpha=alpha).fit(X[idx], Y[np.ix_(idx, cols)])
+            coef[:, m, cols] = model.coef_.reshape(len(cols), -1).T   # 單一輸出時 coef_ 為 1 維
+            intercept[m, cols] = np.reshape(model.intercept_, len(cols))
+    return coef.reshape(X.shape[1], members * n_targets), intercept.reshape(-1)
+
+
+def train(texts, labels, targets, members=LOCAL_SCORER_MEMBERS, alpha=LOCAL_SCORER_ALPHA, seed=0, meta=None):
+    """
+    Fit a LocalScorer on essay texts and their LLM label dicts (a label dict may lack
+    targets, e.g. metrics that were scored by a heuristic). Targets with fewer than
+    LOCAL_SCORER_MIN_ESSAYS labels are left out of the model (meta['dropped_targets']).
+    Reports holdout MAE per target (fit on 80%), then refits on everything.
+    """
+    if len(texts) < LOCAL_SCORER_MIN_ESSAYS:
+        raise ValueError(f"Need at least {LOCAL_SCORER_MIN_ESSAYS} labelled essays, got {len(texts)}")
+    counts = {t: sum(1 for label in labels if label.get(t) is not None) for t in targets}
+    dropped = [t for t in targets if counts[t] < LOCAL_SCORER_MIN_ESSAYS]
+    targets = [t for t in targets if t not in dropped]
+    if not targets:
+        raise ValueError(f"No target has at least {LOCAL_SCORER_MIN_ESSAYS} labels")
+    rng = np.random.default_rng(seed)
+    X = featurize(texts)
+    Y = np.array([[float(label[t]) if label.get(t) is not None else np.nan for t in targets] for label in labels])
+
+    order = rng.permutation(len(texts))
+    n_holdout = max(1, int(len(texts) * HOLDOUT_FRACTION))
+    test, fit = order[:n_holdout], order[n_holdout:]
+    coef, intercept = _fit_ensemble(X[fit], Y[fit], members, alpha, rng)
+    pred = np.asarray(X[test] @ coef + intercept).reshape(len(test), members, len(targets)).mean(axis=1)
+    holdout_mae = dict(zip(targets, np.round(np.nanmean(np.abs(pred - Y[test]), axis=0), 4).tolist()))
+
+    coef, intercept = _fit_ensemble(X, Y, members, alpha, rng)
+    meta = dict(meta or {}, n_train=len(texts), holdout_mae=holdout_mae, members=members, alpha=alpha,
+                dropped_targets=dropped, trained_at=time.strftime("%Y-%m-%d %H:%M:%S"))
+    return LocalScorer(targets, coef, intercept, members, meta)
+
+
+def save(scorer, path=LOCAL_SCORER_FILE):
+    tmp = f"{path}.tmp"
+    with open(tmp, 'wb') as f:
+        pickle.dump(scorer, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+_loaded = {"mtime": None, "scorer": None}
+_load_lock = threading.Lock()
+
+
+def get_scorer(path=LOCAL_SCORER_FILE):
+    """The trained scorer (reloaded when the file changes), or None if not trained yet."""
+    with _load_lock:
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None
+        if _loaded["mtime"] != mtime:
+            with open(path, 'rb') as f:
+                _loaded["scorer"] = pickle.load(f)
+            _loaded["mtime"] = mtime
+        return _loaded["scorer"]
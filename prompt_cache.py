@@ -0,0 +1,213 @@
+"""
+🗂️ Prompt Cache - 供應商端的提示前綴快取
+- Gemini : 以 CachedContent 保存固定的 system prompt (評分用的 examiner prompt)，之後的呼叫
+           只送出作文本身。快取以 TTL 管理：快到期時延長，過期、被服務端移除或建立失敗時
+           退回一般呼叫並在稍後重建。
+- Kimi 等 OpenAI 相容端點 : 沒有顯式快取 API，依賴服務端的自動前綴快取；stable_prefix()
+           確保 system 訊息逐字不變並固定排在最前面，讓每次請求共用同一個前綴。
+
+快取命中的 tokens 由 provider 回報 (Gemini cached_content_token_count /
+OpenAI prompt_tokens_details.cached_tokens)，記入 token ledger 並以折扣價計費。
+"""
+
+import os
+import time
+import hashlib
+import datetime
+import threading
+
+import arena_metrics
+from token_ledger import estimate_tokens
+
+try:
+    from google.generativeai import caching as genai_caching
+except ImportError:
+    genai_caching = None
+
+try:
+    from google.api_core import exceptions as google_exceptions
+except ImportError:
+    google_exceptions = None
+
+GEMINI_CACHE_ENABLED = os.environ.get("GEMINI_PROMPT_CACHE", "1") != "0"
+GEMINI_CACHE_TTL = float(os.environ.get("GEMINI_CACHE_TTL", "3600"))               # 每次建立/延長的存活秒數
+GEMINI_CACHE_REFRESH_MARGIN = float(os.environ.get("GEMINI_CACHE_REFRESH_MARGIN", "300"))  # 剩餘秒數低於此值時延長
+GEMINI_CACHE_MIN_TOKENS = int(os.environ.get("GEMINI_CACHE_MIN_TOKENS", "1024"))   # 模型的顯式快取最小長度
+GEMINI_CACHE_MAX_ENTRIES = int(os.environ.get("GEMINI_CACHE_MAX_ENTRIES", "8"))    # 同時保留的快取數 (按小時計費)
+GEMINI_CACHE_RETRY_AFTER = 600   # 建立失敗後多久再嘗試 (秒)
+
+
+def stable_prefix(messages):
+    """
+    Reorder messages so all system content comes first as one message, byte-identical
+    across calls (trailing whitespace stripped); the variable user text follows.
+    """
+    system = "\n\n".join(m['content'].rstrip() for m in messages if m['role'] == 'system')
+    rest = [m for m in messages if m['role'] != 'system']
+    return ([{"role": "system", "content": system}] if system else []) + rest
+
+
+def cached_prompt_tokens(usage_block):
+    """Cached prompt tokens from an OpenAI-style usage dict (0 when not reported)."""
+    details = usage_block.get("prompt_tokens_details") or {}
+    return int(details.get("cached_tokens") or usage_block.get("cached_tokens") or 0)
+
+
+def is_stale_handle_error(error):
+    """
+    True when a call through a CachedContent handle failed because the server no longer
+    has (or no longer lets us use) the cache: NotFound / PermissionDenied (404 / 403).
+    Only these are worth re-sending with the full prompt; timeouts and other errors are not.
+    """
+    if google_exceptions is not None and isinstance(error, (google_exceptions.NotFound,
+                                                            google_exceptions.PermissionDenied)):
+        return True
+    code = getattr(error, 'code', None)
+    code = getattr(code, 'value', code)  # grpc StatusCode 或 HTTP 狀態碼
+    if isinstance(code, tuple):
+        code = code[0]
+    return code in (403, 404, 5, 7)      # HTTP 404 / 403，gRPC NOT_FOUND=5 / PERMISSION_DENIED=7
+
+
+class _Entry:
+    def __init__(self, handle, expires_at):
+        self.handle = handle
+        self.expires_at = expires_at
+        self.last_used = time.monotonic()
+        self.refreshing = False
+
+
+class GeminiPromptCache:
+    """
+    (model, system prompt) -> CachedContent handle with TTL refresh and LRU eviction.
+    create/extend/delete default to google.generativeai.caching and can be replaced.
+    The network calls run outside the lock; while one caller creates or extends a
+    handle, the others call uncached (create) or keep using the current handle (extend).
+    """
+
+    def __init__(self, create=None, extend=None, delete=None, ttl=GEMINI_CACHE_TTL,
+                 refresh_margin=GEMINI_CACHE_REFRESH_MARGIN, min_tokens=GEMINI_CACHE_MIN_TOKENS,
+                 max_entries=GEMINI_CACHE_MAX_ENTRIES):
+        self.create = create or self._create
+        self.extend = extend or self._extend
+        self.delete = delete or self._delete
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.min_tokens = min_tokens
+        self.max_entries = max_entries
+        self.entries = {}
+        self._failed = {}   # key -> monotonic time of the last failed create
+        self._creating = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model, system_instruction):
+        return (model, hashlib.sha256(system_instruction.encode('utf-8')).hexdigest()[:16])
+
+    def get(self, model, system_instruction):
+        """Return a live CachedContent handle for this prompt, or None to call uncached."""
+        if not GEMINI_CACHE_ENABLED or not system_instruction:
+            return None
+        if estimate_tokens(system_instruction) < self.min_tokens:
+            return None  # 低於模型的最小快取長度；穩定前綴仍可吃到隱式快取
+        key = self.key(model, system_instruction)
+        now = time.monotonic()
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.expires_at <= now:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                if key in self._creating or \
+                        now - self._failed.get(key, -GEMINI_CACHE_RETRY_AFTER) < GEMINI_CACHE_RETRY_AFTER:
+                    return None
+                self._creating.add(key)
+            elif entry.expires_at - now < self.refresh_margin and not entry.refreshing:
+                entry.refreshing = True
+            else:
+                arena_metrics.PROMPT_CACHE_EVENTS.inc(provider='gemini', event='hit')
+                entry.last_used = now
+                return entry.handle
+
+        # 建立 / 延長是網路呼叫：不持有鎖，其他 Gemini 呼叫不必排隊
+        if entry is None:
+            entry = self._create_entry(key, model, system_instruction, now)
+            if entry is None:
+                return None
+        else:
+            self._extend_entry(entry, now)
+        entry.last_used = now
+        return entry.handle
+
+    def invalidate(self, model, system_instruction):
+        """Forget a handle the server rejected and delete it (it would otherwise be billed until its TTL)."""
+        with self._lock:
+            entry = self.entries.pop(self.key(model, system_instruction), None)
+        arena_metrics.PROMPT_CACHE_EVENTS.inc(provider='gemini', event='invalidated')
+        if entry is not None:
+            self._delete_quietly(entry.handle)
+
+    def _create_entry(self, key, model, system_instruction, now):
+        try:
+            handle = self.create(model, system_instruction, self.ttl)
+        except Exception as e:
+            print(f"  [Cache] Gemini 快取建立失敗，{GEMINI_CACHE_RETRY_AFTER:.0f}s 內改用一般呼叫: {e}")
+            with self._lock:
+                self._creating.discard(key)
+                self._failed[key] = now
+            arena_metrics.PROMPT_CACHE_EVENTS.inc(provider='gemini', event='error')
+            return None
+        with self._lock:
+            self._creating.discard(key)
+            evicted = self._evict_oldest() if len(self.entries) >= self.max_entries else None
+            entry = self.entries[key] = _Entry(handle, now + self.ttl)
+        arena_metrics.PROMPT_CACHE_EVENTS.inc(provider='gemini', event='create')
+        if evicted is not None:
+            self._delete_quietly(evicted.handle)
+        return entry
+
+    def _extend_entry(self, entry, now):
+        try:
+            self.extend(entry.handle, self.ttl)
+            entry.expires_at = now + self.ttl
+            arena_metrics.PROMPT_CACHE_EVENTS.inc(provider='gemini', event='refresh')
+        except Exception as e:
+            # 延長失敗時沿用原本的到期時間，到期後重建
+            print(f"  [Cache] Gemini 快取延長失敗: {e}")
+            arena_metrics.PROMPT_CACHE_EVENTS.inc(provider='gemini', event='error')
+        finally:
+            entry.refreshing = False
+
+    def _evict_oldest(self):
+        """Pop the least recently used entry (caller holds the lock and deletes it afterwards)."""
+        key = min(self.entries, key=lambda k: self.entries[k].last_used)
+        arena_metrics.PROMPT_CACHE_EVENTS.inc(provider='gemini', event='evict')
+        return self.entries.pop(key)
+
+    def _delete_quietly(self, handle):
+        try:
+            self.delete(handle)
+        except Exception:
+            pass  # 刪不掉 (例如服務端已移除) 也會在 TTL 到期後自動消失
+
+    @staticmethod
+    def _create(model, system_instruction, ttl):
+        if genai_caching is None:
+            raise RuntimeError("google-generativeai caching module not available")
+        return genai_caching.CachedContent.create(
+            model=model if model.startswith("models/") else f"models/{model}",
+            display_name="ielts-examiner-prompt",
+            system_instruction=system_instruction,
+            ttl=datetime.timedelta(seconds=ttl),
+        )
+
+    @staticmethod
+    def _extend(handle, ttl):
+        handle.update(ttl=datetime.timedelta(seconds=ttl))
+
+    @staticmethod
+    def _delete(handle):
+        handle.delete()
+
+
+gemini_cache = GeminiPromptCache()
@@ -0,0 +1,211 @@
+"""
+🧮 RCA Workers - arena_api 的 CPU 密集階段行程池 (RandomForest 擬合 / matplotlib 繪圖)
+- 常駐的 spawn 行程：啟動時載入 ielts_rca_analyzer (sklearn / matplotlib / seaborn)，並先跑一次
+  小型擬合與繪圖，之後的請求不再付出 import、字型快取等冷啟動成本
+- 請求執行緒只送出精簡的 NumPy 陣列 (pack_frame)，不 pickle 整個 DataFrame；等待結果時
+  不持有 GIL，其他請求執行緒可以繼續處理快取命中與 LLM I/O
+- 工作行程內的直方圖觀測 (RF 擬合、圖表繪製) 與 trace spans 隨結果傳回，在 API 行程補記，
+  /metrics 與 trace log 不會因為改用行程池而少掉這些數字；請求正在剖析時，工作行程也以
+  相同模式剖析該任務，結果併入請求的剖析檔
+- ARENA_CPU_WORKERS=0 時在呼叫端執行緒內直接執行 (與未使用行程池時相同)
+"""
+
+import io
+import os
+import time
+import threading
+import multiprocessing
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import pandas as pd
+
+import arena_metrics
+import arena_tracing as tracing
+import arena_profiling as profiling
+
+CPU_POOL_WORKERS = int(os.environ.get("ARENA_CPU_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 📦 COMPACT FRAME TRANSPORT
+# ═══════════════════════════════════════════════════════════════════════════
+
+def pack_frame(df):
+    """DataFrame -> dict with one float64 matrix for numeric columns plus plain lists for the rest."""
+    if df is None:
+        return None
+    numeric = [c for c in df.columns if pd.api.types.is_numeric_dtype(df[c])]
+    return {
+        'columns': list(df.columns),
+        'numeric': numeric,
+        'values': df[numeric].to_numpy(dtype=np.float64),
+        'other': {c: df[c].tolist() for c in df.columns if c not in numeric},
+        'index': df.index.to_numpy(),   # rca_df 已排序，繪圖依賴原本的 index
+        'attrs': dict(df.attrs),        # 例如 bootstrap 摘要
+    }
+
+
+def unpack_frame(packed):
+    if packed is None:
+        return None
+    data = dict(zip(packed['numeric'], packed['values'].T))
+    data.update(packed['other'])
+    df = pd.DataFrame(data, index=packed['index'], columns=packed['columns'])
+    df.attrs.update(packed.get('attrs', {}))
+    return df
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# ⚙️ WORKER TASKS (run inside the pool processes)
+# ═══════════════════════════════════════════════════════════════════════════
+
+def _warm():
+    """Pool initializer: import the analyzer and run one tiny fit + render so lazy imports are done."""
+    import ielts_rca_analyzer as analyzer
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.uniform(0.4, 0.9, size=(4, len(analyzer.TASK1_METRICS))),
+                      columns=list(analyzer.TASK1_METRICS))
+    df['overall_band'] = [5.5, 6.0, 6.5, 7.0]
+    df['file_name'] = [f"warm_{i}.txt" for i in range(len(df))]
+    rca = analyzer.perform_ml_analysis(df)
+    analyzer.plot_results(rca, df, "", image_file=io.BytesIO(), text_file=None)
+
+
+def _ping():
+    return os.getpid()
+
+
+def _captured(profile_mode, fn, *args):
+    """
+    Run fn(*args) in a worker, returning its metric observations, spans and (when the
+    request is being profiled) its profile with the value.
+    """
+    trace = tracing.start_trace(fn.__name__)
+    try:
+        with arena_metrics.capture() as observed, profiling.capture(profile_mode) as profiled:
+            value = fn(*args)
+    finally:
+        data = tracing.finish_trace(trace, log=False)
+    return {'value': value, 'observed': observed, 'trace': data, 'profile': profiled.result}
+
+
+def rca_task(packed_df, bootstrap=0):
+    import ielts_rca_analyzer as analyzer
+    return pack_frame(analyzer.perform_ml_analysis(unpack_frame(packed_df), bootstrap=bootstrap))
+
+
+def chart_task(packed_rca, packed_df, recommendations, packed_prev, text_file):
+    """Render the report chart and return the PNG bytes (text report written to text_file)."""
+    import ielts_rca_analyzer as analyzer
+    buffer = io.BytesIO()
+    analyzer.plot_results(unpack_frame(packed_rca), unpack_frame(packed_df), recommendations,
+                          unpack_frame(packed_prev), image_file=buffer, text_file=text_file)
+    return buffer.getvalue()
+
+
+def cohort_task(matrix, top=3):
+    """Cohort RCA on a cohort_rca.build_matrix() result (already columnar NumPy arrays)."""
+    import ielts_rca_analyzer as analyzer
+    return analyzer.cohort_rca.analyze(matrix, metric_names=analyzer.TASK1_METRICS,
+                                       variance_ref=analyzer.SCORE_VARIANCE_REF, top=top)
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 🏊 POOL
+# ═══════════════════════════════════════════════════════════════════════════
+
+class CpuPool:
+    """
+    Warm ProcessPoolExecutor (spawn) for CPU-bound stages. Falls back to running inline
+    when disabled or when the pool breaks (it is recreated for the next call); tasks
+    caught by another thread's reset (shut down / cancelled) also run inline.
+    """
+
+    def __init__(self, workers=CPU_POOL_WORKERS):
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Spawn and warm all workers now instead of on the first request."""
+        executor = self._get_executor()
+        if executor is not None:
+            for _ in range(self.workers):
+                executor.submit(_ping)
+        return self
+
+    def _get_executor(self):
+        if self.workers <= 0:
+            return None
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'),
+                                                     initializer=_warm)
+            return self._executor
+
+    def _reset(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, task, fn, *args):
+        """Start fn(*args) in the pool; returns a zero-arg callable that waits for the result."""
+        start = time.perf_counter()
+        executor = self._get_executor()
+        session = profiling.current_session()
+        future = None
+        if executor is not None:
+            try:
+                future = executor.submit(_captured, session.mode if session else None, fn, *args)
+            except BrokenProcessPool:
+                self._reset(executor)
+            except RuntimeError:
+                pass  # 另一個請求剛重設 (shutdown) 這個行程池
+
+        def result():
+            mode = 'pool'
+            try:
+                if future is None:
+                    mode = 'inline'
+                    value = fn(*args)
+                else:
+                    outcome = future.result()
+                    arena_metrics.replay(outcome['observed'])
+                    tracing.merge_trace(outcome['trace'], time.perf_counter())
+                    if session is not None:
+                        session.merge(outcome['profile'])
+                    value = outcome['value']
+            except BrokenProcessPool as e:
+                print(f"[CPU Pool] ⚠️ 工作行程異常結束，改在本執行緒執行 {task}: {e}")
+                self._reset(executor)
+                mode = 'inline'
+                value = fn(*args)
+            except CancelledError:
+                print(f"[CPU Pool] ⚠️ 行程池已重設，改在本執行緒執行 {task}")
+                mode = 'inline'
+                value = fn(*args)
+            arena_metrics.CPU_POOL_TASK_SECONDS.observe(time.perf_counter() - start, task=task, mode=mode)
+            return value
+        return result
+
+    def rca(self, *dfs, bootstrap=0):
+        """
+        perform_ml_analysis for each DataFrame, fitted concurrently; returns a list (None for
+        None inputs). Only the first frame (the current state) gets `bootstrap` resamples.
+        """
+        pending = [self.submit('rca', rca_task, pack_frame(df), bootstrap if i == 0 else 0) if df is not None else None
+                   for i, df in enumerate(dfs)]
+        return [unpack_frame(wait()) if wait is not None else None for wait in pending]
+
+    def chart(self, rca_df, df, recommendations, rca_prev_df=None, text_file=None):
+        """PNG bytes of the report chart."""
+        return self.submit('chart', chart_task, pack_frame(rca_df), pack_frame(df), recommendations,
+                           pack_frame(rca_prev_df), text_file)()
+
+    def cohort(self, matrix, top=3):
+        """Class-level RCA result dict (one pooled fit plus per-student fits in a single worker)."""
+        return self.submit('cohort', cohort_task, matrix, top)()
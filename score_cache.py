@@ -0,0 +1,431 @@
+"""
+💾 Score Cache Store
+ai_scores_cache.json 的共用存取層 (ielts_rca_analyzer.py CLI 與 arena_api.py 共用)
+
+Layout (format 2, minified JSON):
+    {
+      "format": 2,
+      "scores":  {content_hash: {metric: value, ..., "_rubric_version": 2}},
+      "aliases": {file_name: content_hash}
+    }
+
+每份評分只存一次 (以內容雜湊為鍵)，檔案名稱只是指向雜湊的別名。
+舊版 (format 1) 的扁平結構 {hash: {...}, file_name: {...}} 會在載入時自動轉換。
+
+新評分先寫入 append-only journal (ai_scores_cache.json.journal, 每行一筆)，
+快照只以「寫暫存檔 → fsync → rename」的方式原子替換，當機時不會損毀既有評分。
+CLI 與 API 可同時執行: 寫入時持有 <cache>.lock 檔案鎖，並合併 (而非覆蓋) 對方的新紀錄。
+
+Usage:
+    python score_cache.py compact [--file ai_scores_cache.json] [--essays-folder essays_to_analyze]
+"""
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+CACHE_FORMAT = 2
+DEFAULT_CACHE_FILE = "ai_scores_cache.json"
+JOURNAL_SUFFIX = ".journal"
+LOCK_SUFFIX = ".lock"
+JOURNAL_CHECKPOINT_ENTRIES = 200  # journal 超過此筆數時寫入新快照
+
+
+def _is_content_hash(key):
+    return len(key) == 32 and all(c in '0123456789abcdef' for c in key)
+
+
+def _hash_file(path):
+    """Same normalisation as get_content_hash() / get_essay_hash()."""
+    with open(path, 'r', encoding='utf-8') as f:
+        normalized = f.read().strip().lower()
+    return hashlib.md5(normalized.encode('utf-8')).hexdigest()
+
+
+def normalise_layout(raw, essay_folder=None):
+    """
+    Convert a raw cache document (either layout) into (scores, aliases).
+
+    Legacy documents stored each score dict twice: under the content hash and under the
+    file name, and the API embedded 'file_name' inside the entry. Filename keys are
+    resolved to their hash by hashing the essay file (when `essay_folder` is given) or by
+    matching an identical hash-keyed entry; unresolvable ones are kept under their own name.
+    """
+    if not isinstance(raw, dict):
+        return {}, {}
+    if raw.get('format') == CACHE_FORMAT:
+        return dict(raw.get('scores', {})), dict(raw.get('aliases', {}))
+
+    scores = {}
+    aliases = {}
+    by_content = {}
+
+    for key, entry in raw.items():
+        if not isinstance(entry, dict) or not _is_content_hash(key):
+            continue
+        record = {k: v for k, v in entry.items() if k != 'file_name'}
+        scores[key] = record
+        if entry.get('file_name'):
+            aliases[entry['file_name']] = key
+        by_content.setdefault(json.dumps(record, sort_keys=True), key)
+
+    for key, entry in raw.items():
+        if not isinstance(entry, dict) or _is_content_hash(key):
+            continue
+        record = {k: v for k, v in entry.items() if k != 'file_name'}
+        content_hash = None
+        if essay_folder:
+            path = os.path.join(essay_folder, key)
+            if os.path.exists(path):
+                content_hash = _hash_file(path)
+        if content_hash is None:
+            content_hash = by_content.get(json.dumps(record, sort_keys=True))
+        if content_hash is None:
+            content_hash = key  # orphan filename entry: keep it addressable by name
+        if content_hash not in scores or len(record) > len(scores[content_hash]):
+            scores[content_hash] = record
+        aliases[key] = content_hash
+
+    return scores, aliases
+
+
+def _fsync_dir(path):
+    """fsync the directory entry after a rename (no-op where unsupported, e.g. Windows)."""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)) or '.', os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class FileLock:
+    """
+    Inter-process lock on <cache>.lock (fcntl.flock on POSIX, msvcrt on Windows).
+    `shared=True` takes a reader lock where the platform supports it.
+    """
+
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+        self._fh = None
+
+    def __enter__(self):
+        self._fh = open(self.path, 'a+b')
+        if fcntl is not None:
+            fcntl.flock(self._fh.fileno(), fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        else:
+            # msvcrt 只有互斥鎖；LK_LOCK 重試約 10 秒後會拋錯，因此持續重試
+            self._fh.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self._fh.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fh.fileno(), fcntl.LOCK_UN)
+            else:
+                self._fh.seek(0)
+                msvcrt.locking(self._fh.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._fh.close()
+            self._fh = None
+
+
+class ScoreCache:
+    """
+    In-memory view of the score cache: one record per content hash plus a
+    filename → hash alias index.
+
+    Durability:
+    - `put()` appends the new record to an append-only journal (<cache>.journal)
+    - `commit()` group-commits every pending journal line with a single fsync; concurrent
+      writers that arrive while an fsync is in flight are committed together by the next one
+    - the snapshot (<cache>) is only ever replaced atomically (write temp → fsync → rename),
+      and the journal is truncated afterwards; `load()` replays the journal over the snapshot
+
+    Sharing between processes (CLI backfill + live API):
+    - journal appends and snapshots hold an exclusive FileLock; reads hold a shared one
+    - before appending, a writer first replays records other processes added since its last
+      read, and records are merged per hash ({**old, **new}) rather than overwritten
+    - `refresh()` picks up other writers' records in O(new journal bytes); a full re-read
+      only happens after another process has checkpointed a new snapshot
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_FILE, scores=None, aliases=None, checkpoint_every=JOURNAL_CHECKPOINT_ENTRIES, essay_folder=None):
+        self.path = path
+        self.journal_path = path + JOURNAL_SUFFIX
+        self.lock_path = path + LOCK_SUFFIX
+        self.scores = scores if scores is not None else {}
+        self.aliases = aliases if aliases is not None else {}
+        self.checkpoint_every = checkpoint_every
+        self.essay_folder = essay_folder
+
+        self._lock = threading.RLock()          # guards scores / aliases / pending / offsets
+        self._commit_lock = threading.Lock()    # one journal fsync at a time (per process)
+        self._pending = []
+        self._seq = 0
+        self._committed_seq = 0
+        self._journal_entries = 0
+        self._journal_offset = 0                # bytes of the journal already applied
+        self._snapshot_id = None
+
+    @classmethod
+    def load(cls, path=DEFAULT_CACHE_FILE, essay_folder=None):
+        cache = cls(path, essay_folder=essay_folder)
+        with FileLock(cache.lock_path, shared=True):
+            replayed = cache._reload_locked()
+        if replayed:
+            print(f"[Cache] 🔁 已從 journal 重播 {replayed} 筆評分")
+        return cache
+
+    # --- Disk sync (callers hold the FileLock) ---
+
+    def _snapshot_stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _reload_locked(self):
+        """Full re-read: snapshot, then journal, then our own not-yet-committed records."""
+        scores, aliases = {}, {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    scores, aliases = normalise_layout(json.load(f), self.essay_folder)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                # 舊版原地寫入可能留下損毀檔案: 移到旁邊保留，而不是默默覆蓋
+                # 只持有共用鎖: 同時讀到損毀檔案的另一個程序可能已先移走它
+                corrupt_path = f"{self.path}.corrupt-{time.strftime('%Y%m%d_%H%M%S')}"
+                try:
+                    os.replace(self.path, corrupt_path)
+                    print(f"[Warning] Cache snapshot corrupted, moved to {corrupt_path}; recovering from journal.")
+                except FileNotFoundError:
+                    print("[Warning] Cache snapshot corrupted (already moved aside); recovering from journal.")
+
+        with self._lock:
+            self.scores = scores
+            self.aliases = aliases
+            self._journal_offset = 0
+            self._journal_entries = 0
+            self._snapshot_id = self._snapshot_stat()
+            replayed = self._replay_journal_locked()
+            for line in self._pending:
+                self._apply(json.loads(line))
+        return replayed
+
+    def _replay_journal_locked(self):
+        """Apply complete journal lines appended since `_journal_offset`."""
+        if not os.path.exists(self.journal_path):
+            return 0
+        with open(self.journal_path, 'rb') as f:
+            f.seek(self._journal_offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1  # an unterminated tail is either torn or still being written
+        replayed = 0
+        for raw in data[:end].splitlines():
+            try:
+                record = json.loads(raw)
+            except (json.JSONDecodeError, UnicodeDecodeError):
+                continue  # torn line from a crash mid-append
+            self._apply(record)
+            replayed += 1
+        with self._lock:
+            self._journal_offset += end
+            self._journal_entries += replayed
+        return replayed
+
+    def _catch_up_locked(self):
+        try:
+            journal_size = os.path.getsize(self.journal_path)
+        except OSError:
+            journal_size = 0
+        if self._snapshot_stat() != self._snapshot_id or journal_size < self._journal_offset:
+            # 另一個程序已寫入新快照並截斷 journal
+            return self._reload_locked()
+        return self._replay_journal_locked()
+
+    def _apply(self, record):
+        """Merge one journal record: metrics are unioned per hash, never clobbered."""
+        with self._lock:
+            existing = self.scores.get(record['h'])
+            self.scores[record['h']] = {**existing, **record['s']} if existing else record['s']
+            if record.get('a'):
+                self.aliases[record['a']] = record['h']
+
+    def refresh(self):
+        """Pick up scores written by other processes (CLI ↔ API) since the last sync."""
+        with FileLock(self.lock_path, shared=True):
+            return self._catch_up_locked()
+
+    # --- Lookup ---
+
+    def __contains__(self, content_hash):
+        return content_hash in self.scores
+
+    def __len__(self):
+        return len(self.scores)
+
+    def get(self, content_hash):
+        return self.scores.get(content_hash)
+
+    def lookup(self, content_hash=None, file_name=None):
+        """
+        Hash-based lookup first, then the filename alias (CLI backward compatibility).
+        Returns (entry, content_hash) or (None, None).
+        """
+        if content_hash and content_hash in self.scores:
+            return self.scores[content_hash], content_hash
+        if file_name and file_name in self.aliases:
+            key = self.aliases[file_name]
+            if key in self.scores:
+                return self.scores[key], key
+        return None, None
+
+    def file_name_for(self, content_hash):
+        """Reverse alias lookup (first file name pointing at this hash)."""
+        for name, key in self.aliases.items():
+            if key == content_hash:
+                return name
+        return None
+
+    # --- Mutation ---
+
+    def put(self, content_hash, entry, file_name=None):
+        """
+        Store one record per hash; 'file_name' goes to the alias index, not the record.
+        Fields are merged into an existing record (same as replaying the journal), so a
+        key can be overwritten but not removed.
+        """
+        file_name = file_name or entry.get('file_name')
+        record = {k: v for k, v in entry.items() if k != 'file_name'}
+        line = json.dumps({'h': content_hash, 's': record, 'a': file_name}, ensure_ascii=False, separators=(',', ':'))
+        with self._lock:
+            self._apply({'h': content_hash, 's': record, 'a': file_name})
+            self._pending.append(line)
+            self._seq += 1
+            return self._seq
+
+    def commit(self, upto=None):
+        """
+        Durably append pending records to the journal (one write + one fsync per group).
+        Returns once everything up to `upto` (default: all puts so far) is on disk.
+        """
+        with self._lock:
+            target = self._seq if upto is None else upto
+        if self._committed_seq >= target:
+            return
+        with self._commit_lock:
+            with self._lock:
+                if self._committed_seq >= target:
+                    return  # committed by another writer's group
+                lines = self._pending
+                self._pending = []
+                group_seq = self._seq
+
+            with FileLock(self.lock_path):
+                # 先合併其他程序寫入的紀錄，再附加自己的
+                self._catch_up_locked()
+                data = ("\n".join(lines) + "\n").encode('utf-8')
+                with open(self.journal_path, 'ab+') as f:
+                    # 若上次當機留下不完整的最後一行，先補換行，避免與新紀錄黏在一起
+                    if f.tell() > 0:
+                        f.seek(-1, os.SEEK_END)
+                        if f.read(1) != b"\n":
+                            data = b"\n" + data
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    end_offset = f.tell()
+
+            with self._lock:
+                for line in lines:
+                    self._apply(json.loads(line))  # survive a reload done during catch-up
+                self._journal_offset = end_offset
+                self._journal_entries += len(lines)
+                self._committed_seq = group_seq
+
+    def save(self):
+        """Commit pending records; checkpoint into a fresh snapshot when the journal grows large."""
+        self.commit()
+        if self._journal_entries >= self.checkpoint_every:
+            self.snapshot()
+
+    def to_document(self):
+        with self._lock:
+            return {"format": CACHE_FORMAT, "scores": dict(self.scores), "aliases": dict(self.aliases)}
+
+    def snapshot(self):
+        """Atomically replace the snapshot (temp file → fsync → rename), then truncate the journal."""
+        self.commit()
+        with self._commit_lock:
+            with FileLock(self.lock_path):
+                self._catch_up_locked()
+                document = self.to_document()
+                tmp_path = f"{self.path}.tmp-{os.getpid()}"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(document, f, ensure_ascii=False, separators=(',', ':'))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+                _fsync_dir(self.path)
+                # 快照已包含所有 journal 紀錄，可安全截斷
+                with open(self.journal_path, 'w', encoding='utf-8') as f:
+                    f.flush()
+                    os.fsync(f.fileno())
+                with self._lock:
+                    self._journal_offset = 0
+                    self._journal_entries = 0
+                    self._snapshot_id = self._snapshot_stat()
+
+
+def compact_cache_file(path=DEFAULT_CACHE_FILE, essay_folder=None):
+    """Rewrite an existing cache file in the normalised, minified layout."""
+    if not os.path.exists(path):
+        print(f"[錯誤] 找不到快取檔案: {path}")
+        return False
+    size_before = os.path.getsize(path)
+    with open(path, 'r', encoding='utf-8') as f:
+        raw = json.load(f)
+    entries_before = len(raw) if raw.get('format') != CACHE_FORMAT else len(raw.get('scores', {}))
+
+    cache = ScoreCache.load(path, essay_folder)
+    cache.snapshot()
+    size_after = os.path.getsize(path)
+
+    print(f"[Cache] 🗜️ 壓縮完成: {path}")
+    print(f"  條目: {entries_before} → {len(cache.scores)} 筆評分 + {len(cache.aliases)} 個別名")
+    print(f"  大小: {size_before:,} → {size_after:,} bytes ({size_after / max(size_before, 1):.0%})")
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score cache maintenance")
+    parser.add_argument('command', choices=['compact'], help='compact: rewrite in the normalised minified layout')
+    parser.add_argument('--file', default=DEFAULT_CACHE_FILE, help='Cache file path')
+    parser.add_argument('--essays-folder', default="essays_to_analyze", help='Used to resolve legacy filename keys')
+    args = parser.parse_args()
+
+    if args.command == 'compact':
+        sys.exit(0 if compact_cache_file(args.file, args.essays_folder) else 1)
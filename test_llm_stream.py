@@ -0,0 +1,104 @@
+"""
+🧪 LLM Stream Filter Test
+ThinkFilter / JsonObjectDetector / StreamCollector 的串流切割情境
+(標籤或跳脫字元被 chunk 切開時，評分串流不能默默產生錯誤的輸出)
+
+    python -m pytest -q test_llm_stream.py
+"""
+
+import json
+
+import pytest
+
+from llm_stream import JsonObjectDetector, StreamCollector, ThinkFilter
+
+
+def _chunks(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def _splits(text):
+    """Every chunking of `text` into fixed-size pieces, plus every two-piece split."""
+    for size in range(1, len(text) + 1):
+        yield _chunks(text, size)
+    for i in range(1, len(text)):
+        yield [text[:i], text[i:]]
+
+
+def _think(chunks):
+    f = ThinkFilter()
+    return "".join(f.feed(c) for c in chunks) + f.flush()
+
+
+@pytest.mark.parametrize('text, expected', [
+    ("abc<think>hidden</think>def", "abcdef"),
+    ("<think>a</think>x<think>b</think>y", "xy"),
+    ("<think></think>{\"a\": 1}", "{\"a\": 1}"),
+    ("x < y and </think> stays", "x < y and </think> stays"),
+    ("ends with <thi", "ends with <thi"),       # 不是標籤的前綴在結尾輸出
+])
+def test_think_filter_split_tags(text, expected):
+    for chunks in _splits(text):
+        assert _think(chunks) == expected, chunks
+
+
+def test_think_filter_unterminated_block():
+    for chunks in _splits("answer <think>still reasoning </thi"):
+        f = ThinkFilter()
+        visible = "".join(f.feed(c) for c in chunks)
+        assert visible == "answer "
+        assert f.inside
+        assert f.flush() == ""  # 未結束的推理內容永遠不輸出
+
+
+def _detect(chunks):
+    detector = JsonObjectDetector()
+    for n, chunk in enumerate(chunks):
+        if detector.feed(chunk):
+            return detector, n
+    return detector, None
+
+
+@pytest.mark.parametrize('obj', [
+    '{"a": "}{", "b": {"c": [1, 2]}}',           # 字串內的括號
+    '{"a": "say \\"}\\" now", "b": 2}',           # 跳脫的引號
+    '{"path": "c:\\\\", "next": "{"}',            # 跳脫的反斜線後緊接結束引號
+    '{"u": "\\u007d", "n": {}}',
+])
+def test_json_detector_strings_and_escapes(obj):
+    json.loads(obj)
+    text = "Here you go: " + obj + " trailing {not json"
+    for chunks in _splits(text):
+        detector, n = _detect(chunks)
+        assert detector.complete, chunks
+        assert detector.text == obj
+        # tail = 完成物件的那個 chunk 中，物件之後的部分
+        assert "".join(chunks[:n + 1]) == text[:text.index(obj) + len(obj)] + detector.tail
+
+
+def test_json_detector_incomplete():
+    detector, n = _detect(_chunks('{"a": "unterminated }', 3))
+    assert n is None and not detector.complete
+
+
+def test_collector_stops_on_first_object():
+    chunks = ['<think>{"draft": 1}</think>Sure', ': {"a": 1, "s": "x}', '"', '} and <th', 'ink> text']
+    seen = []
+    collector = StreamCollector(seen.append, stop_at_json=True)
+    stopped_at = next(i for i, c in enumerate(chunks) if collector.feed(c))
+    assert stopped_at == 3
+    assert collector.stopped_early
+    assert collector.text == '{"a": 1, "s": "x}"}'
+    assert "".join(seen) == 'Sure: {"a": 1, "s": "x}"}'  # 物件之後的文字不輸出
+    assert collector.feed(' ignored after the stop') is True
+    assert collector.finish() == '{"a": 1, "s": "x}"}'
+    assert "".join(seen) == 'Sure: {"a": 1, "s": "x}"}'  # 被保留的 '<th' 也不在 finish() 時輸出
+
+
+def test_collector_without_stop_keeps_everything():
+    seen = []
+    collector = StreamCollector(seen.append)
+    for chunk in _chunks('<think>r</think>{"a": 1} then <th', 4):
+        assert collector.feed(chunk) is False
+    assert collector.finish() == '{"a": 1} then <th'
+    assert "".join(seen) == collector.text
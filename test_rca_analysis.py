@@ -0,0 +1,62 @@
+"""
+🧪 RCA Analysis Test
+perform_ml_analysis / bootstrap_bottlenecks 在部分指標缺值時的行為
+(例如 rubric v2 之前的快取沒有 lr_conciseness，補評失敗時沿用舊紀錄)
+
+    python -m pytest -q test_rca_analysis.py
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import ielts_rca_analyzer as analyzer
+
+MISSING = 'lr_conciseness'
+
+
+def _frame(rows=12, missing=4):
+    rng = np.random.default_rng(0)
+    metrics = list(analyzer.TASK1_METRICS)
+    df = pd.DataFrame(rng.uniform(0.4, 0.9, size=(rows, len(metrics))), columns=metrics)
+    df['overall_band'] = np.round(2 * (4 + 5 * df[metrics].mean(axis=1))) / 2
+    df.loc[:missing - 1, MISSING] = np.nan  # 最舊的幾篇沒有這個指標
+    return df
+
+
+def test_nan_weighted_mean_matches_pandas():
+    df = _frame()
+    values = df[list(analyzer.TASK1_METRICS)].to_numpy(dtype=float, copy=True)
+    assert np.allclose(analyzer.nan_weighted_mean(values), df[list(analyzer.TASK1_METRICS)].mean().to_numpy())
+
+    weights = 0.5 ** np.arange(len(df))[::-1]
+    column = df[MISSING].to_numpy()
+    present = ~np.isnan(column)
+    expected = (column[present] * weights[present]).sum() / weights[present].sum()
+    j = list(analyzer.TASK1_METRICS).index(MISSING)
+    assert analyzer.nan_weighted_mean(values, weights)[j] == pytest.approx(expected)
+
+    # 沒有任何分數的欄位維持 NaN，不影響其他欄位
+    values[:, 0] = np.nan
+    result = analyzer.nan_weighted_mean(values, weights)
+    assert np.isnan(result[0]) and np.isfinite(result[1:]).all()
+
+
+@pytest.mark.parametrize('half_life', [0, 4])
+def test_partially_missing_metric(monkeypatch, half_life):
+    monkeypatch.setattr(analyzer, 'RCA_HALF_LIFE', half_life)
+    df = _frame()
+    rca = analyzer.perform_ml_analysis(df, bootstrap=0).set_index('Metric')
+    assert np.isfinite(rca['Avg_Score']).all()
+    assert np.isfinite(rca['Bottleneck_Index']).all()
+    if not half_life:
+        assert rca.loc[MISSING, 'Avg_Score'] == pytest.approx(df[MISSING].mean())
+
+
+def test_bootstrap_with_missing_metric(monkeypatch):
+    monkeypatch.setattr(analyzer, 'RCA_BOOTSTRAP_BUDGET', 60)
+    rca = analyzer.perform_ml_analysis(_frame(), bootstrap=20).set_index('Metric')
+    assert rca.attrs['bootstrap']['resamples'] == 20
+    for column in ('BI_CI_Low', 'BI_CI_High', 'Rank_Stability'):
+        assert np.isfinite(rca[column]).all()
+    assert rca.loc[MISSING, 'BI_CI_Low'] <= rca.loc[MISSING, 'BI_CI_High']
@@ -0,0 +1,186 @@
+"""
+🧪 Score Cache Concurrency Test
+ScoreCache 的跨程序行為 (journal、FileLock、merge-on-apply、group-commit fsync)
+
+    python -m pytest -q test_score_cache.py
+
+寫入程序以 spawn 啟動 (與 rca_workers 相同，Windows 也適用)，彼此只透過快取檔案溝通。
+"""
+
+import os
+import json
+import time
+import threading
+import multiprocessing
+
+import score_cache
+from score_cache import ScoreCache
+
+WRITERS = 4
+PUTS_PER_WRITER = 60
+
+
+def _hash(writer, i):
+    return f"{writer:04x}{i:028x}"
+
+
+def _writer(path, writer, start, checkpoint_every):
+    """One process: private hashes, one shared hash (own metric per put), periodic checkpoints."""
+    cache = ScoreCache.load(path)
+    cache.checkpoint_every = checkpoint_every
+    start.wait()
+    for i in range(PUTS_PER_WRITER):
+        cache.put(_hash(writer, i), {'overall_band': 6.0, 'writer': writer}, file_name=f"w{writer}_{i}.txt")
+        cache.put('f' * 32, {f"m{writer}_{i}": i})
+        cache.save()
+        if i % 7 == 0:
+            cache.refresh()
+
+
+def _run_writers(path, checkpoint_every):
+    ctx = multiprocessing.get_context('spawn')
+    start = ctx.Event()
+    procs = [ctx.Process(target=_writer, args=(path, w, start, checkpoint_every)) for w in range(WRITERS)]
+    for p in procs:
+        p.start()
+    start.set()
+    for p in procs:
+        p.join(120)
+        assert p.exitcode == 0
+
+
+def _assert_complete(cache):
+    for w in range(WRITERS):
+        for i in range(PUTS_PER_WRITER):
+            assert cache.get(_hash(w, i)) == {'overall_band': 6.0, 'writer': w}
+            assert cache.aliases[f"w{w}_{i}.txt"] == _hash(w, i)
+    # 同一個 hash 的部分紀錄合併，而不是互相覆蓋
+    shared = cache.get('f' * 32)
+    assert shared == {f"m{w}_{i}": i for w in range(WRITERS) for i in range(PUTS_PER_WRITER)}
+
+
+def test_concurrent_writers_journal_only(tmp_path):
+    path = str(tmp_path / "cache.json")
+    _run_writers(path, checkpoint_every=10 ** 9)
+    assert not os.path.exists(path)
+    _assert_complete(ScoreCache.load(path))
+
+
+def test_concurrent_writers_with_checkpoints(tmp_path):
+    # 小的 checkpoint 間隔: 其他程序附加 journal 的同時，快照不斷被替換、journal 被截斷
+    path = str(tmp_path / "cache.json")
+    _run_writers(path, checkpoint_every=25)
+    with open(path, encoding='utf-8') as f:
+        assert json.load(f)['format'] == score_cache.CACHE_FORMAT
+    _assert_complete(ScoreCache.load(path))
+
+
+def _put_and_commit(path, items, snapshot=False):
+    cache = ScoreCache.load(path)
+    for content_hash, entry in items:
+        cache.put(content_hash, entry)
+    cache.snapshot() if snapshot else cache.commit()
+
+
+def test_refresh_sees_other_process(tmp_path):
+    path = str(tmp_path / "cache.json")
+    ctx = multiprocessing.get_context('spawn')
+    reader = ScoreCache.load(path)
+    reader.put('a' * 32, {'overall_band': 5.0})
+    reader.commit()
+
+    def run(items, snapshot=False):
+        p = ctx.Process(target=_put_and_commit, args=(path, items, snapshot))
+        p.start()
+        p.join(60)
+        assert p.exitcode == 0
+
+    # journal 附加: refresh 只重播新的部分
+    run([('b' * 32, {'overall_band': 6.0}), ('a' * 32, {'ta_data_accuracy': 0.7})])
+    assert reader.refresh() == 2
+    assert reader.get('b' * 32) == {'overall_band': 6.0}
+    assert reader.get('a' * 32) == {'overall_band': 5.0, 'ta_data_accuracy': 0.7}
+    assert reader.refresh() == 0
+
+    # 另一個程序寫入新快照並截斷 journal: refresh 改為完整重讀
+    run([('c' * 32, {'overall_band': 7.0})], snapshot=True)
+    assert os.path.getsize(reader.journal_path) == 0
+    reader.refresh()
+    assert sorted(reader.scores) == ['a' * 32, 'b' * 32, 'c' * 32]
+
+    # 尚未 commit 的本地紀錄在完整重讀後仍然存在，並在 commit 時與磁碟上的紀錄合併
+    reader.put('d' * 32, {'overall_band': 8.0})
+    run([('e' * 32, {'overall_band': 4.0})], snapshot=True)
+    reader.commit()
+    assert reader.get('d' * 32) == {'overall_band': 8.0}
+    assert reader.get('e' * 32) == {'overall_band': 4.0}
+    assert len(ScoreCache.load(path)) == 5
+
+
+def test_group_commit_shares_fsync(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.json")
+    cache = ScoreCache.load(path)
+    real_fsync = os.fsync
+    calls = []
+
+    def slow_fsync(fd):
+        calls.append(fd)
+        time.sleep(0.02)  # 讓其他執行緒在 fsync 期間排隊，由下一次 fsync 一併寫入
+        real_fsync(fd)
+
+    monkeypatch.setattr(score_cache.os, 'fsync', slow_fsync)
+    threads = 16
+    barrier = threading.Barrier(threads)
+
+    def writer(n):
+        barrier.wait()
+        cache.commit(cache.put(f"{n:032x}", {'overall_band': 6.0}))
+
+    workers = [threading.Thread(target=writer, args=(n,)) for n in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+    assert 1 <= len(calls) < threads
+    with open(cache.journal_path, 'rb') as f:
+        assert len(f.read().splitlines()) == threads
+    assert len(ScoreCache.load(path)) == threads
+
+
+def test_torn_journal_tail(tmp_path):
+    path = str(tmp_path / "cache.json")
+    cache = ScoreCache.load(path)
+    cache.put('a' * 32, {'overall_band': 5.0})
+    cache.commit()
+    with open(cache.journal_path, 'ab') as f:
+        f.write(b'{"h":"' + b'b' * 32 + b'","s":{"overall_ba')  # 當機留下的半行
+
+    other = ScoreCache.load(path)
+    assert sorted(other.scores) == ['a' * 32]
+    other.put('c' * 32, {'overall_band': 7.0})
+    other.commit()
+
+    reloaded = ScoreCache.load(path)
+    assert sorted(reloaded.scores) == ['a' * 32, 'c' * 32]
+
+
+def test_corrupt_snapshot_moved_by_another_reader(tmp_path, monkeypatch):
+    path = str(tmp_path / "cache.json")
+    cache = ScoreCache.load(path)
+    cache.put('a' * 32, {'overall_band': 5.0})
+    cache.commit()
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"format": 2, "scores": {')  # 舊版原地寫入中斷留下的檔案
+
+    real_replace = os.replace
+
+    def replace_after_other_reader(src, dst):
+        # 另一個持有共用鎖的讀取者搶先把損毀的快照移走
+        real_replace(src, dst + "-other")
+        real_replace(src, dst)
+
+    monkeypatch.setattr(score_cache.os, 'replace', replace_after_other_reader)
+    reloaded = ScoreCache.load(path)
+    assert reloaded.get('a' * 32) == {'overall_band': 5.0}
+    assert not os.path.exists(path)
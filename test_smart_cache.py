@@ -14,6 +14,8 @@ import time
 import os
 import glob
 
+from score_cache import ScoreCache
+
 API_BASE = "http://localhost:5000"
 ESSAYS_FOLDER = "essays_to_analyze"
 CACHE_FILE = "ai_scores_cache.json"
@@ -48,10 +50,7 @@ def test_1_first_submission():
     # 記錄提交前的狀態
     files_before = set(glob.glob(f"{ESSAYS_FOLDER}/*.txt")) if os.path.exists(ESSAYS_FOLDER) else set()
     
-    cache_before = {}
-    if os.path.exists(CACHE_FILE):
-        with open(CACHE_FILE, 'r', encoding='utf-8') as f:
-            cache_before = json.load(f)
+    cache_before = ScoreCache.load(CACHE_FILE)
     
     print(f"[Before] 作文數量: {len(files_before)}")
     print(f"[Before] 快取條目數: {len(cache_before)}")
@@ -84,8 +83,7 @@ def test_1_first_submission():
     files_after = set(glob.glob(f"{ESSAYS_FOLDER}/*.txt")) if os.path.exists(ESSAYS_FOLDER) else set()
     new_files = files_after - files_before
     
-    with open(CACHE_FILE, 'r', encoding='utf-8') as f:
-        cache_after = json.load(f)
+    cache_after = ScoreCache.load(CACHE_FILE)
     
     print(f"\n[After] 作文數量: {len(files_after)}")
     print(f"[After] 快取條目數: {len(cache_after)}")
@@ -172,14 +170,13 @@ def test_3_cli_cross_reference():
     
     # 檢查快取內容
     if os.path.exists(CACHE_FILE):
-        with open(CACHE_FILE, 'r', encoding='utf-8') as f:
-            cache = json.load(f)
+        cache = ScoreCache.load(CACHE_FILE)
         
         print(f"\n[Cache] 快取條目數: {len(cache)}")
         
-        # 檢查是否同時有雜湊鍵和檔案名鍵
-        hash_keys = [k for k in cache.keys() if len(k) == 32 and all(c in '0123456789abcdef' for c in k)]
-        filename_keys = [k for k in cache.keys() if k.endswith('.txt')]
+        # 檢查是否同時有雜湊鍵 (評分紀錄) 和檔案名別名
+        hash_keys = [k for k in cache.scores.keys() if len(k) == 32 and all(c in '0123456789abcdef' for c in k)]
+        filename_keys = [k for k in cache.aliases.keys() if k.endswith('.txt')]
         
         print(f"[Cache] 雜湊鍵數量: {len(hash_keys)}")
         print(f"[Cache] 檔案名鍵數量: {len(filename_keys)}")
@@ -0,0 +1,299 @@
+"""
+🪙 Token Ledger - LLM token 用量與成本記帳
+每次 LLM 呼叫的 prompt / completion tokens 以一行 JSON 附加到 TOKEN_USAGE_FILE；
+provider 沒有回報用量時以字元數估算 (estimated=true)。
+
+彙總維度: 日期 × 端點 (API 路徑或 cli:<mode>) × 學生 × provider × 呼叫類型 (task)。
+每日預算 (DAILY_TOKEN_BUDGET / DAILY_STUDENT_TOKEN_BUDGET) 依呼叫類型分級降級：
+達到預算 80% 時略過詳細報告 (deep_dive)，100% 時略過 AI 建議，120% 時停止新評分。
+
+Usage:
+    python token_ledger.py                   # 今日用量摘要
+    python token_ledger.py --days 7 --by student
+"""
+
+import os
+import re
+import json
+import time
+import argparse
+import threading
+import contextlib
+import contextvars
+from collections import defaultdict
+
+USAGE_FILE = os.environ.get("TOKEN_USAGE_FILE", "token_usage.jsonl")
+DAILY_TOKEN_BUDGET = int(os.environ.get("DAILY_TOKEN_BUDGET", "0"))                   # 全體每日上限，0 = 不限制
+DAILY_STUDENT_TOKEN_BUDGET = int(os.environ.get("DAILY_STUDENT_TOKEN_BUDGET", "0"))   # 每位學生每日上限，0 = 不限制
+
+# 每種呼叫類型可使用的預算比例：越不重要的呼叫越早停止
+TASK_BUDGET_SHARE = {
+    'deep_dive': 0.8,
+    'recommendations': 1.0,
+    'scoring': 1.2,
+    'partial_scoring': 1.2,
+}
+DEFAULT_BUDGET_SHARE = 1.0
+
+# USD per 1M tokens (input, output)；依合約價格調整
+TOKEN_PRICES = {
+    'kimi': (0.60, 2.50),
+    'gemini': (0.30, 2.50),
+    'fake': (0.0, 0.0),
+}
+# 命中供應商提示快取的 prompt tokens 以輸入價格的此比例計費
+CACHED_PROMPT_PRICE_RATIO = {
+    'kimi': 0.25,
+    'gemini': 0.25,
+}
+
+GROUP_FIELDS = ('endpoint', 'student', 'provider', 'task')
+
+_CJK = re.compile(r'[　-〿㐀-䶿一-鿿豈-﫿＀-￯]')
+
+
+def estimate_tokens(text):
+    """Rough token count: one per CJK character, ~4 characters per token otherwise."""
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return cjk + max(0, len(text) - cjk + 3) // 4
+
+
+def estimate_cost(provider, prompt_tokens, completion_tokens, cached_tokens=0):
+    """USD cost; `cached_tokens` (part of prompt_tokens) are billed at the cached-prompt rate."""
+    price_in, price_out = TOKEN_PRICES.get(provider, (0.0, 0.0))
+    cached_in = price_in * CACHED_PROMPT_PRICE_RATIO.get(provider, 1.0)
+    return ((prompt_tokens - cached_tokens) * price_in + cached_tokens * cached_in
+            + completion_tokens * price_out) / 1_000_000
+
+
+class BudgetExceeded(Exception):
+    """Raised before an LLM call when the daily token budget for its task is used up."""
+
+    def __init__(self, task, scope, used, limit):
+        self.task = task
+        self.scope = scope
+        self.used = used
+        self.limit = limit
+        super().__init__(f"Daily token budget exceeded for {task} ({scope}: {used}/{limit} tokens)")
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 🏷️ CALL CONTEXT (which endpoint / student the tokens are spent for)
+# ═══════════════════════════════════════════════════════════════════════════
+
+_context = contextvars.ContextVar("token_usage_context", default={"endpoint": "unknown", "student": "anonymous"})
+
+
+def set_context(endpoint=None, student=None):
+    current = dict(_context.get())
+    if endpoint:
+        current["endpoint"] = endpoint
+    if student:
+        current["student"] = str(student)
+    return _context.set(current)
+
+
+@contextlib.contextmanager
+def usage_context(endpoint=None, student=None):
+    token = set_context(endpoint, student)
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def current_context():
+    return _context.get()
+
+
+# ═══════════════════════════════════════════════════════════════════════════
+# 📒 LEDGER
+# ═══════════════════════════════════════════════════════════════════════════
+
+class TokenLedger:
+    """
+    Append-only usage log with in-memory daily totals. Other processes' appends
+    (CLI vs API) are picked up incrementally by refresh().
+    """
+
+    def __init__(self, path=USAGE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._offset = 0
+        # (day, endpoint, student, provider, task) -> totals
+        self.totals = defaultdict(lambda: {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                                           "cached_tokens": 0, "cost_usd": 0.0, "estimated_calls": 0})
+        self.refresh()
+
+    def _apply(self, record):
+        key = (record["day"],) + tuple(record.get(f, "unknown") for f in GROUP_FIELDS)
+        t = self.totals[key]
+        t["calls"] += 1
+        t["prompt_tokens"] += record.get("prompt_tokens", 0)
+        t["completion_tokens"] += record.get("completion_tokens", 0)
+        t["cached_tokens"] += record.get("cached_tokens", 0)
+        t["cost_usd"] += record.get("cost_usd", 0.0)
+        t["estimated_calls"] += 1 if record.get("estimated") else 0
+
+    def refresh(self):
+        """Read records appended since the last refresh (only complete lines)."""
+        with self._lock:
+            if not os.path.exists(self.path):
+                return
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+            end = data.rfind(b"\n") + 1
+            for line in data[:end].splitlines():
+                try:
+                    self._apply(json.loads(line))
+                except (json.JSONDecodeError, KeyError):
+                    continue
+            self._offset += end
+
+    def record(self, provider, task, prompt_tokens, completion_tokens, estimated=False, model=None, cached_tokens=0):
+        ctx = current_context()
+        record = {
+            "ts": round(time.time(), 3),
+            "day": time.strftime("%Y-%m-%d"),
+            "endpoint": ctx["endpoint"],
+            "student": ctx["student"],
+            "provider": provider,
+            "model": model,
+            "task": task or "other",
+            "prompt_tokens": int(prompt_tokens),
+            "completion_tokens": int(completion_tokens),
+            "cached_tokens": int(cached_tokens),
+            "estimated": bool(estimated),
+            "cost_usd": round(estimate_cost(provider, prompt_tokens, completion_tokens, cached_tokens), 6),
+        }
+        with self._lock:
+            # 單行 O_APPEND 寫入；多個程序同時附加也不會交錯
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.refresh()  # 讀回自己 (以及其他程序) 新增的紀錄
+        return record
+
+    def spent(self, day=None, student=None):
+        day = day or time.strftime("%Y-%m-%d")
+        total = 0
+        for key, t in list(self.totals.items()):
+            if key[0] == day and (student is None or key[2] == student):
+                total += t["prompt_tokens"] + t["completion_tokens"]
+        return total
+
+    def check(self, task, student=None):
+        """Raise BudgetExceeded if today's spend leaves no budget for this kind of call."""
+        share = TASK_BUDGET_SHARE.get(task, DEFAULT_BUDGET_SHARE)
+        student = student or current_context()["student"]
+        self.refresh()
+        if DAILY_TOKEN_BUDGET > 0:
+            used, limit = self.spent(), int(DAILY_TOKEN_BUDGET * share)
+            if used >= limit:
+                raise BudgetExceeded(task, "daily", used, limit)
+        if DAILY_STUDENT_TOKEN_BUDGET > 0:
+            used, limit = self.spent(student=student), int(DAILY_STUDENT_TOKEN_BUDGET * share)
+            if used >= limit:
+                raise BudgetExceeded(task, f"student {student}", used, limit)
+
+    def allows(self, task, student=None):
+        try:
+            self.check(task, student)
+            return True
+        except BudgetExceeded:
+            return False
+
+    def summary(self, days=1, by=GROUP_FIELDS, student=None):
+        """
+        Aggregate the last `days` days grouped by day plus the `by` fields.
+        Returns {"rows": [...], "totals": {...}, "budget": {...}}.
+        """
+        self.refresh()
+        cutoff = time.strftime("%Y-%m-%d", time.localtime(time.time() - (days - 1) * 86400))
+        groups = defaultdict(lambda: {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                                      "cached_tokens": 0, "cost_usd": 0.0, "estimated_calls": 0})
+        for key, t in list(self.totals.items()):
+            day, fields = key[0], dict(zip(GROUP_FIELDS, key[1:]))
+            if day < cutoff or (student and fields["student"] != student):
+                continue
+            gkey = (day,) + tuple(fields[f] for f in by)
+            for k, v in t.items():
+                groups[gkey][k] += v
+
+        rows = []
+        totals = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0,
+                  "cost_usd": 0.0, "estimated_calls": 0}
+        for gkey in sorted(groups):
+            row = {"day": gkey[0], **dict(zip(by, gkey[1:])), **groups[gkey]}
+            row["total_tokens"] = row["prompt_tokens"] + row["completion_tokens"]
+            row["cost_usd"] = round(row["cost_usd"], 6)
+            rows.append(row)
+            for k in totals:
+                totals[k] += groups[gkey][k]
+        totals["total_tokens"] = totals["prompt_tokens"] + totals["completion_tokens"]
+        totals["cost_usd"] = round(totals["cost_usd"], 6)
+        return {"rows": rows, "totals": totals, "budget": self.budget_status(student)}
+
+    def budget_status(self, student=None):
+        status = {"daily_budget": DAILY_TOKEN_BUDGET, "daily_used": self.spent(),
+                  "task_share": TASK_BUDGET_SHARE}
+        if student:
+            status["student_budget"] = DAILY_STUDENT_TOKEN_BUDGET
+            status["student_used"] = self.spent(student=student)
+        return status
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger():
+    """Process-wide ledger instance (created on first use)."""
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = TokenLedger(USAGE_FILE)
+        return _ledger
+
+
+def print_summary(report):
+    rows = report["rows"]
+    if not rows:
+        print("[Usage] 尚無 token 用量紀錄")
+        return
+    fields = [k for k in rows[0] if k not in ("calls", "prompt_tokens", "completion_tokens", "cached_tokens",
+                                               "total_tokens", "cost_usd", "estimated_calls")]
+    header = "".join(f"{f:<22}" for f in fields)
+    print(f"{header}{'calls':>7}{'prompt':>11}{'cached':>9}{'completion':>12}{'total':>11}{'USD':>10}")
+    print("-" * (len(header) + 60))
+    for row in rows:
+        label = "".join(f"{str(row[f])[:21]:<22}" for f in fields)
+        est = "*" if row["estimated_calls"] else " "
+        print(f"{label}{row['calls']:>7}{row['prompt_tokens']:>11}{row['cached_tokens']:>9}{row['completion_tokens']:>12}"
+              f"{row['total_tokens']:>10}{est}{row['cost_usd']:>10.4f}")
+    t = report["totals"]
+    print("-" * (len(header) + 60))
+    print(f"{'TOTAL':<{len(header)}}{t['calls']:>7}{t['prompt_tokens']:>11}{t['cached_tokens']:>9}{t['completion_tokens']:>12}"
+          f"{t['total_tokens']:>11}{t['cost_usd']:>10.4f}")
+    b = report["budget"]
+    if b["daily_budget"]:
+        print(f"\n今日預算: {b['daily_used']}/{b['daily_budget']} tokens ({b['daily_used'] / b['daily_budget']:.0%})")
+    print("(* 含估算用量: provider 未回報 usage)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LLM token usage summary")
+    parser.add_argument('--days', type=int, default=1, help='Number of days to include (default: today)')
+    parser.add_argument('--by', type=str, default=','.join(GROUP_FIELDS),
+                        help=f"Comma-separated grouping fields: {', '.join(GROUP_FIELDS)}")
+    parser.add_argument('--student', type=str, help='Only this student')
+    parser.add_argument('--file', type=str, default=USAGE_FILE)
+    args = parser.parse_args()
+
+    by = tuple(f.strip() for f in args.by.split(',') if f.strip())
+    unknown = [f for f in by if f not in GROUP_FIELDS]
+    if unknown:
+        parser.error(f"unknown grouping field(s): {', '.join(unknown)}")
+    print_summary(TokenLedger(args.file).summary(days=args.days, by=by, student=args.student))
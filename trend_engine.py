@@ -0,0 +1,183 @@
+"""
+📈 Trend Engine - 每個指標的線上趨勢與變點偵測 (每篇新作文 O(1) 更新，不重掃歷史)
+- EWMA / EW 標準差 : 近期水準與波動
+- 斜率             : 指數遺忘的加權線性回歸 (x = 作文序號)，以充分統計量遞迴更新
+- 變點 (CUSUM)     : 雙向 CUSUM，以更新前的 EWMA 為基準、EW 標準差標準化；超過門檻即記錄
+                     變點 (up / down) 並歸零
+- TrendRegistry    : API 端依學生保存引擎；請求的歷史與引擎狀態一致時只套用新作文，
+                     否則 (例如伺服器重啟) 由歷史重建一次
+
+分數尺度: 指標為 0-1，overall_band 為 0-9 (門檻依 SCALES 換算)。
+"""
+
+import os
+import math
+import hashlib
+import threading
+from collections import OrderedDict, deque
+
+TREND_ALPHA = float(os.environ.get("TREND_ALPHA", "0.3"))                    # EWMA 平滑係數
+TREND_SLOPE_HALF_LIFE = float(os.environ.get("TREND_SLOPE_HALF_LIFE", "10"))  # 斜率回歸的遺忘半衰期 (篇數)
+CUSUM_K = 0.5          # 允許的漂移 (標準差單位)
+CUSUM_H = 4.0          # 變點門檻 (標準差單位)
+TREND_WARMUP = 5       # 少於此篇數不判定變點 (EW 變異數尚未穩定)
+MAX_CHANGE_POINTS = 5  # 每個指標保留的最近變點數
+TREND_MAX_STUDENTS = int(os.environ.get("TREND_MAX_STUDENTS", "1000"))
+
+# 各尺度的最小標準差 (避免前幾篇波動為 0 時 z 值爆炸) 與「持平」的斜率範圍 (每篇)
+SCALES = {
+    'metric': {'min_std': 0.03, 'flat_slope': 0.005},
+    'band':   {'min_std': 0.25, 'flat_slope': 0.05},
+}
+
+
+class MetricTrend:
+    """Online EWMA, exponentially-forgetting slope and two-sided CUSUM for one metric."""
+
+    __slots__ = ('scale', 'alpha', 'decay', 'n', 'ewma', 'ewvar', 'sw', 'sx', 'sy', 'sxx', 'sxy',
+                 'cusum_pos', 'cusum_neg', 'change_points', 'last')
+
+    def __init__(self, scale='metric', alpha=TREND_ALPHA, slope_half_life=TREND_SLOPE_HALF_LIFE):
+        self.scale = SCALES[scale]
+        self.alpha = alpha
+        self.decay = 0.5 ** (1.0 / slope_half_life)
+        self.n = 0
+        self.ewma = self.ewvar = 0.0
+        self.sw = self.sx = self.sy = self.sxx = self.sxy = 0.0
+        self.cusum_pos = self.cusum_neg = 0.0
+        self.change_points = deque(maxlen=MAX_CHANGE_POINTS)
+        self.last = None
+
+    def update(self, value):
+        value = float(value)
+        if self.n == 0:
+            self.ewma = value
+        else:
+            diff = value - self.ewma
+            z = diff / max(math.sqrt(self.ewvar), self.scale['min_std'])
+            self.cusum_pos = max(0.0, self.cusum_pos + z - CUSUM_K)
+            self.cusum_neg = max(0.0, self.cusum_neg - z - CUSUM_K)
+            if self.n >= TREND_WARMUP and max(self.cusum_pos, self.cusum_neg) > CUSUM_H:
+                direction = 'up' if self.cusum_pos > self.cusum_neg else 'down'
+                self.change_points.append({'index': self.n, 'direction': direction})
+                self.cusum_pos = self.cusum_neg = 0.0
+            increment = self.alpha * diff
+            self.ewma += increment
+            self.ewvar = (1 - self.alpha) * (self.ewvar + diff * increment)
+
+        # 加權回歸的充分統計量: 舊資料依 decay 遺忘
+        x = float(self.n)
+        self.sw = self.decay * self.sw + 1.0
+        self.sx = self.decay * self.sx + x
+        self.sy = self.decay * self.sy + value
+        self.sxx = self.decay * self.sxx + x * x
+        self.sxy = self.decay * self.sxy + x * value
+        self.n += 1
+        self.last = value
+
+    @property
+    def slope(self):
+        denominator = self.sw * self.sxx - self.sx * self.sx
+        if self.n < 2 or denominator <= 1e-12:
+            return 0.0
+        return (self.sw * self.sxy - self.sx * self.sy) / denominator
+
+    def summary(self):
+        slope = self.slope
+        flat = self.scale['flat_slope']
+        return {
+            'n': self.n,
+            'last': self.last,
+            'ewma': round(self.ewma, 4),
+            'std': round(math.sqrt(self.ewvar), 4),
+            'slope': round(slope, 4),
+            'direction': 'improving' if slope > flat else ('declining' if slope < -flat else 'stable'),
+            'cusum_pos': round(self.cusum_pos, 3),
+            'cusum_neg': round(self.cusum_neg, 3),
+            'change_points': list(self.change_points),
+        }
+
+
+def row_key(row, metrics):
+    """Stable key of a score row (same scores -> same key), used to match API history with engine state."""
+    values = ",".join(f"{float(row[m]):.4f}" if m in row and row[m] is not None else "-" for m in metrics)
+    return hashlib.md5(values.encode('utf-8')).hexdigest()[:16]
+
+
+class TrendEngine:
+    """Per-metric MetricTrend set for one student; update(row) is O(number of metrics)."""
+
+    def __init__(self, metrics, band_key='overall_band'):
+        self.metrics = list(metrics)
+        self.band_key = band_key
+        self.trends = {m: MetricTrend() for m in self.metrics}
+        if band_key:
+            self.trends[band_key] = MetricTrend(scale='band')
+        self.n = 0
+        self.last_key = None
+
+    @classmethod
+    def from_rows(cls, rows, metrics, **kwargs):
+        engine = cls(metrics, **kwargs)
+        for row in rows:
+            engine.update(row)
+        return engine
+
+    def update(self, row):
+        for name, trend in self.trends.items():
+            value = row.get(name)
+            if value is not None and not (isinstance(value, float) and math.isnan(value)):
+                trend.update(value)
+        self.n += 1
+        self.last_key = row_key(row, self.metrics)
+
+    def snapshot(self):
+        return {name: trend.summary() for name, trend in self.trends.items()}
+
+    def recent_changes(self, within=1):
+        """Metrics whose latest change point is among the last `within` essays."""
+        return {name: trend.change_points[-1]['direction'] for name, trend in self.trends.items()
+                if trend.change_points and trend.change_points[-1]['index'] >= trend.n - within}
+
+
+class TrendRegistry:
+    """Student id -> TrendEngine (LRU). Rebuilds from history only when it is out of sync."""
+
+    def __init__(self, metrics, max_students=TREND_MAX_STUDENTS):
+        self.metrics = list(metrics)
+        self.max_students = max_students
+        self.engines = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, student):
+        with self._lock:
+            engine = self.engines.get(student)
+            if engine is not None:
+                self.engines.move_to_end(student)
+            return engine
+
+    def observe(self, student, history, new_row=None):
+        """
+        Bring the student's engine up to `history` (+ new_row) and return it. When the
+        engine already reflects `history` only new_row is applied (O(1)); a repeated
+        request for the same new essay is a no-op.
+        """
+        with self._lock:
+            engine = self.engines.get(student)
+            new_key = row_key(new_row, self.metrics) if new_row is not None else None
+            history_key = row_key(history[-1], self.metrics) if history else None
+            if engine is not None and new_row is not None and engine.n == len(history) + 1 \
+                    and engine.last_key == new_key:
+                pass  # 同一篇作文的重複請求
+            elif engine is not None and engine.n == len(history) and engine.last_key == history_key:
+                if new_row is not None:
+                    engine.update(new_row)
+            else:
+                engine = TrendEngine.from_rows(history, self.metrics)
+                if new_row is not None:
+                    engine.update(new_row)
+            self.engines[student] = engine
+            self.engines.move_to_end(student)
+            while len(self.engines) > self.max_students:
+                self.engines.popitem(last=False)
+            return engine